@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+from datetime import datetime
+
+# 只在文件开头这么多字节内查找EXIF，避免扫描整个文件
+MAX_SCAN_BYTES = 256 * 1024
+
+# 单个IFD最多读取的条目数，防止损坏的文件导致大量读取
+MAX_IFD_ENTRIES = 512
+
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+
+
+def _read_ifd(read, endian, offset):
+    """读取一个IFD，返回 {标签: (类型, 数量, 4字节值)}"""
+    raw = read(offset, 2)
+    if len(raw) < 2:
+        return {}
+    count = min(struct.unpack(endian + "H", raw)[0], MAX_IFD_ENTRIES)
+    data = read(offset + 2, count * 12)
+    entries = {}
+    for i in range(len(data) // 12):
+        tag, typ, n = struct.unpack(endian + "HHI", data[i * 12:i * 12 + 8])
+        entries[tag] = (typ, n, data[i * 12 + 8:i * 12 + 12])
+    return entries
+
+
+def _read_ascii(read, endian, entry):
+    typ, n, value = entry
+    if typ != 2 or n == 0:
+        return None
+    if n <= 4:
+        data = value[:n]
+    else:
+        data = read(struct.unpack(endian + "I", value)[0], min(n, 64))
+    return data.split(b"\x00", 1)[0].decode("ascii", "ignore").strip() or None
+
+
+def _parse_tiff(read):
+    """从TIFF结构中读取拍摄时间，read(offset, size) 返回相对TIFF头的数据"""
+    header = read(0, 8)
+    if header[:4] == b"II*\x00":
+        endian = "<"
+    elif header[:4] == b"MM\x00*":
+        endian = ">"
+    else:
+        return None
+
+    ifd0 = _read_ifd(read, endian, struct.unpack(endian + "I", header[4:8])[0])
+    candidates = []
+    if TAG_EXIF_IFD in ifd0:
+        exif_offset = struct.unpack(endian + "I", ifd0[TAG_EXIF_IFD][2])[0]
+        exif_ifd = _read_ifd(read, endian, exif_offset)
+        # 优先 DateTimeOriginal，其次 DateTimeDigitized
+        candidates += [exif_ifd.get(TAG_DATETIME_ORIGINAL), exif_ifd.get(TAG_DATETIME_DIGITIZED)]
+    # 再其次 ImageIFD.DateTime
+    candidates.append(ifd0.get(TAG_DATETIME))
+
+    for entry in candidates:
+        if entry is not None:
+            value = _read_ascii(read, endian, entry)
+            if value:
+                return value
+    return None
+
+
+def _bytes_reader(data):
+    return lambda offset, size: data[offset:offset + size]
+
+
+def _file_reader(f, base):
+    def read(offset, size):
+        f.seek(base + offset)
+        return f.read(size)
+    return read
+
+
+def _scan_jpeg(f):
+    """遍历JPEG标记段，只读取APP1段，遇到图像数据即停止"""
+    pos = 2
+    while pos < MAX_SCAN_BYTES:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        if marker in (0xD9, 0xDA):  # EOI、SOS
+            return None
+        length = struct.unpack(">H", header[2:4])[0]
+        if marker == 0xE1:
+            segment = f.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                return _parse_tiff(_bytes_reader(segment[6:]))
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+        pos += 2 + length
+    return None
+
+
+def _scan_png(f):
+    """遍历PNG数据块，只读取IDAT之前的eXIf块"""
+    pos = 8
+    while pos < MAX_SCAN_BYTES:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in (b"IDAT", b"IEND"):
+            return None
+        if chunk_type == b"eXIf":
+            return _parse_tiff(_bytes_reader(f.read(length)))
+        f.seek(length + 4, os.SEEK_CUR)
+        pos += 12 + length
+    return None
+
+
+def scan_exif_datetime(f):
+    """从已打开的文件中读取EXIF拍摄时间字符串，没有则返回None
+
+    只读取文件头部的EXIF结构，不解码图像。读取结束后文件位置回到开头，
+    同一个文件对象可以直接交给 Image.open 解码。
+    """
+    try:
+        f.seek(0)
+        head = f.read(8)
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            return _scan_jpeg(f)
+        if head[:4] in (b"II*\x00", b"MM\x00*"):
+            # TIFF 的IFD可能位于文件任意位置，按偏移量读取需要的部分
+            return _parse_tiff(_file_reader(f, 0))
+        if head == b"\x89PNG\r\n\x1a\n":
+            return _scan_png(f)
+        return None
+    except (OSError, struct.error):
+        return None
+    finally:
+        f.seek(0)
+
+
+def format_exif_date(value):
+    """将 YYYY:MM:DD HH:MM:SS 转换为 YYYY-MM-DD，格式不正确时返回None"""
+    try:
+        return datetime.strptime(value, "%Y:%m:%d %H:%M:%S").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+class ExifDateScanner:
+    """批量获取拍摄日期，按 (路径, 修改时间) 缓存，可选择保存到文件供下次运行使用"""
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    self.cache = {path: tuple(entry) for path, entry in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                print(f"读取日期缓存失败: {e}")
+
+    def lookup(self, path, stat=None):
+        """只查缓存，返回拍摄日期；没有缓存或文件已修改时返回None，不读取文件"""
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            self.hits += 1
+            return cached[1]
+        return None
+
+    def get_date(self, path, f=None, stat=None):
+        """返回 YYYY-MM-DD 格式的拍摄日期，没有EXIF则用文件修改时间
+
+        f 为已经打开的文件对象时直接复用，不会再次打开文件。
+        """
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        date_text = self.lookup(path, stat)
+        if date_text is not None:
+            return date_text
+
+        self.misses += 1
+        if f is None:
+            with open(path, "rb") as f:
+                value = scan_exif_datetime(f)
+        else:
+            value = scan_exif_datetime(f)
+
+        date_text = format_exif_date(value)
+        if date_text is None:
+            # 没有EXIF则用文件修改时间
+            date_text = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d")
+
+        self.cache[path] = (stat.st_mtime_ns, date_text)
+        self._dirty = True
+        return date_text
+
+    def entry(self, path):
+        """返回缓存条目 (修改时间, 日期)，用于交给其他进程中的扫描器合并"""
+        return self.cache.get(os.path.abspath(path))
+
+    def merge(self, entries):
+        """合并其他进程读取的缓存条目 {路径: (修改时间, 日期)}"""
+        if entries:
+            self.cache.update(entries)
+            self.misses += len(entries)
+            self._dirty = True
+
+    def save(self):
+        """将缓存写入文件"""
+        if not self.cache_path or not self._dirty:
+            return
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        os.replace(temp_path, self.cache_path)
+        self._dirty = False
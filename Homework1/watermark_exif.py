@@ -1,52 +1,129 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
+import math
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
-import piexif
-from datetime import datetime
+from exif_scanner import ExifDateScanner
+
+# 支持的图片扩展名
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# 默认设置，与之前交互输入时的默认值相同
+DEFAULTS = {
+    "font_size": 80,
+    "color": "#000000",
+    "position": "right-bottom",
+    "font": "arial.ttf",
+    "recursive": False,
+    "output": None,
+    "workers": os.cpu_count() or 1,
+    "skip_existing": False,
+    "cache": None,
+    "verbose": False,
+}
+
+# 按 (路径, 修改时间) 缓存拍摄日期
+_date_scanner = ExifDateScanner()
+
+# 每个工作任务最多包含的图片数，同一文字图层的图片分成多块以便均衡负载
+GROUP_CHUNK_SIZE = 16
+
+# 工作进程中的文字图层缓存，字体只加载一次
+_worker_layers = None
 
-def get_exif_date(image_path):
-    """尽量从EXIF获取拍摄时间，没有则用文件修改时间"""
-    try:
-        exif_dict = piexif.load(image_path)
-
-        # 1. 优先 DateTimeOriginal
-        if piexif.ExifIFD.DateTimeOriginal in exif_dict['Exif']:
-            date_str = exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal].decode()
-        # 2. 其次 DateTimeDigitized
-        elif piexif.ExifIFD.DateTimeDigitized in exif_dict['Exif']:
-            date_str = exif_dict['Exif'][piexif.ExifIFD.DateTimeDigitized].decode()
-        # 3. 再其次 ImageIFD.DateTime
-        elif 0x0132 in exif_dict['0th']:  # 0x0132 = DateTime
-            date_str = exif_dict['0th'][0x0132].decode()
-        else:
-            # 没有EXIF则用文件修改时间
-            ts = os.path.getmtime(image_path)
-            return datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
-
-        # 格式：YYYY:MM:DD HH:MM:SS
-        dt = datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-        return dt.strftime("%Y-%m-%d")
-    except Exception:
-        # 出现异常也用文件修改时间
-        ts = os.path.getmtime(image_path)
-        return datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
-
-
-def add_watermark(image_path, text, font_size, color, position):
-    """在图片上添加水印并返回新图像对象"""
-    image = Image.open(image_path).convert("RGBA")
-    draw = ImageDraw.Draw(image)
 
+def get_exif_date(image_path, f=None):
+    """尽量从EXIF获取拍摄时间，没有则用文件修改时间
+
+    只读取文件头部的EXIF结构；f 为已打开的文件对象时与解码共用同一个文件句柄。
+    """
+    return _date_scanner.get_date(image_path, f)
+
+
+def load_font(font_size, font_path="arial.ttf"):
+    """加载字体，找不到时使用默认字体"""
     try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except:
-        font = ImageFont.load_default()
+        return ImageFont.truetype(font_path, font_size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+class TextLayerCache:
+    """缓存渲染好的文字图层，同一天拍摄的照片共用图层
+
+    图层按 (文本, 字号, 颜色, 亚像素偏移) 缓存。居中时坐标可能是半像素，
+    偏移由图片尺寸的奇偶决定，同一日期的图片最多对应4个图层。
+    """
 
-    # Pillow 10 推荐用 textbbox 计算大小
-    bbox = draw.textbbox((0, 0), text, font=font)
+    def __init__(self, font_path="arial.ttf", max_layers=256):
+        self.font_path = font_path
+        self.max_layers = max_layers
+        self.fonts = {}
+        self.bboxes = {}
+        self.layers = OrderedDict()
+        self.rendered = 0
+
+    def font(self, font_size):
+        font = self.fonts.get(font_size)
+        if font is None:
+            font = self.fonts[font_size] = load_font(font_size, self.font_path)
+        return font
+
+    def text_bbox(self, text, font_size):
+        """文字相对于绘制起点的包围盒"""
+        key = (text, font_size)
+        bbox = self.bboxes.get(key)
+        if bbox is None:
+            # Pillow 10 推荐用 textbbox 计算大小
+            bbox = self.bboxes[key] = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox(
+                (0, 0), text, font=self.font(font_size))
+        return bbox
+
+    def get(self, text, font_size, color, offset=(0, 0)):
+        """返回从绘制起点开始、覆盖到文字右下角的透明图层"""
+        key = (text, font_size, color, offset)
+        layer = self.layers.get(key)
+        if layer is not None:
+            self.layers.move_to_end(key)
+            return layer
+
+        bbox = self.text_bbox(text, font_size)
+        layer = Image.new("RGBA", (max(1, bbox[2] + 1), max(1, bbox[3] + 1)), (0, 0, 0, 0))
+        ImageDraw.Draw(layer).text(offset, text, font=self.font(font_size), fill=color)
+        self.layers[key] = layer
+        self.rendered += 1
+        if len(self.layers) > self.max_layers:
+            self.layers.popitem(last=False)
+        return layer
+
+
+def add_watermark(image_path, text, font_size, color, position, image=None, font=None, layers=None):
+    """在图片上添加水印并返回新图像对象
+
+    image 为已打开的图像时不再重新打开文件，font 为已加载的字体时不再重新加载，
+    layers 为 TextLayerCache 时复用其中已经渲染好的文字图层。
+    """
+    if image is None:
+        image = Image.open(image_path)
+    if layers is None:
+        layers = TextLayerCache()
+        if font is not None:
+            layers.fonts[font_size] = font
+
+    bbox = layers.text_bbox(text, font_size)
     text_w, text_h = bbox[2] - bbox[0], bbox[3] - bbox[1]
 
+    # 关键：JPEG 不支持 RGBA，转换回 RGB
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    else:
+        image.load()
+
     width, height = image.size
 
     if position == "left-top":
@@ -60,33 +137,175 @@ def add_watermark(image_path, text, font_size, color, position):
     else:
         x, y = 10, 10
 
-    draw.text((x, y), text, font=font, fill=color)
-    # 关键：JPEG 不支持 RGBA，转换回 RGB
-    return image.convert("RGB")
-
-def main():
-    if len(sys.argv) < 2:
-        print("用法：python watermark_exif.py <图片路径>")
-        sys.exit(1)
-
-    input_path = sys.argv[1]
-    dir_path = os.path.dirname(input_path)
-    base_dir = os.path.basename(dir_path)
-    out_dir = os.path.join(dir_path, base_dir + "_watermark")
-    os.makedirs(out_dir, exist_ok=True)
-
-    font_size = int(input("请输入字体大小(默认80): ") or 80)
-    color = input("请输入字体颜色(例如 #FF0000，默认黑色): ") or "#000000"
-    position = input("请输入位置(left-top/center/right-bottom，默认right-bottom): ") or "right-bottom"
-
-    for fname in os.listdir(dir_path):
-        if fname.lower().endswith((".jpg", ".jpeg", ".png")):
-            full_path = os.path.join(dir_path, fname)
-            date_text = get_exif_date(full_path)
-            new_image = add_watermark(full_path, date_text, font_size, color, position)
-            save_path = os.path.join(out_dir, fname)
-            new_image.save(save_path)
-            print(f"已保存：{save_path}")
+    # 整数部分决定图层位置，小数部分在渲染图层时处理
+    left, top = math.floor(x), math.floor(y)
+    layer = layers.get(text, font_size, color, (x - left, y - top))
+
+    # 只处理图层与图片重叠的区域
+    x, y = left, top
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + layer.width, width), min(y + layer.height, height)
+    if left < right and top < bottom:
+        region = image.crop((left, top, right, bottom)).convert("RGBA")
+        region.alpha_composite(layer, source=(left - x, top - y))
+        image.paste(region.convert("RGB"), (left, top))
+    return image
+
+
+def _init_worker(font_path):
+    global _worker_layers
+    _worker_layers = TextLayerCache(font_path)
+
+
+def _process_group(task):
+    """工作进程中处理使用同一文字图层的一组图片
+
+    日期为None的一组是缓存中没有的图片，在这里读取拍摄日期，与解码共用同一个文件句柄。
+    返回 ([(源路径, 输出路径, 像素数, 错误信息)], {路径: 新读取的日期缓存条目})。
+    """
+    (date_text, font_size, color, position), files = task
+    results = []
+    scanned = {}
+    for src, dst in files:
+        try:
+            with open(src, "rb") as f:
+                text = date_text
+                if text is None:
+                    text = _date_scanner.get_date(src, f)
+                    scanned[os.path.abspath(src)] = _date_scanner.entry(src)
+                with Image.open(f) as image:
+                    new_image = add_watermark(src, text, font_size, color, position, image,
+                                              layers=_worker_layers)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            new_image.save(dst)
+            results.append((src, dst, new_image.width * new_image.height, None))
+        except Exception as e:
+            results.append((src, dst, 0, str(e)))
+    return results, scanned
+
+
+def group_tasks(tasks, chunk_size=GROUP_CHUNK_SIZE):
+    """按 (日期文本, 字号, 颜色, 位置) 分组，每组切分为不超过 chunk_size 张的任务"""
+    groups = {}
+    for src, dst, key in tasks:
+        groups.setdefault(key, []).append((src, dst))
+    chunks = []
+    for key, files in groups.items():
+        for i in range(0, len(files), chunk_size):
+            chunks.append((key, files[i:i + chunk_size]))
+    return chunks, len(groups)
+
+
+def parse_args(argv=None):
+    """解析命令行参数，配置文件中的设置作为默认值，命令行参数优先"""
+    parser = argparse.ArgumentParser(description="根据EXIF拍摄日期为图片添加文字水印")
+    parser.add_argument("inputs", nargs="+", help="图片文件或目录；指定文件时处理该文件所在的目录")
+    parser.add_argument("-c", "--config", help="JSON 配置文件，键名与参数名相同（如 font_size、skip_existing）")
+    parser.add_argument("-s", "--font-size", type=int, help="字体大小（默认80）")
+    parser.add_argument("--color", help="字体颜色，例如 #FF0000（默认黑色）")
+    parser.add_argument("-p", "--position", choices=["left-top", "center", "right-bottom"], help="水印位置（默认right-bottom）")
+    parser.add_argument("--font", help="字体文件（默认arial.ttf）")
+    parser.add_argument("-r", "--recursive", action="store_true", default=None, help="递归处理子目录")
+    parser.add_argument("-o", "--output", help="输出根目录，按输入目录的相对路径保存；默认保存到各目录下的 目录名_watermark")
+    parser.add_argument("-j", "--workers", type=int, help="工作进程数（默认CPU核数）")
+    parser.add_argument("--skip-existing", action="store_true", default=None, help="跳过输出文件已存在的图片")
+    parser.add_argument("--cache", help="拍摄日期缓存文件，重复运行时跳过未修改的图片的EXIF读取")
+    parser.add_argument("-v", "--verbose", action="store_true", default=None, help="输出每张保存的图片")
+    args = parser.parse_args(argv)
+
+    settings = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            parser.error(f"配置文件中有未知的设置: {', '.join(sorted(unknown))}")
+        settings.update(config)
+    for key in DEFAULTS:
+        value = getattr(args, key)
+        if value is not None:
+            settings[key] = value
+    settings["inputs"] = args.inputs
+    return settings
+
+
+def _output_dir(dir_path, root, output):
+    if output is None:
+        # 保存在原目录名_watermark的新目录下
+        return os.path.join(dir_path, os.path.basename(dir_path) + "_watermark")
+    return os.path.normpath(os.path.join(output, os.path.relpath(dir_path, root)))
+
+
+def collect_images(inputs, recursive=False, output=None):
+    """收集需要处理的图片，返回 [(源路径, 输出路径, stat)]"""
+    jobs = []
+    seen = set()
+    for input_path in inputs:
+        root = input_path if os.path.isdir(input_path) else os.path.dirname(os.path.abspath(input_path))
+        root = os.path.abspath(root)
+        for dir_path, dir_names, _ in os.walk(root):
+            if not recursive:
+                dir_names[:] = []
+            # 不处理输出目录
+            dir_names[:] = sorted(name for name in dir_names if not name.endswith("_watermark")
+                                  and (output is None or os.path.join(dir_path, name) != os.path.abspath(output)))
+
+            out_dir = _output_dir(dir_path, root, output)
+            with os.scandir(dir_path) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    if entry.path in seen:
+                        continue
+                    seen.add(entry.path)
+                    jobs.append((entry.path, os.path.join(out_dir, entry.name), entry.stat()))
+    return jobs
+
+
+def main(argv=None):
+    settings = parse_args(argv)
+    start = time.perf_counter()
+
+    # 1. 收集图片，从缓存中查找拍摄日期；缓存中没有的图片由工作进程在解码前读取，每个文件只打开一次
+    scanner = ExifDateScanner(settings["cache"])
+    images = collect_images(settings["inputs"], settings["recursive"], settings["output"])
+    tasks = []
+    skipped = 0
+    for src, dst, stat in images:
+        if settings["skip_existing"] and os.path.exists(dst):
+            skipped += 1
+            continue
+        date_text = scanner.lookup(src, stat)
+        tasks.append((src, dst, (date_text, settings["font_size"], settings["color"], settings["position"])))
+    scan_time = time.perf_counter() - start
+
+    # 2. 按日期分组，多进程添加水印；每个进程只加载一次字体，每组的文字图层只渲染一次
+    chunks, group_count = group_tasks(tasks)
+    processed = 0
+    failed = 0
+    pixels = 0
+    workers = max(1, settings["workers"])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(settings["font"],)) as executor:
+        for results, scanned in executor.map(_process_group, chunks):
+            scanner.merge(scanned)
+            for src, dst, image_pixels, error in results:
+                if error is None:
+                    processed += 1
+                    pixels += image_pixels
+                    if settings["verbose"]:
+                        print(f"已保存：{dst}")
+                else:
+                    failed += 1
+                    print(f"处理 {src} 失败: {error}", file=sys.stderr)
+    scanner.save()
+
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    print(f"完成 {processed} 张，跳过 {skipped} 张，失败 {failed} 张，"
+          f"用时 {elapsed:.1f} 秒（收集图片 {scan_time:.1f} 秒，日期缓存命中 {scanner.hits} 张，读取 {scanner.misses} 张，{group_count} 组水印文字），"
+          f"{processed / elapsed:.1f} 张/秒，{pixels / 1e6 / elapsed:.1f} 百万像素/秒")
+    return 1 if failed else 0
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
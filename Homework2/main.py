@@ -9,6 +9,7 @@
 
 import sys
 import os
+import multiprocessing
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QIcon
 from watermark_app import WatermarkApp
@@ -16,6 +17,9 @@ from watermark_app import WatermarkApp
 
 def main():
     """主函数，启动水印应用程序"""
+    # 打包后的程序需要支持进程池导出
+    multiprocessing.freeze_support()
+    
     # 确保templates目录存在
     if not os.path.exists('templates'):
         os.makedirs('templates')
@@ -6,21 +6,36 @@ import os
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QLabel, QFileDialog, QListWidget, QListWidgetItem,
                              QComboBox, QSlider, QLineEdit, QGroupBox, QRadioButton, QCheckBox,
-                             QSpinBox, QColorDialog, QTabWidget, QScrollArea, QMessageBox,
-                             QGridLayout, QSizePolicy, QFrame, QSplitter, QButtonGroup)
+                             QSpinBox, QDoubleSpinBox, QColorDialog, QTabWidget, QScrollArea, QMessageBox,
+                             QGridLayout, QSizePolicy, QFrame, QSplitter, QButtonGroup,
+                             QProgressDialog)
 from PyQt5.QtGui import (QPixmap, QImage, QPainter, QColor, QFont, QFontDatabase,
                          QDrag, QIcon, QCursor, QPen, QBrush, QTransform)
 from PyQt5.QtCore import (Qt, QSize, QPoint, QRect, QMimeData, QByteArray, QBuffer,
                           QSettings, QTimer, QEvent, QFileInfo, QDir, pyqtSignal)
 import json
 import uuid
+import logging
+import threading
+from concurrent.futures import wait as wait_futures
 from PIL import Image, ImageDraw, ImageFont
 import io
 
 from watermark_image import WatermarkImage
 from watermark_preview import WatermarkPreview
+from watermark_contact import ContactSheet
+from watermark_scheduler import EXPORT, scheduler
+from watermark_render import CUSTOM_POSITION
 from watermark_settings import WatermarkSettings
 from watermark_templates import WatermarkTemplates
+from watermark_journal import ExportJournal
+from watermark_pipeline import ExportPipeline, default_memory_budget
+from watermark_tiles import TILED_PIXEL_THRESHOLD
+from watermark_encode import PRESET_NAMES, output_formats
+from watermark_tokens import TOKEN_NAMES, has_tokens, read_token_values, resolve_text, resolve_texts
+
+# 导出统计等调试信息，需要时用 logging.basicConfig(level=logging.DEBUG) 打开
+logger = logging.getLogger(__name__)
 
 class WatermarkApp(QMainWindow):
     def __init__(self):
@@ -33,12 +48,22 @@ class WatermarkApp(QMainWindow):
         self.current_image_index = -1  # 当前选中的图片索引
         self.settings = WatermarkSettings()  # 水印设置
         self.templates = WatermarkTemplates()  # 水印模板
+        self.token_values = {}  # 预览用的每张图片的水印文本变量值
+        self.contact_sheet = None  # 批量预览窗口，第一次打开时创建
+        # 单张图片的覆盖设置：路径 -> 与基础设置不同的字段，只保存有改动的图片
+        self.overrides = {}
+        # 只修改当前图片时的基础设置，此时编辑控件显示的是当前图片实际使用的设置
+        self.base_settings = None
+        self.applying_overrides = False  # 正在将设置显示到编辑控件，不记录改动
         
         # 创建UI
         self.init_ui()
         
         # 加载上次的设置
         self.load_last_settings()
+        
+        # 窗口显示后检查未完成的导出任务
+        QTimer.singleShot(0, self.check_pending_jobs)
     
     def init_ui(self):
         # 创建主窗口布局
@@ -66,6 +91,19 @@ class WatermarkApp(QMainWindow):
         left_layout.addWidget(QLabel("已导入图片:"))
         left_layout.addWidget(self.image_list)
         
+        # 所有图片加水印后的缩略图
+        self.btn_contact_sheet = QPushButton("批量预览")
+        left_layout.addWidget(self.btn_contact_sheet)
+        
+        # 单张图片的覆盖设置
+        override_layout = QHBoxLayout()
+        self.override_mode = QCheckBox("只修改当前图片")
+        self.override_mode.setToolTip("勾选后的改动只应用于当前图片，其他图片仍使用基础设置")
+        override_layout.addWidget(self.override_mode)
+        self.btn_clear_override = QPushButton("恢复基础设置")
+        override_layout.addWidget(self.btn_clear_override)
+        left_layout.addLayout(override_layout)
+        
         # 导出控件
         export_group = QGroupBox("导出设置")
         export_layout = QVBoxLayout(export_group)
@@ -74,13 +112,14 @@ class WatermarkApp(QMainWindow):
         format_layout = QHBoxLayout()
         format_layout.addWidget(QLabel("输出格式:"))
         self.output_format = QComboBox()
-        self.output_format.addItems(["JPEG", "PNG"])
+        # WebP、AVIF 取决于 Pillow 的编译选项
+        self.output_format.addItems([fmt.upper() for fmt in output_formats()])
         format_layout.addWidget(self.output_format)
         export_layout.addLayout(format_layout)
         
-        # JPEG质量设置
+        # 有损格式（JPEG、WebP、AVIF）的质量设置
         quality_layout = QHBoxLayout()
-        quality_layout.addWidget(QLabel("JPEG质量:"))
+        quality_layout.addWidget(QLabel("质量:"))
         self.jpeg_quality = QSlider(Qt.Horizontal)
         self.jpeg_quality.setRange(1, 100)
         self.jpeg_quality.setValue(90)
@@ -89,6 +128,38 @@ class WatermarkApp(QMainWindow):
         quality_layout.addWidget(self.jpeg_quality_label)
         export_layout.addLayout(quality_layout)
         
+        # 编码预设，对应各格式的编码速度和文件大小取舍
+        preset_layout = QHBoxLayout()
+        preset_layout.addWidget(QLabel("编码预设:"))
+        self.encoder_preset = QComboBox()
+        for preset, name in PRESET_NAMES.items():
+            self.encoder_preset.addItem(name, preset)
+        self.encoder_preset.setCurrentIndex(self.encoder_preset.findData("balanced"))
+        preset_layout.addWidget(self.encoder_preset)
+        export_layout.addLayout(preset_layout)
+        
+        # JPEG目标文件大小，启用时质量滑块作为质量上限
+        target_layout = QHBoxLayout()
+        self.target_size_enabled = QCheckBox("限制JPEG文件大小(KB):")
+        target_layout.addWidget(self.target_size_enabled)
+        self.target_size = QSpinBox()
+        self.target_size.setRange(10, 100000)
+        self.target_size.setValue(500)
+        target_layout.addWidget(self.target_size)
+        export_layout.addLayout(target_layout)
+        
+        # 元数据
+        metadata_layout = QHBoxLayout()
+        self.keep_metadata = QCheckBox("保留元数据(EXIF/ICC/XMP)")
+        self.keep_metadata.setChecked(True)
+        metadata_layout.addWidget(self.keep_metadata)
+        self.strip_gps = QCheckBox("移除GPS位置")
+        self.strip_gps.setChecked(True)
+        metadata_layout.addWidget(self.strip_gps)
+        self.strip_private = QCheckBox("移除作者和序列号")
+        metadata_layout.addWidget(self.strip_private)
+        export_layout.addLayout(metadata_layout)
+        
         # 文件命名规则
         naming_group = QGroupBox("文件命名规则")
         naming_layout = QVBoxLayout(naming_group)
@@ -115,6 +186,58 @@ class WatermarkApp(QMainWindow):
         
         export_layout.addWidget(naming_group)
         
+        # 导出流水线设置
+        pipeline_group = QGroupBox("导出流水线")
+        pipeline_layout = QGridLayout(pipeline_group)
+        cpu_count = os.cpu_count() or 2
+        
+        pipeline_layout.addWidget(QLabel("渲染线程:"), 0, 0)
+        self.render_workers = QSpinBox()
+        self.render_workers.setRange(1, 64)
+        self.render_workers.setValue(max(1, cpu_count // 2))
+        pipeline_layout.addWidget(self.render_workers, 0, 1)
+        
+        pipeline_layout.addWidget(QLabel("编码线程:"), 1, 0)
+        self.encode_workers = QSpinBox()
+        self.encode_workers.setRange(1, 64)
+        self.encode_workers.setValue(max(1, cpu_count - cpu_count // 2))
+        pipeline_layout.addWidget(self.encode_workers, 1, 1)
+        
+        pipeline_layout.addWidget(QLabel("队列深度:"), 2, 0)
+        self.queue_depth = QSpinBox()
+        self.queue_depth.setRange(1, 64)
+        self.queue_depth.setValue(4)
+        pipeline_layout.addWidget(self.queue_depth, 2, 1)
+        
+        pipeline_layout.addWidget(QLabel("内存预算(MB):"), 3, 0)
+        self.memory_budget = QSpinBox()
+        self.memory_budget.setRange(256, 1024 * 1024)
+        self.memory_budget.setSingleStep(256)
+        self.memory_budget.setValue(default_memory_budget() // (1024 * 1024))
+        pipeline_layout.addWidget(self.memory_budget, 3, 1)
+        
+        self.tiled_mode = QCheckBox("大图分块处理(百万像素):")
+        self.tiled_mode.setChecked(True)
+        pipeline_layout.addWidget(self.tiled_mode, 4, 0)
+        self.tiled_threshold = QSpinBox()
+        self.tiled_threshold.setRange(1, 100000)
+        self.tiled_threshold.setValue(TILED_PIXEL_THRESHOLD // 1000000)
+        pipeline_layout.addWidget(self.tiled_threshold, 4, 1)
+        
+        pipeline_layout.addWidget(QLabel("并行方式:"), 5, 0)
+        self.export_backend = QComboBox()
+        self.export_backend.addItem("线程流水线", "thread")
+        self.export_backend.addItem("进程池", "process")
+        pipeline_layout.addWidget(self.export_backend, 5, 1)
+        
+        pipeline_layout.addWidget(QLabel("进程数:"), 6, 0)
+        self.process_count = QSpinBox()
+        self.process_count.setRange(1, 64)
+        self.process_count.setValue(cpu_count)
+        pipeline_layout.addWidget(self.process_count, 6, 1)
+        
+        export_layout.addWidget(pipeline_group)
+        
         # 导出按钮
         self.btn_export = QPushButton("导出图片")
         export_layout.addWidget(self.btn_export)
@@ -145,6 +268,10 @@ class WatermarkApp(QMainWindow):
         text_content_layout = QHBoxLayout()
         text_content_layout.addWidget(QLabel("文本内容:"))
         self.text_content = QLineEdit()
+        self.text_content.setToolTip(
+            "可用变量: " + "，".join(f"{{{name}}} {label}" for name, label in TOKEN_NAMES.items())
+            + "\n序号可以指定格式，例如 {index:03d}"
+        )
         text_content_layout.addWidget(self.text_content)
         text_layout.addLayout(text_content_layout)
         
@@ -171,6 +298,20 @@ class WatermarkApp(QMainWindow):
         font_size_layout.addWidget(self.font_size)
         font_layout.addLayout(font_size_layout)
         
+        # 按图片短边比例设置字号
+        text_ratio_layout = QHBoxLayout()
+        self.text_relative_size = QCheckBox("字号占图片短边:")
+        self.text_relative_size.setToolTip("按每张图片的短边计算字号，不同分辨率的图片上水印比例一致")
+        self.text_size_ratio = QDoubleSpinBox()
+        self.text_size_ratio.setRange(0.5, 50.0)
+        self.text_size_ratio.setSingleStep(0.5)
+        self.text_size_ratio.setSuffix("%")
+        self.text_size_ratio.setValue(5.0)
+        self.text_size_ratio.setEnabled(False)
+        text_ratio_layout.addWidget(self.text_relative_size)
+        text_ratio_layout.addWidget(self.text_size_ratio)
+        font_layout.addLayout(text_ratio_layout)
+        
         # 字体样式
         font_style_layout = QHBoxLayout()
         self.font_bold = QCheckBox("粗体")
@@ -200,13 +341,50 @@ class WatermarkApp(QMainWindow):
         text_opacity_layout.addWidget(self.text_opacity_label)
         font_layout.addLayout(text_opacity_layout)
         
+        # 自动对比度
+        self.auto_contrast = QCheckBox("自动对比度")
+        self.auto_contrast.setToolTip("按每张图片水印处的背景亮度改用黑色或白色文本，背景杂乱时提高不透明度")
+        font_layout.addWidget(self.auto_contrast)
+        
         # 文本样式效果
         text_effect_group = QGroupBox("文本效果")
         text_effect_layout = QVBoxLayout(text_effect_group)
         
         # 阴影效果
+        shadow_layout = QHBoxLayout()
         self.text_shadow = QCheckBox("添加阴影")
-        text_effect_layout.addWidget(self.text_shadow)
+        shadow_layout.addWidget(self.text_shadow)
+        self.shadow_soft = QCheckBox("柔和")
+        self.shadow_soft.setToolTip("按模糊半径、偏移和颜色绘制模糊的投影")
+        shadow_layout.addWidget(self.shadow_soft)
+        self.shadow_color_btn = QPushButton()
+        self.shadow_color_btn.setFixedSize(30, 30)
+        self.shadow_color = QColor(0, 0, 0, 160)
+        self.update_shadow_color_button()
+        shadow_layout.addWidget(self.shadow_color_btn)
+        text_effect_layout.addLayout(shadow_layout)
+        
+        # 柔和阴影的模糊半径和偏移
+        soft_shadow_layout = QHBoxLayout()
+        soft_shadow_layout.addWidget(QLabel("模糊:"))
+        self.shadow_blur = QSpinBox()
+        self.shadow_blur.setRange(0, 50)
+        self.shadow_blur.setSuffix(" px")
+        self.shadow_blur.setValue(4)
+        soft_shadow_layout.addWidget(self.shadow_blur)
+        soft_shadow_layout.addWidget(QLabel("偏移:"))
+        self.shadow_offset_x = QSpinBox()
+        self.shadow_offset_x.setRange(-50, 50)
+        self.shadow_offset_x.setValue(3)
+        soft_shadow_layout.addWidget(self.shadow_offset_x)
+        self.shadow_offset_y = QSpinBox()
+        self.shadow_offset_y.setRange(-50, 50)
+        self.shadow_offset_y.setValue(3)
+        soft_shadow_layout.addWidget(self.shadow_offset_y)
+        text_effect_layout.addLayout(soft_shadow_layout)
+        self.shadow_soft.setEnabled(False)
+        for widget in (self.shadow_color_btn, self.shadow_blur, self.shadow_offset_x, self.shadow_offset_y):
+            widget.setEnabled(False)
         
         # 描边效果
         outline_layout = QHBoxLayout()
@@ -242,6 +420,20 @@ class WatermarkApp(QMainWindow):
         size_group = QGroupBox("大小调整")
         size_layout = QVBoxLayout(size_group)
         
+        # 按图片短边比例缩放
+        image_ratio_layout = QHBoxLayout()
+        self.image_relative_size = QCheckBox("长边占图片短边:")
+        self.image_relative_size.setToolTip("按每张图片的短边计算水印图片大小，保持水印图片的宽高比")
+        self.image_size_ratio = QDoubleSpinBox()
+        self.image_size_ratio.setRange(1.0, 100.0)
+        self.image_size_ratio.setSingleStep(1.0)
+        self.image_size_ratio.setSuffix("%")
+        self.image_size_ratio.setValue(20.0)
+        self.image_size_ratio.setEnabled(False)
+        image_ratio_layout.addWidget(self.image_relative_size)
+        image_ratio_layout.addWidget(self.image_size_ratio)
+        size_layout.addLayout(image_ratio_layout)
+        
         # 按比例缩放
         scale_layout = QHBoxLayout()
         scale_layout.addWidget(QLabel("缩放比例:"))
@@ -315,8 +507,18 @@ class WatermarkApp(QMainWindow):
         
         position_layout.addLayout(grid_layout)
         
+        # 拖拽后的自定义位置
+        self.custom_position_label = QLabel()
+        position_layout.addWidget(self.custom_position_label)
+        
+        # 自动位置
+        self.auto_position = QCheckBox("自动位置")
+        self.auto_position.setToolTip("按每张图片的内容选择背景最平坦的位置，尽量不与其他水印图层重叠")
+        position_layout.addWidget(self.auto_position)
+        
         # 手动拖拽提示
-        position_layout.addWidget(QLabel("提示: 您也可以直接在预览图上拖拽水印"))
+        position_layout.addWidget(QLabel("提示: 您也可以直接在预览图上拖拽水印，位置按图片尺寸的比例保存"))
+        position_layout.addWidget(QLabel("提示: 在预览图上滚动滚轮缩放，放大后拖拽空白处平移，按0适应窗口、按1显示原始大小"))
         
         # 旋转设置
         rotation_layout = QHBoxLayout()
@@ -329,8 +531,45 @@ class WatermarkApp(QMainWindow):
         rotation_layout.addWidget(self.rotation_value)
         position_layout.addLayout(rotation_layout)
         
+        # 平铺设置
+        tile_layout = QHBoxLayout()
+        self.tiled = QCheckBox("平铺")
+        self.tiled.setToolTip("水印按斜向错开的网格重复铺满整幅图片，配合旋转角度使用")
+        tile_layout.addWidget(self.tiled)
+        tile_layout.addWidget(QLabel("间距:"))
+        self.tile_spacing = QSpinBox()
+        self.tile_spacing.setRange(0, 500)
+        self.tile_spacing.setSuffix("%")
+        self.tile_spacing.setValue(50)
+        self.tile_spacing.setEnabled(False)
+        tile_layout.addWidget(self.tile_spacing)
+        position_layout.addLayout(tile_layout)
+        
         right_layout.addWidget(position_group)
         
+        # 水印图层
+        layer_group = QGroupBox("水印图层")
+        layer_layout = QVBoxLayout(layer_group)
+        layer_layout.addWidget(QLabel("以下图层从上到下依次叠加，当前编辑的水印在最上层"))
+        self.layer_list = QListWidget()
+        self.layer_list.setMaximumHeight(100)
+        layer_layout.addWidget(self.layer_list)
+        
+        layer_buttons_layout = QHBoxLayout()
+        self.btn_add_layer = QPushButton("添加为图层")
+        self.btn_add_layer.setToolTip("将当前编辑的水印复制为一个新图层，可以继续编辑下一个水印")
+        self.btn_edit_layer = QPushButton("编辑")
+        self.btn_edit_layer.setToolTip("将所选图层与当前编辑的水印交换")
+        self.btn_remove_layer = QPushButton("删除")
+        self.btn_layer_up = QPushButton("上移")
+        self.btn_layer_down = QPushButton("下移")
+        for btn in (self.btn_add_layer, self.btn_edit_layer, self.btn_remove_layer,
+                    self.btn_layer_up, self.btn_layer_down):
+            layer_buttons_layout.addWidget(btn)
+        layer_layout.addLayout(layer_buttons_layout)
+        
+        right_layout.addWidget(layer_group)
+        
         # 模板管理
         template_group = QGroupBox("水印模板")
         template_layout = QVBoxLayout(template_group)
@@ -370,6 +609,9 @@ class WatermarkApp(QMainWindow):
         # 图片导入
         self.btn_import_image.clicked.connect(self.import_images)
         self.btn_import_folder.clicked.connect(self.import_folder)
+        self.btn_contact_sheet.clicked.connect(self.open_contact_sheet)
+        self.override_mode.toggled.connect(self.update_override_mode)
+        self.btn_clear_override.clicked.connect(self.clear_current_override)
         self.image_list.itemClicked.connect(self.on_image_selected)
         
         # 导出
@@ -380,17 +622,26 @@ class WatermarkApp(QMainWindow):
         self.text_content.textChanged.connect(self.update_preview)
         self.font_family.currentIndexChanged.connect(self.update_preview)
         self.font_size.valueChanged.connect(self.update_preview)
+        self.text_relative_size.stateChanged.connect(self.update_size_mode)
+        self.text_size_ratio.valueChanged.connect(self.update_preview)
         self.font_bold.stateChanged.connect(self.update_preview)
         self.font_italic.stateChanged.connect(self.update_preview)
         self.text_color_btn.clicked.connect(self.select_text_color)
         self.text_opacity.valueChanged.connect(self.update_text_opacity)
-        self.text_shadow.stateChanged.connect(self.update_preview)
+        self.text_shadow.stateChanged.connect(self.update_shadow_mode)
+        self.shadow_soft.stateChanged.connect(self.update_shadow_mode)
+        self.shadow_color_btn.clicked.connect(self.select_shadow_color)
+        self.shadow_blur.valueChanged.connect(self.update_preview)
+        self.shadow_offset_x.valueChanged.connect(self.update_preview)
+        self.shadow_offset_y.valueChanged.connect(self.update_preview)
         self.text_outline.stateChanged.connect(self.update_preview)
         self.outline_width.valueChanged.connect(self.update_preview)
         
         # 图片水印
         self.btn_select_watermark.clicked.connect(self.select_watermark_image)
         self.image_scale.valueChanged.connect(self.update_image_scale)
+        self.image_relative_size.stateChanged.connect(self.update_size_mode)
+        self.image_size_ratio.valueChanged.connect(self.update_preview)
         self.keep_aspect_ratio.stateChanged.connect(self.update_aspect_ratio)
         self.image_width.valueChanged.connect(self.update_image_width)
         self.image_height.valueChanged.connect(self.update_image_height)
@@ -399,7 +650,20 @@ class WatermarkApp(QMainWindow):
         # 位置和旋转
         for btn in self.position_buttons.values():
             btn.clicked.connect(self.update_position)
+        self.preview.position_changed.connect(self.on_preview_position_changed)
         self.rotation_slider.valueChanged.connect(self.update_rotation)
+        self.tiled.stateChanged.connect(self.update_tiled)
+        self.auto_position.stateChanged.connect(self.update_tiled)
+        self.auto_contrast.stateChanged.connect(self.update_preview)
+        self.tile_spacing.valueChanged.connect(self.update_preview)
+        
+        # 水印图层
+        self.btn_add_layer.clicked.connect(self.add_layer)
+        self.btn_edit_layer.clicked.connect(self.edit_selected_layer)
+        self.layer_list.itemDoubleClicked.connect(self.edit_selected_layer)
+        self.btn_remove_layer.clicked.connect(self.remove_selected_layer)
+        self.btn_layer_up.clicked.connect(lambda: self.move_selected_layer(-1))
+        self.btn_layer_down.clicked.connect(lambda: self.move_selected_layer(1))
         
         # 模板
         self.btn_save_template.clicked.connect(self.save_template)
@@ -431,12 +695,14 @@ class WatermarkApp(QMainWindow):
                 continue
                 
             try:
-                # 创建缩略图
-                pixmap = QPixmap(path)
-                if pixmap.isNull():
+                # 加载图片，超大图片只生成缩小图
+                image = WatermarkImage(path)
+                if image.pixmap.isNull():
                     continue
-                    
-                thumbnail = pixmap.scaled(80, 80, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                
+                # 创建缩略图
+                thumbnail = QPixmap.fromImage(image.pil_to_qimage(image.thumbnail)).scaled(
+                    80, 80, Qt.KeepAspectRatio, Qt.SmoothTransformation)
                 
                 # 创建列表项
                 item = QListWidgetItem()
@@ -447,10 +713,13 @@ class WatermarkApp(QMainWindow):
                 self.image_list.addItem(item)
                 
                 # 添加到图片列表
-                self.images.append(WatermarkImage(path))
+                self.images.append(image)
             except Exception as e:
                 print(f"无法加载图片 {path}: {e}")
         
+        if self.contact_sheet is not None:
+            self.contact_sheet.reload_images()
+        
         # 如果这是第一批图片，选择第一张
         if self.current_image_index == -1 and self.image_list.count() > 0:
             self.image_list.setCurrentRow(0)
@@ -462,6 +731,9 @@ class WatermarkApp(QMainWindow):
             if img.path == path:
                 self.current_image_index = i
                 self.preview.set_image(self.images[i])
+                if self.base_settings is not None:
+                    # 只修改当前图片时，编辑控件显示新选中图片实际使用的设置
+                    self.show_settings(self.base_settings.with_overrides(self.overrides.get(path)))
                 self.update_preview()
                 break
     
@@ -470,8 +742,126 @@ class WatermarkApp(QMainWindow):
             # 更新设置
             self.update_settings()
             
+            # 预览显示当前图片实际使用的设置和解析后的水印文本
+            self.preview.settings = self.current_settings()
+            self.preview.text = self.current_watermark_text()
+            
             # 更新预览
             self.preview.update()
+            
+            if self.contact_sheet is not None:
+                self.contact_sheet.settings_changed()
+    
+    def base(self):
+        """所有图片共用的基础设置"""
+        return self.base_settings if self.base_settings is not None else self.settings
+    
+    def current_settings(self):
+        """当前图片实际使用的设置"""
+        if self.base_settings is not None:
+            return self.settings
+        return self.settings.with_overrides(self.overrides.get(self.images[self.current_image_index].path))
+    
+    def show_settings(self, settings):
+        """在编辑控件中显示设置，显示过程中触发的更新不记录为当前图片的改动"""
+        self.applying_overrides = True
+        try:
+            self.apply_template_settings(settings)
+            # 编辑控件只在有水印图片时设置路径
+            self.settings.watermark_image_path = settings.watermark_image_path
+            if not settings.watermark_image_path:
+                self.watermark_image_preview.setText("未选择水印图片")
+            self.update_settings()
+        finally:
+            self.applying_overrides = False
+    
+    def record_override(self):
+        """只修改当前图片时，将编辑控件中与基础设置不同的字段记录为当前图片的覆盖设置"""
+        if self.base_settings is None or self.applying_overrides or self.current_image_index < 0:
+            return
+        path = self.images[self.current_image_index].path
+        overrides = self.settings.diff(self.base_settings)
+        if overrides:
+            self.overrides[path] = overrides
+        else:
+            self.overrides.pop(path, None)
+        self.mark_override(path)
+    
+    def mark_override(self, path):
+        """有覆盖设置的图片在列表中的名称后加 *"""
+        for row in range(self.image_list.count()):
+            item = self.image_list.item(row)
+            if item.data(Qt.UserRole) == path:
+                name = os.path.basename(path)
+                item.setText(f"{name} *" if path in self.overrides else name)
+                item.setToolTip("此图片有单独的设置" if path in self.overrides else "")
+                break
+    
+    def update_override_mode(self, checked):
+        """切换是否只修改当前图片"""
+        self.update_settings()
+        if checked:
+            self.base_settings = WatermarkSettings.from_dict(self.settings.to_dict())
+            if self.current_image_index >= 0:
+                path = self.images[self.current_image_index].path
+                self.show_settings(self.base_settings.with_overrides(self.overrides.get(path)))
+        elif self.base_settings is not None:
+            base, self.base_settings = self.base_settings, None
+            self.show_settings(base)
+        self.update_preview()
+    
+    def clear_current_override(self):
+        """删除当前图片的覆盖设置，恢复使用基础设置"""
+        if self.current_image_index < 0:
+            return
+        path = self.images[self.current_image_index].path
+        self.overrides.pop(path, None)
+        self.mark_override(path)
+        if self.base_settings is not None:
+            self.show_settings(self.base_settings)
+        self.update_preview()
+    
+    def open_contact_sheet(self):
+        """打开批量预览，按当前设置显示所有图片加水印后的缩略图"""
+        if not self.images:
+            QMessageBox.warning(self, "警告", "请先导入图片")
+            return
+        self.update_settings()
+        if self.contact_sheet is None:
+            self.contact_sheet = ContactSheet(self.images, self.base, self.overrides, self.watermark_text, self)
+        else:
+            self.contact_sheet.refresh()
+        self.contact_sheet.show()
+        self.contact_sheet.raise_()
+    
+    def current_watermark_text(self):
+        return self.watermark_text(self.current_image_index)
+    
+    def text_template(self, index):
+        """第 index 张图片的水印文本模板，按合并了这张图片覆盖设置的图层栈取得
+
+        有多个图层时为与图层栈对应的列表，否则为字符串。
+        """
+        settings = self.base().with_overrides(self.overrides.get(self.images[index].path))
+        templates = [layer.text_content for layer in settings.layer_stack()]
+        return templates if len(templates) > 1 else templates[0]
+    
+    def watermark_text(self, index):
+        """第 index 张图片的水印文本，有多个图层时为与图层栈对应的列表；没有变量时返回None
+
+        变量值按图片缓存，编辑文本时不重复读取文件。
+        """
+        template = self.text_template(index)
+        templates = template if isinstance(template, list) else [template]
+        if not any(has_tokens(t) for t in templates):
+            return None
+        path = self.images[index].path
+        values = self.token_values.get(path)
+        if values is None:
+            values = self.token_values[path] = read_token_values(path)
+        values = dict(values, index=index + 1)
+        texts = [resolve_text(t, values) for t in templates]
+        return texts if isinstance(template, list) else texts[0]
     
     def update_settings(self):
         # 文本水印设置
@@ -490,6 +880,13 @@ class WatermarkApp(QMainWindow):
         self.settings.text_shadow = self.text_shadow.isChecked()
         self.settings.text_outline = self.text_outline.isChecked()
         self.settings.outline_width = self.outline_width.value()
+        self.settings.shadow_soft = self.shadow_soft.isChecked()
+        self.settings.shadow_blur = self.shadow_blur.value()
+        self.settings.shadow_offset_x = self.shadow_offset_x.value()
+        self.settings.shadow_offset_y = self.shadow_offset_y.value()
+        self.settings.shadow_color = self.shadow_color
+        self.settings.text_relative_size = self.text_relative_size.isChecked()
+        self.settings.text_size_ratio = self.text_size_ratio.value()
         
         # 图片水印设置
         self.settings.watermark_image_scale = self.image_scale.value() / 100.0
@@ -497,6 +894,8 @@ class WatermarkApp(QMainWindow):
         self.settings.watermark_image_width = self.image_width.value()
         self.settings.watermark_image_height = self.image_height.value()
         self.settings.watermark_image_opacity = self.image_opacity.value()
+        self.settings.image_relative_size = self.image_relative_size.isChecked()
+        self.settings.image_size_ratio = self.image_size_ratio.value()
         
         # 位置和旋转
         for name, btn in self.position_buttons.items():
@@ -505,6 +904,12 @@ class WatermarkApp(QMainWindow):
                 break
         
         self.settings.rotation = self.rotation_slider.value()
+        self.settings.tiled = self.tiled.isChecked()
+        self.settings.tile_spacing = self.tile_spacing.value()
+        self.settings.auto_position = self.auto_position.isChecked()
+        self.settings.auto_contrast = self.auto_contrast.isChecked()
+        
+        self.record_override()
     
     def update_color_button(self):
         # 设置颜色按钮的背景色
@@ -518,6 +923,27 @@ class WatermarkApp(QMainWindow):
             self.update_color_button()
             self.update_preview()
     
+    def update_shadow_color_button(self):
+        color = self.shadow_color
+        self.shadow_color_btn.setStyleSheet(
+            f"background-color: rgba({color.red()}, {color.green()}, {color.blue()}, {color.alpha()});")
+    
+    def select_shadow_color(self):
+        color = QColorDialog.getColor(self.shadow_color, self, "选择阴影颜色", QColorDialog.ShowAlphaChannel)
+        if color.isValid():
+            self.shadow_color = color
+            self.update_shadow_color_button()
+            self.update_preview()
+    
+    def update_shadow_mode(self):
+        """柔和阴影的参数只在选择柔和阴影时可用"""
+        shadow = self.text_shadow.isChecked()
+        soft = shadow and self.shadow_soft.isChecked()
+        self.shadow_soft.setEnabled(shadow)
+        for widget in (self.shadow_color_btn, self.shadow_blur, self.shadow_offset_x, self.shadow_offset_y):
+            widget.setEnabled(soft)
+        self.update_preview()
+    
     def update_text_opacity(self):
         value = self.text_opacity.value()
         self.text_opacity_label.setText(f"{value}%")
@@ -545,6 +971,18 @@ class WatermarkApp(QMainWindow):
             except Exception as e:
                 QMessageBox.warning(self, "错误", f"无法加载水印图片: {e}")
     
+    def update_size_mode(self):
+        """按比例设置大小时，固定字号和缩放控件不起作用"""
+        text_relative = self.text_relative_size.isChecked()
+        self.font_size.setEnabled(not text_relative)
+        self.text_size_ratio.setEnabled(text_relative)
+        
+        image_relative = self.image_relative_size.isChecked()
+        for widget in (self.image_scale, self.keep_aspect_ratio, self.image_width, self.image_height):
+            widget.setEnabled(not image_relative)
+        self.image_size_ratio.setEnabled(image_relative)
+        self.update_preview()
+    
     def update_image_scale(self):
         value = self.image_scale.value()
         self.image_scale_label.setText(f"{value}%")
@@ -611,6 +1049,94 @@ class WatermarkApp(QMainWindow):
         self.update_preview()
     
     def update_position(self):
+        self.update_settings()
+        self.update_custom_position_label()
+        self.update_preview()
+    
+    def on_preview_position_changed(self, centers):
+        """在预览中拖拽水印后改为自定义位置，保存文本和图片水印中心的归一化坐标"""
+        self.settings.position = CUSTOM_POSITION
+        for name, value in centers.items():
+            setattr(self.settings, name, value)
+        self.check_position_button(CUSTOM_POSITION)
+        # 拖拽的位置取代自动选择的位置
+        self.auto_position.setChecked(False)
+        self.update_custom_position_label()
+        self.update_preview()
+    
+    def check_position_button(self, position):
+        """选中九宫格中的位置，自定义位置时不选中任何按钮"""
+        self.position_group.setExclusive(False)
+        for name, btn in self.position_buttons.items():
+            btn.setChecked(name == position)
+        self.position_group.setExclusive(True)
+    
+    def update_custom_position_label(self):
+        if self.settings.position == CUSTOM_POSITION:
+            text = f"自定义位置: 水平 {self.settings.position_x:.1%}，垂直 {self.settings.position_y:.1%}"
+            if self.settings.watermark_image_path:
+                text += (f"（图片水印: 水平 {self.settings.image_position_x:.1%}，"
+                         f"垂直 {self.settings.image_position_y:.1%}）")
+            self.custom_position_label.setText(text)
+        else:
+            self.custom_position_label.setText("")
+    
+    def refresh_layer_list(self, current_row=-1):
+        self.layer_list.clear()
+        for layer in self.settings.extra_layers:
+            self.layer_list.addItem(layer.describe())
+        self.layer_list.setCurrentRow(current_row)
+    
+    def copy_current_layer(self):
+        """当前编辑的水印的副本，不包含其他图层"""
+        self.update_settings()
+        layer = WatermarkSettings.from_dict(self.settings.to_dict())
+        layer.extra_layers = []
+        return layer
+    
+    def add_layer(self):
+        self.settings.extra_layers.append(self.copy_current_layer())
+        self.refresh_layer_list(len(self.settings.extra_layers) - 1)
+        self.update_preview()
+    
+    def edit_selected_layer(self):
+        row = self.layer_list.currentRow()
+        if row < 0:
+            return
+        layer = self.settings.extra_layers[row]
+        self.settings.extra_layers[row] = self.copy_current_layer()
+        self.refresh_layer_list(row)
+        
+        # 图层没有图片水印时清除编辑控件中的图片
+        self.settings.watermark_image_path = ""
+        self.watermark_image_preview.setText("未选择水印图片")
+        self.apply_layer_settings(layer)
+    
+    def remove_selected_layer(self):
+        row = self.layer_list.currentRow()
+        if row < 0:
+            return
+        del self.settings.extra_layers[row]
+        self.refresh_layer_list(min(row, len(self.settings.extra_layers) - 1))
+        self.update_preview()
+    
+    def move_selected_layer(self, step):
+        row = self.layer_list.currentRow()
+        target = row + step
+        layers = self.settings.extra_layers
+        if row < 0 or not 0 <= target < len(layers):
+            return
+        layers[row], layers[target] = layers[target], layers[row]
+        self.refresh_layer_list(target)
+        self.update_preview()
+    
+    def update_tiled(self):
+        """平铺或自动位置时九宫格位置不起作用"""
+        tiled = self.tiled.isChecked()
+        for btn in self.position_buttons.values():
+            btn.setEnabled(not tiled and not self.auto_position.isChecked())
+        self.auto_position.setEnabled(not tiled)
+        self.tile_spacing.setEnabled(tiled)
         self.update_preview()
     
     def update_rotation(self):
@@ -646,8 +1172,24 @@ class WatermarkApp(QMainWindow):
         # 获取输出格式
         output_format = self.output_format.currentText().lower()
         
-        # 获取JPEG质量
-        jpeg_quality = self.jpeg_quality.value() if output_format == "jpeg" else 95
+        # 获取有损格式的质量
+        quality = self.jpeg_quality.value() if output_format != "png" else 95
+        
+        # 获取编码预设
+        preset = self.encoder_preset.currentData()
+        
+        # 获取JPEG目标文件大小
+        target_size = None
+        if output_format == "jpeg" and self.target_size_enabled.isChecked():
+            target_size = self.target_size.value() * 1024
+        
+        # 获取元数据设置
+        strip = []
+        if self.strip_gps.isChecked():
+            strip.append("gps")
+        if self.strip_private.isChecked():
+            strip.append("private")
+        metadata = {"keep": self.keep_metadata.isChecked(), "strip": strip}
         
         # 获取命名规则
         if self.naming_original.isChecked():
@@ -666,39 +1208,145 @@ class WatermarkApp(QMainWindow):
         # 更新设置
         self.update_settings()
         
-        # 导出每张图片
-        success_count = 0
-        for img in self.images:
-            try:
-                # 获取输出文件名
-                base_name = os.path.basename(img.path)
-                name, ext = os.path.splitext(base_name)
-                
-                if naming_rule == "original":
-                    output_name = f"{name}.{output_format}"
-                elif naming_rule == "prefix":
-                    output_name = f"{prefix}{name}.{output_format}"
-                else:  # suffix
-                    output_name = f"{name}{suffix}.{output_format}"
-                
-                output_path = os.path.join(output_dir, output_name)
-                
-                # 应用水印并保存
-                result_image = img.apply_watermark(self.settings)
-                
-                if output_format == "jpeg":
-                    # 转换为RGB模式，因为JPEG不支持透明通道
-                    if result_image.mode == "RGBA":
-                        result_image = result_image.convert("RGB")
-                    result_image.save(output_path, quality=jpeg_quality)
-                else:
-                    result_image.save(output_path)
-                
-                success_count += 1
-            except Exception as e:
-                print(f"导出图片 {img.path} 失败: {e}")
+        # 渲染前一次读取所有图片的元数据，解析每张图片的水印文本；覆盖了设置的图片使用自己的模板
+        texts = None
+        templates = [self.text_template(i) for i in range(len(self.images))]
+        if any(has_tokens(t) for template in templates
+               for t in (template if isinstance(template, list) else [template])):
+            texts = self.resolve_export_texts(templates.__getitem__, [img.path for img in self.images])
+            if texts is None:
+                return
+        
+        # 生成每张图片的输出文件名
+        items = []
+        for i, img in enumerate(self.images):
+            base_name = os.path.basename(img.path)
+            name, ext = os.path.splitext(base_name)
+            
+            if naming_rule == "original":
+                output_name = f"{name}.{output_format}"
+            elif naming_rule == "prefix":
+                output_name = f"{prefix}{name}.{output_format}"
+            else:  # suffix
+                output_name = f"{name}{suffix}.{output_format}"
+            
+            item = {"path": img.path, "output": output_name}
+            if texts is not None:
+                item["text"] = texts[i]
+            if img.path in self.overrides:
+                # 只记录有覆盖设置的图片，导出时与基础设置合并
+                item["overrides"] = self.overrides[img.path]
+            items.append(item)
+        
+        # 创建导出任务日志，程序中断后可以恢复
+        journal = ExportJournal.create({
+            "output_dir": output_dir,
+            "output_format": output_format,
+            "quality": quality,
+            "preset": preset,
+            "target_size": target_size,
+            "metadata": metadata,
+            "settings": self.base().to_dict(),
+            "items": items
+        })
+        self.run_export_job(journal)
+    
+    def resolve_export_texts(self, template, paths):
+        """在后台读取所有图片的元数据并解析水印文本，期间显示进度，界面保持响应；用户取消时返回None
+
+        template 与 resolve_texts 的参数相同。
+        """
+        progress = QProgressDialog("正在读取图片信息...", "取消", 0, len(paths), self)
+        progress.setWindowTitle("导出")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+        
+        read = []
+        cancelled = threading.Event()
+        future = scheduler.submit(EXPORT, resolve_texts, template, paths, lambda: read.append(None), cancelled)
+        while not wait_futures([future], 0.05).done:
+            if progress.wasCanceled():
+                cancelled.set()
+            progress.setValue(len(read))
+            QApplication.processEvents()
+        progress.close()
+        return future.result()
+    
+    def run_export_job(self, journal):
+        """执行导出任务，跳过日志中已完成的图片"""
+        settings = WatermarkSettings.from_dict(journal.spec["settings"])
+        pipeline = ExportPipeline(
+            journal, settings,
+            renderers=self.render_workers.value(),
+            encoders=self.encode_workers.value(),
+            read_depth=self.queue_depth.value(),
+            encode_depth=self.queue_depth.value(),
+            write_depth=self.queue_depth.value() * 2,
+            images={img.path: img for img in self.images},
+            memory_budget=self.memory_budget.value() * 1024 * 1024,
+            tiled_threshold=self.tiled_threshold.value() * 1000000 if self.tiled_mode.isChecked() else None,
+            backend=self.export_backend.currentData(),
+            processes=self.process_count.value()
+        )
         
-        QMessageBox.information(self, "导出完成", f"成功导出 {success_count} 张图片到 {output_dir}")
+        total = len(journal.items)
+        already_done = total - journal.remaining_count()
+        progress = QProgressDialog("正在导出图片...", "暂停", 0, total, self)
+        progress.setWindowTitle("导出")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+        
+        journal.start()
+        pipeline.start()
+        while not pipeline.wait(0.05):
+            if progress.wasCanceled() and not pipeline.cancelled:
+                pipeline.cancel()
+            progress.setValue(already_done + pipeline.completed)
+            QApplication.processEvents()
+        progress.setValue(total)
+        
+        logger.debug("导出统计:\n%s", pipeline.format_stats())
+        logger.debug("调度器统计:\n%s", scheduler.format_stats())
+        
+        if pipeline.cancelled:
+            journal.close()
+            QMessageBox.information(
+                self, "导出已暂停",
+                f"已导出 {pipeline.completed} 张图片，剩余 {journal.remaining_count()} 张将在下次启动时提示恢复"
+            )
+        elif journal.remaining_count():
+            # 失败的图片没有记录为已完成，保留日志，下次启动时可以重试
+            journal.close()
+            QMessageBox.warning(
+                self, "导出完成",
+                f"成功导出 {pipeline.completed} 张图片到 {journal.output_dir}，{journal.remaining_count()} 张失败，"
+                f"下次启动时可以重试失败的图片"
+            )
+        else:
+            journal.finish()
+            QMessageBox.information(self, "导出完成", f"成功导出 {pipeline.completed} 张图片到 {journal.output_dir}")
+    
+    def check_pending_jobs(self):
+        """启动时检查未完成的导出任务，让用户选择恢复或丢弃"""
+        for journal in ExportJournal.pending_jobs():
+            total = len(journal.items)
+            box = QMessageBox(self)
+            box.setWindowTitle("未完成的导出任务")
+            box.setText(
+                f"发现未完成的导出任务：已完成 {total - journal.remaining_count()}/{total} 张，"
+                f"输出目录 {journal.output_dir}。"
+            )
+            btn_resume = box.addButton("恢复", QMessageBox.AcceptRole)
+            btn_discard = box.addButton("丢弃", QMessageBox.DestructiveRole)
+            box.addButton("稍后", QMessageBox.RejectRole)
+            box.exec_()
+            
+            if box.clickedButton() == btn_resume:
+                self.run_export_job(journal)
+            elif box.clickedButton() == btn_discard:
+                journal.discard()
+            else:
+                journal.close()
     
     def save_template(self):
         name = self.template_name.text().strip()
@@ -710,7 +1358,7 @@ class WatermarkApp(QMainWindow):
         self.update_settings()
         
         # 保存模板
-        self.templates.save_template(name, self.settings)
+        self.templates.save_template(name, self.base())
         QMessageBox.information(self, "成功", f"模板 '{name}' 已保存")
     
     def load_template(self):
@@ -732,6 +1380,15 @@ class WatermarkApp(QMainWindow):
                 QMessageBox.information(self, "成功", f"已加载模板 '{name}'")
     
     def apply_template_settings(self, settings):
+        # 应用其他水印图层
+        self.settings.extra_layers = list(settings.extra_layers)
+        self.refresh_layer_list()
+        
+        # 当前编辑的水印
+        self.apply_layer_settings(settings)
+    
+    def apply_layer_settings(self, settings):
+        """将一个水印图层的设置显示在编辑控件中"""
         # 应用文本水印设置
         self.text_content.setText(settings.text_content)
         
@@ -750,6 +1407,14 @@ class WatermarkApp(QMainWindow):
         self.text_shadow.setChecked(settings.text_shadow)
         self.text_outline.setChecked(settings.text_outline)
         self.outline_width.setValue(settings.outline_width)
+        self.shadow_soft.setChecked(settings.shadow_soft)
+        self.shadow_blur.setValue(settings.shadow_blur)
+        self.shadow_offset_x.setValue(settings.shadow_offset_x)
+        self.shadow_offset_y.setValue(settings.shadow_offset_y)
+        self.shadow_color = settings.shadow_color
+        self.update_shadow_color_button()
+        self.text_relative_size.setChecked(settings.text_relative_size)
+        self.text_size_ratio.setValue(settings.text_size_ratio)
         
         # 应用图片水印设置
         if settings.watermark_image_path:
@@ -763,12 +1428,23 @@ class WatermarkApp(QMainWindow):
         self.image_width.setValue(settings.watermark_image_width)
         self.image_height.setValue(settings.watermark_image_height)
         self.image_opacity.setValue(settings.watermark_image_opacity)
-        
-        # 应用位置和旋转设置
-        for name, btn in self.position_buttons.items():
-            btn.setChecked(name == settings.position)
+        self.image_relative_size.setChecked(settings.image_relative_size)
+        self.image_size_ratio.setValue(settings.image_size_ratio)
+        
+        # 应用位置和旋转设置，自定义位置不对应编辑控件，直接保存到设置中
+        self.check_position_button(settings.position)
+        self.settings.position = settings.position
+        self.settings.position_x = settings.position_x
+        self.settings.position_y = settings.position_y
+        self.settings.image_position_x = settings.image_position_x
+        self.settings.image_position_y = settings.image_position_y
+        self.update_custom_position_label()
         
         self.rotation_slider.setValue(settings.rotation)
+        self.tiled.setChecked(settings.tiled)
+        self.tile_spacing.setValue(settings.tile_spacing)
+        self.auto_position.setChecked(settings.auto_position)
+        self.auto_contrast.setChecked(settings.auto_contrast)
         
         # 更新预览
         self.update_preview()
@@ -782,7 +1458,10 @@ class WatermarkApp(QMainWindow):
     def closeEvent(self, event):
         # 保存当前设置
         self.update_settings()
-        self.templates.save_last_settings(self.settings)
+        self.templates.save_last_settings(self.base())
+        if self.contact_sheet is not None:
+            self.contact_sheet.shutdown()
+        scheduler.shutdown()
         super().closeEvent(event)
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+
+from PIL import Image, ImageChops
+from PyQt5.QtGui import QColor
+
+from watermark_render import render_anchored_layers, layer_box
+
+# 统计用缩略图的长边，只用于比较各区域的亮度和复杂程度
+ANALYSIS_SIZE = 64
+
+# 统计区域在缩略图上的最小边长
+MIN_SAMPLE = 4
+
+# 自动位置的候选，分数相同时按此顺序选择：角落优先，其次边缘，最后中心
+AUTO_POSITIONS = ["右下", "左下", "右上", "左上", "下中", "上中", "右中", "左中", "中心"]
+
+# 文本亮度与背景平均亮度相差不到该值时改用黑色或白色
+CONTRAST_THRESHOLD = 96
+
+# 背景亮度的平均偏差超过该值时视为杂乱区域，提高文本不透明度
+BUSY_DEVIATION = 32
+BUSY_OPACITY = 90
+
+
+def analysis_proxy(image, max_size=ANALYSIS_SIZE):
+    """按最近邻采样生成的灰度缩略图，只读取少量像素，耗时与原图大小基本无关"""
+    scale = min(1.0, max_size / max(image.size))
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.NEAREST).convert("L")
+
+
+def _luminance(color):
+    return 0.299 * color.red() + 0.587 * color.green() + 0.114 * color.blue()
+
+
+def _mean(image):
+    return image.resize((1, 1), Image.BOX).getpixel((0, 0))
+
+
+def _region_stat(proxy, image_size, box):
+    """缩略图上与原图区域 box 对应部分的 (平均亮度, 平均偏差)
+
+    平均偏差为各像素与平均亮度之差的绝对值的平均，反映区域的复杂程度。
+    统计用 BOX 缩小到1个像素完成，不在Python中逐个遍历直方图；
+    区域至少取 MIN_SAMPLE 个像素见方，很小的水印也按周围的一小块背景判断。
+    """
+    scale_x = proxy.width / image_size[0]
+    scale_y = proxy.height / image_size[1]
+    edges = []
+    for start, end, scale, limit in ((box[0], box[2], scale_x, proxy.width), (box[1], box[3], scale_y, proxy.height)):
+        low, high = int(start * scale), round(end * scale)
+        if high - low < MIN_SAMPLE:
+            center = (start + end) / 2 * scale
+            low = round(center - MIN_SAMPLE / 2)
+            high = low + MIN_SAMPLE
+        low = min(max(low, 0), max(limit - MIN_SAMPLE, 0))
+        edges.append((low, max(min(high, limit), low + 1)))
+    region = proxy.crop((edges[0][0], edges[1][0], edges[0][1], edges[1][1]))
+    mean = _mean(region)
+    deviation = ImageChops.difference(region, Image.new("L", region.size, mean))
+    return mean, _mean(deviation)
+
+
+def _placement_box(image_size, settings, text):
+    """水印图层在图片上占据的区域，没有水印时返回None"""
+    boxes = [layer_box(layer, x, y, image_size) for layer, x, y in render_anchored_layers(image_size, settings, text)]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def _overlaps(box, boxes):
+    return any(box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+               for other in boxes)
+
+
+def _choose_position(proxy, image_size, settings, text, taken):
+    """选择背景最平坦的位置，尽量不与已放置的水印重叠，返回 (位置, 区域)
+
+    当前设置的位置最先比较，分数相同时保持不变。
+    """
+    candidates = [settings.position] + [p for p in AUTO_POSITIONS if p != settings.position]
+    trial = copy.copy(settings)
+    best = None
+    for position in candidates:
+        trial.position = position
+        box = _placement_box(image_size, trial, text)
+        if box is None:
+            return settings.position, None
+        # 与其他水印重叠的位置排在所有不重叠的位置之后
+        score = (_overlaps(box, taken), _region_stat(proxy, image_size, box)[1])
+        if best is None or score < best[0]:
+            best = (score, position, box)
+    return best[1], best[2]
+
+
+def _contrast_text(settings, mean, deviation):
+    """按背景亮度调整文本颜色和不透明度
+
+    颜色只在黑白两色中选择，不透明度只有原值和 BUSY_OPACITY 两档，
+    一批图片渲染的文本图层种类不会因此明显增加。
+    """
+    if abs(_luminance(settings.text_color) - mean) < CONTRAST_THRESHOLD:
+        value = 0 if mean >= 128 else 255
+        settings.text_color = QColor(value, value, value, settings.text_color.alpha())
+    if deviation > BUSY_DEVIATION:
+        settings.text_opacity = max(settings.text_opacity, BUSY_OPACITY)
+
+
+def auto_settings(settings, image_size, make_proxy, text=None):
+    """按图片内容确定自动位置和自动对比度，返回这张图片实际使用的设置
+
+    make_proxy() 返回统计用的缩略图，只在有图层启用自动模式时调用。
+    调整过的图层是原设置的浅拷贝，原设置不变；渲染缓存按实际使用的位置和颜色区分。
+    没有图层启用自动模式时直接返回 settings。
+    """
+    stack = settings.layer_stack()
+    if not any(layer.auto_position or layer.auto_contrast for layer in stack):
+        return settings
+
+    try:
+        proxy = make_proxy()
+        if proxy.mode != "L":
+            proxy = proxy.convert("L")
+    except Exception as e:
+        print(f"生成统计缩略图失败: {e}")
+        return settings
+
+    texts = text if isinstance(text, list) else [None] * (len(stack) - 1) + [text]
+    adjusted = []
+    taken = []  # 已放置的定位水印所占区域
+    for layer, layer_text in zip(stack, texts):
+        if layer.tiled:
+            if layer.auto_contrast:
+                # 平铺水印覆盖整幅图片，按整体亮度调整
+                layer = copy.copy(layer)
+                _contrast_text(layer, *_region_stat(proxy, image_size, (0, 0) + tuple(image_size)))
+            adjusted.append(layer)
+            continue
+
+        if layer.auto_position or layer.auto_contrast:
+            layer = copy.copy(layer)
+        if layer.auto_position:
+            layer.position, box = _choose_position(proxy, image_size, layer, layer_text, taken)
+        else:
+            box = _placement_box(image_size, layer, layer_text)
+        if box is None:
+            adjusted.append(layer)
+            continue
+        if layer.auto_contrast:
+            _contrast_text(layer, *_region_stat(proxy, image_size, box))
+        taken.append(box)
+        adjusted.append(layer)
+
+    top = adjusted[-1]
+    if top is settings:
+        top = copy.copy(settings)
+    top.extra_layers = adjusted[:-1]
+    return top
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""编码预设基准测试
+
+对每种输出格式的每个编码预设统计编码耗时和每百万像素的输出字节数。
+
+用法: python watermark_benchmark.py [图片 ...] [--repeat N] [--quality Q]
+不指定图片时使用生成的测试图片。
+"""
+
+import argparse
+import statistics
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from watermark_encode import ENCODER_PRESETS, PRESET_NAMES, encode_image, output_formats
+
+
+def make_test_image(size=(3000, 2000)):
+    """生成兼有平滑渐变、细节和噪声的测试图片，近似真实照片的压缩难度"""
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    radial = Image.radial_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge("RGB", (gradient, radial, noise))
+
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, max(1, width // 40)):
+        draw.line((i, 0, width - i, height), fill=(255 - i % 256, i % 256, 128), width=3)
+    return image.convert("RGBA")
+
+
+def benchmark(images, repeat=3, quality=90):
+    """返回 [(格式, 预设, 平均耗时秒, 每百万像素字节数)]"""
+    megapixels = sum(image.width * image.height for image in images) / 1e6
+    results = []
+    for output_format in output_formats():
+        for preset in ENCODER_PRESETS[output_format]:
+            timings = []
+            total_bytes = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                total_bytes = sum(len(encode_image(image, output_format, quality, preset)) for image in images)
+                timings.append(time.perf_counter() - start)
+            results.append((output_format, preset, statistics.median(timings), total_bytes / megapixels))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="编码预设基准测试")
+    parser.add_argument("images", nargs="*", help="测试图片，不指定时使用生成的图片")
+    parser.add_argument("--repeat", type=int, default=3, help="每个预设重复编码的次数，取中位数")
+    parser.add_argument("--quality", type=int, default=90, help="有损格式的质量")
+    args = parser.parse_args()
+
+    if args.images:
+        images = [Image.open(path).convert("RGBA") for path in args.images]
+    else:
+        images = [make_test_image()]
+    megapixels = sum(image.width * image.height for image in images) / 1e6
+    print(f"{len(images)} 张图片，共 {megapixels:.1f} 百万像素，质量 {args.quality}，重复 {args.repeat} 次")
+
+    print(f"{'格式':<6}{'预设':<6}{'耗时(秒)':>10}{'百万像素/秒':>12}{'字节/百万像素':>16}")
+    for output_format, preset, elapsed, bytes_per_mp in benchmark(images, args.repeat, args.quality):
+        print(f"{output_format:<8}{PRESET_NAMES[preset]:<6}{elapsed:>12.3f}{megapixels / elapsed:>14.1f}"
+              f"{bytes_per_mp:>18,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QListWidget, QListWidgetItem
+from PyQt5.QtGui import QImage, QPixmap, QIcon
+from PyQt5.QtCore import Qt, QSize, QTimer, pyqtSignal
+
+from watermark_settings import WatermarkSettings
+from watermark_render import composite_scaled
+from watermark_auto import auto_settings
+from watermark_scheduler import THUMBNAIL, PREFETCH, CancelToken, scheduler
+
+# 设置连续变化时，停止变化多久后才重新渲染（毫秒）
+REFRESH_DELAY = 150
+
+
+class ContactSheet(QDialog):
+    """所有图片加上当前水印后的缩略图网格，用于导出前检查各种宽高比下的水印位置
+
+    缩略图使用图片加载时生成的 WatermarkImage.thumbnail，不重新解码原图。
+    渲染交给调度器的低优先级后台线程，只渲染可见的格子，并预取下面一屏；设置改变后已渲染的格子标记为过期，
+    可见的格子立即重新渲染，其余的在滚动到可见时再渲染。每一代共用一个取消标记，
+    设置再次改变或窗口关闭时尚未开始的任务从队列中移除。
+    每个格子按基础设置的代和这张图片的覆盖设置判断是否过期，只修改一张图片时只重新渲染这一张。
+    """
+
+    cell_ready = pyqtSignal(int, object, QImage)
+
+    def __init__(self, images, base_settings, overrides, text_for, parent=None):
+        """base_settings() 返回基础设置，overrides 为 {路径: 覆盖设置}，text_for(index) 返回第 index 张图片的水印文本"""
+        super().__init__(parent)
+        self.setWindowTitle("批量预览")
+        self.resize(900, 650)
+        self.images = images
+        self.base_settings = base_settings
+        self.overrides = overrides
+        self.text_for = text_for
+        self.generation = 0  # 设置每改变一次加1
+        self.snapshot = None  # 当前一代的设置副本，渲染线程只读取副本
+        self.rendered = {}  # 图片序号 -> 已显示的渲染结果的键 (代, 覆盖设置)
+        self.queued = {}  # 图片序号 -> 已提交渲染的键
+        self.wanted = frozenset()  # 当前可见和预取的图片序号，由界面线程整体替换
+        self.token = CancelToken()  # 当前一代任务的取消标记
+
+        layout = QVBoxLayout(self)
+        self.status_label = QLabel()
+        layout.addWidget(self.status_label)
+        self.grid = QListWidget()
+        size = QSize(images[0].THUMBNAIL_SIZE, images[0].THUMBNAIL_SIZE) if images else QSize(160, 160)
+        self.grid.setIconSize(size)
+        self.grid.setViewMode(QListWidget.IconMode)
+        self.grid.setResizeMode(QListWidget.Adjust)
+        self.grid.setMovement(QListWidget.Static)
+        self.grid.setUniformItemSizes(True)
+        self.grid.setSpacing(6)
+        layout.addWidget(self.grid)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.cell_ready.connect(self.on_cell_ready)
+        self.grid.verticalScrollBar().valueChanged.connect(self.schedule_visible)
+
+        self.reload_images()
+
+    def reload_images(self):
+        """图片列表改变后重建网格"""
+        self.grid.clear()
+        self.rendered = {}
+        self.new_token()
+        for image in self.images:
+            item = QListWidgetItem(os.path.basename(image.path))
+            item.setSizeHint(QSize(self.grid.iconSize().width() + 16, self.grid.iconSize().height() + 28))
+            item.setTextAlignment(Qt.AlignHCenter | Qt.AlignBottom)
+            self.grid.addItem(item)
+        self.refresh()
+
+    def settings_changed(self):
+        """设置改变，合并连续的改变后再重新渲染"""
+        self.refresh_timer.start()
+
+    def refresh(self):
+        """基础设置改变时开始新的一代，重新渲染可见的格子；只切换了图片等设置未变时不重新渲染"""
+        settings = self.base_settings().to_dict()
+        if self.snapshot is None or settings != self.snapshot.to_dict():
+            self.generation += 1
+            self.snapshot = WatermarkSettings.from_dict(settings)
+            self.new_token()
+        self.schedule_visible()
+
+    def new_token(self):
+        """取消已提交但尚未开始的任务，之后的任务使用新的取消标记"""
+        scheduler.cancel(self.token)
+        self.token = CancelToken()
+        self.queued = {}
+
+    def visible_indexes(self):
+        viewport = self.grid.viewport().rect()
+        return [row for row in range(self.grid.count())
+                if self.grid.visualItemRect(self.grid.item(row)).intersects(viewport)]
+
+    def schedule_visible(self, *args):
+        """提交可见且结果过期的格子，再按预取优先级提交下面一屏，已提交的不重复提交"""
+        if not self.isVisible() or self.snapshot is None:
+            return
+        visible = self.visible_indexes()
+        prefetch = []
+        if visible:
+            prefetch = list(range(visible[-1] + 1, min(visible[-1] + 1 + len(visible), len(self.images))))
+        self.wanted = frozenset(visible + prefetch)
+        # 已不需要的格子在渲染线程中会被跳过，再次可见时需要重新提交
+        self.queued = {index: key for index, key in self.queued.items() if index in self.wanted}
+        for priority, indexes in ((THUMBNAIL, visible), (PREFETCH, prefetch)):
+            for index in indexes:
+                image = self.images[index]
+                overrides = self.overrides.get(image.path)
+                key = (self.generation, json.dumps(overrides, sort_keys=True) if overrides else None)
+                if self.rendered.get(index) == key or self.queued.get(index) == key:
+                    continue
+                if image.thumbnail is None:
+                    continue
+                self.queued[index] = key
+                settings = self.snapshot.with_overrides(overrides)
+                scheduler.submit(priority, self.render_cell, index, key, image, settings, self.text_for(index),
+                                 token=self.token)
+        self.update_status()
+
+    def render_cell(self, index, key, image, settings, text):
+        """在渲染线程中合成一个格子；设置已经改变或格子已不需要时跳过"""
+        if key[0] != self.generation or index not in self.wanted:
+            return
+        try:
+            settings = auto_settings(settings, image.size, lambda: image.analysis, text)
+            cell = composite_scaled(image.thumbnail.copy(), image.size, settings, text)
+            self.cell_ready.emit(index, key, image.pil_to_qimage(cell).copy())
+        except Exception as e:
+            print(f"渲染 {image.path} 的批量预览失败: {e}")
+
+    def on_cell_ready(self, index, key, qimage):
+        if self.queued.get(index) == key:
+            del self.queued[index]
+        if key[0] != self.generation or index >= self.grid.count():
+            return
+        self.grid.item(index).setIcon(QIcon(QPixmap.fromImage(qimage)))
+        self.rendered[index] = key
+        self.update_status()
+
+    def update_status(self):
+        current = sum(1 for key in self.rendered.values() if key[0] == self.generation)
+        self.status_label.setText(f"共 {len(self.images)} 张图片，已按当前设置渲染 {current} 张"
+                                  f"（只渲染可见的图片，滚动时继续渲染）")
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        # 布局完成后才能确定可见的格子
+        QTimer.singleShot(0, self.schedule_visible)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.schedule_visible()
+
+    def hideEvent(self, event):
+        # 未开始的渲染不再需要，重新打开时再提交
+        self.wanted = frozenset()
+        self.new_token()
+        super().hideEvent(event)
+
+    def shutdown(self):
+        scheduler.cancel(self.token)
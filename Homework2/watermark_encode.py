@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import math
+import statistics
+import threading
+from collections import deque
+
+from PIL import features
+
+from watermark_png import PNG_PRESETS, encode_png
+
+# 编码预设，名称及界面显示文字
+PRESET_NAMES = {
+    "fast": "最快",
+    "balanced": "均衡",
+    "small": "最小",
+    "quality": "保真",
+}
+
+# 各输出格式的预设对应的编码参数，质量由界面的质量滑块单独指定
+ENCODER_PRESETS = {
+    "jpeg": {
+        "fast": {"optimize": False, "progressive": False, "subsampling": "4:2:0"},
+        "balanced": {"optimize": True, "progressive": False, "subsampling": "4:2:0"},
+        "small": {"optimize": True, "progressive": True, "subsampling": "4:2:0"},
+        "quality": {"optimize": True, "progressive": False, "subsampling": "4:4:4"},
+    },
+    "png": {
+        "fast": PNG_PRESETS["fast"],
+        "balanced": PNG_PRESETS["balanced"],
+        "small": PNG_PRESETS["small"],
+        # PNG 本身无损，保真与均衡相同
+        "quality": PNG_PRESETS["balanced"],
+    },
+    "webp": {
+        "fast": {"method": 2},
+        "balanced": {"method": 4},
+        "small": {"method": 6},
+        # 无损 WebP，忽略质量设置
+        "quality": {"method": 4, "lossless": True},
+    },
+    "avif": {
+        "fast": {"speed": 9, "subsampling": "4:2:0"},
+        "balanced": {"speed": 6, "subsampling": "4:2:0"},
+        "small": {"speed": 5, "subsampling": "4:2:0"},
+        "quality": {"speed": 6, "subsampling": "4:4:4"},
+    },
+}
+
+# JPEG 质量每提高1档文件大小的对数增量，按质量每10档分段；导出时根据实际编码结果更新
+_JPEG_SIZE_SLOPES = [0.03, 0.03, 0.025, 0.02, 0.017, 0.015, 0.017, 0.02, 0.03, 0.055]
+
+# 不支持透明通道的格式
+_OPAQUE_FORMATS = {"jpeg"}
+
+
+def output_formats():
+    """当前 Pillow 支持的输出格式"""
+    formats = ["jpeg", "png"]
+    if features.check("webp"):
+        formats.append("webp")
+    if features.check("avif"):
+        formats.append("avif")
+    return formats
+
+
+def frame_mode(output_format):
+    """输出格式编码前需要的图像模式"""
+    return "RGB" if output_format in _OPAQUE_FORMATS else "RGBA"
+
+
+def encode_image(image, output_format, quality=95, preset="balanced", metadata=None):
+    """将渲染结果编码为输出格式的字节数据
+
+    metadata 为 ImageMetadata.export_options() 返回的元数据，None 表示不写入元数据。
+    """
+    options = ENCODER_PRESETS[output_format][preset]
+
+    if output_format == "png":
+        # PNG 按行分块多线程压缩
+        return encode_png(image, options["compress_level"], options["filter"], metadata=metadata)
+
+    if metadata:
+        options = dict(options, **{key: value for key, value in metadata.items() if value})
+
+    # 转换为RGB模式，因为JPEG不支持透明通道
+    if output_format in _OPAQUE_FORMATS and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, output_format.upper(), quality=quality, **options)
+    return buffer.getvalue()
+
+
+class TargetSizeEstimator:
+    """按目标文件大小选择JPEG质量，在同一批导出中学习质量与文件大小的关系
+
+    每张图片的搜索从前面图片的结果推算的质量开始，多数图片只需一到两次试编码。
+    """
+
+    def __init__(self, history=16, smoothing=0.3):
+        self.smoothing = smoothing
+
+        self._slopes = list(_JPEG_SIZE_SLOPES)
+        self._results = deque(maxlen=history)  # 最近图片的 (质量, 每像素字节数)
+        self._lock = threading.Lock()
+
+    def _slope(self, quality):
+        return self._slopes[min(max(quality, 1), 99) // 10]
+
+    def predict(self, quality, size, target, max_quality=95):
+        """根据某个质量下的文件大小，推算不超过 target 字节的最高质量"""
+        log_size = math.log(size)
+        log_target = math.log(target)
+        with self._lock:
+            if log_size <= log_target:
+                while quality < max_quality and log_size + self._slope(quality) <= log_target:
+                    log_size += self._slope(quality)
+                    quality += 1
+            else:
+                while quality > 1 and log_size > log_target:
+                    quality -= 1
+                    log_size -= self._slope(quality)
+        return quality
+
+    def start_quality(self, pixels, target, max_quality=95):
+        """根据本批次前面图片的结果估算起始质量"""
+        with self._lock:
+            results = list(self._results)
+        if not results:
+            return min(85, max_quality)
+        estimates = [self.predict(quality, bpp * pixels, target, max_quality) for quality, bpp in results]
+        return int(statistics.median(estimates))
+
+    def learn(self, pixels, trials, quality):
+        """记录一张图片的搜索结果，trials 为 [(质量, 字节数)]"""
+        with self._lock:
+            sizes = dict(trials)
+            self._results.append((quality, sizes[quality] / pixels))
+
+            # 用同一张图片相邻两次试编码的结果更新对应质量段的斜率
+            points = sorted(sizes.items())
+            for (q1, s1), (q2, s2) in zip(points, points[1:]):
+                bucket = min((q1 + q2) // 2, 99) // 10
+                slope = math.log(s2 / s1) / (q2 - q1)
+                self._slopes[bucket] += self.smoothing * (slope - self._slopes[bucket])
+
+
+def encode_to_size(image, max_bytes, max_quality=95, preset="balanced", estimator=None, metadata=None):
+    """编码为不超过 max_bytes 字节的JPEG（包括元数据），质量尽量高且不超过 max_quality
+
+    返回 (数据, 质量, 试编码次数, 是否满足大小限制)；最低质量仍超出时返回最低质量的结果。
+    """
+    if estimator is None:
+        estimator = TargetSizeEstimator()
+    pixels = image.width * image.height
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    low, high = 1, max_quality
+    quality = min(max(estimator.start_quality(pixels, max_bytes, max_quality), low), high)
+    best = None
+    trials = []
+    encoded = {}
+    while True:
+        data = encode_image(image, "jpeg", quality, preset, metadata)
+        trials.append((quality, len(data)))
+        encoded[quality] = data
+        fits = len(data) <= max_bytes
+        if fits:
+            best = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+        if low > high:
+            break
+
+        predicted = estimator.predict(quality, len(data), max_bytes, max_quality)
+        if fits and predicted < low:
+            # 模型认为再提高一档就会超出
+            break
+        quality = min(max(predicted, low), high)
+
+    fits = best is not None
+    if not fits:
+        best = min(encoded)
+    estimator.learn(pixels, trials, best)
+    return encoded[best], best, len(trials), fits
+
+
+def encode_for_export(image, options, metadata=None, estimator=None):
+    """按导出任务的编码选项编码，返回 (数据, 试编码次数, 是否满足大小限制)
+
+    options 包括 output_format、quality、preset 和 target_size。
+    """
+    if options.get("target_size"):
+        data, _, trials, fits = encode_to_size(image, options["target_size"], options["quality"],
+                                               options["preset"], estimator, metadata)
+        return data, trials, fits
+    return encode_image(image, options["output_format"], options["quality"], options["preset"], metadata), 0, True
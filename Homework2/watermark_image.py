@@ -2,32 +2,117 @@
 # -*- coding: utf-8 -*-
 
 import os
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from PIL import Image
 import io
 from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QFont, QTransform
 from PyQt5.QtCore import Qt, QPoint, QRect, QSize
 
+from watermark_render import render_layers, render_text_layer, render_image_layer, composite_layer
+from watermark_tiles import TILED_PIXEL_THRESHOLD, TiledSource, open_unbounded
+from watermark_metadata import ImageMetadata
+from watermark_auto import analysis_proxy, auto_settings
+
 class WatermarkImage:
-    def __init__(self, path):
+    # 超过该像素数的图片只生成预览用的缩小图，不在内存中保留原图
+    LARGE_IMAGE_PIXELS = TILED_PIXEL_THRESHOLD
+    PROXY_SIZE = 2048
+    # 缩略图的长边，图片列表和批量预览共用
+    THUMBNAIL_SIZE = 160
+    
+    def __init__(self, path, load=True):
         self.path = path
         self.original_image = None
         self.pixmap = None
-        self.load_image()
+        self.source = None  # 只读取了文件头、尚未解码的PIL图像
+        self.size = None
+        self.mode = None
+        self.metadata = None  # 读取文件头时获取的EXIF、ICC、XMP
+        self.analysis = None  # 自动模式统计用的灰度缩略图
+        self.thumbnail = None  # 加载时生成的PIL缩略图，只读
+        if load:
+            self.load_image()
     
     def load_image(self):
         """加载图片并创建QPixmap"""
         try:
-            # 使用PIL加载图片
-            self.original_image = Image.open(self.path).convert("RGBA")
+            header = open_unbounded(self.path)
+            self.size = header.size
+            
+            if self.size[0] * self.size[1] >= self.LARGE_IMAGE_PIXELS:
+                self.metadata = ImageMetadata.from_image(header)
+                header.close()
+                # 超大图片按行带生成缩小图，导出时再分块处理原图
+                preview_image = TiledSource(self.path).make_proxy(self.PROXY_SIZE)
+            else:
+                # 使用PIL加载图片，复用已经读取的文件头
+                self.source = header
+                preview_image = self.decode_image()
+            
+            self.analysis = analysis_proxy(preview_image)
+            self.thumbnail = self.make_thumbnail(preview_image)
             
             # 转换为QPixmap用于显示
-            qimage = self.pil_to_qimage(self.original_image)
+            qimage = self.pil_to_qimage(preview_image)
             self.pixmap = QPixmap.fromImage(qimage)
         except Exception as e:
             print(f"无法加载图片 {self.path}: {e}")
             self.original_image = None
             self.pixmap = QPixmap()
     
+    def make_thumbnail(self, image):
+        """按 THUMBNAIL_SIZE 缩小，先按整数倍缩小再精确缩放，耗时与原图大小关系不大"""
+        scale = min(1.0, self.THUMBNAIL_SIZE / max(image.size))
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    
+    def read_header(self, header=None):
+        """只读取文件头获取尺寸、模式和元数据，不解码像素数据
+
+        header 为已经打开的文件头，传入时直接使用，不重新打开文件。
+        """
+        if self.source is None:
+            self.source = header or Image.open(self.path)
+            self.metadata = ImageMetadata.from_image(self.source)
+            self.size = self.source.size
+            self.mode = self.source.mode
+            if self.metadata.orientation in (5, 6, 7, 8):
+                # 解码时会旋转90度
+                self.size = self.size[::-1]
+        return self.size, self.mode
+    
+    def decode_image(self):
+        """只解码为PIL图像，不创建QPixmap，可在工作线程中调用
+
+        按EXIF方向转正像素：在源图模式下变换后立即释放解码缓冲，峰值内存与不旋转时相同。
+        """
+        source = self.source or Image.open(self.path)
+        self.source = None
+        try:
+            if self.metadata is None:
+                self.metadata = ImageMetadata.from_image(source)
+            method = self.metadata.transpose_method()
+            if method is None:
+                self.original_image = source.convert("RGBA")
+            else:
+                oriented = source.transpose(method)
+                source.close()
+                self.original_image = oriented if oriented.mode == "RGBA" else oriented.convert("RGBA")
+                del oriented
+                self.metadata.orientation_applied = True
+        finally:
+            source.close()
+        self.size = self.original_image.size
+        return self.original_image
+    
+    def release_image(self):
+        """释放解码后的图像数据"""
+        self.original_image = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+    
     def pil_to_qimage(self, pil_image):
         """将PIL图像转换为QImage"""
         if pil_image.mode == "RGBA":
@@ -53,221 +138,37 @@ class WatermarkImage:
         # 从字节数组创建PIL图像
         return Image.open(byte_array)
     
-    def apply_watermark(self, settings):
-        """应用水印并返回处理后的PIL图像"""
+    def apply_watermark(self, settings, text=None):
+        """应用水印并返回处理后的PIL图像，text 为按图片解析好的水印文本"""
         if not self.original_image:
             return None
         
         # 创建副本以避免修改原始图像
         result = self.original_image.copy()
         
-        # 根据水印类型应用水印
-        if settings.watermark_image_path and os.path.exists(settings.watermark_image_path):
-            # 应用图片水印
-            result = self.apply_image_watermark(result, settings)
+        # 自动位置和自动对比度按这张图片的内容调整设置
+        settings = auto_settings(settings, result.size, lambda: analysis_proxy(result), text)
         
-        if settings.text_content.strip():
-            # 应用文本水印
-            result = self.apply_text_watermark(result, settings)
+        # 按图层栈的顺序合成，重叠的图层已预先合并，每块区域只合成一次
+        for layer, x, y in render_layers(result.size, settings, text):
+            composite_layer(result, layer, x, y)
         
         return result
     
     def apply_text_watermark(self, image, settings):
         """应用文本水印"""
-        if not settings.text_content.strip():
-            return image
-        
-        # 创建绘图对象
-        draw = ImageDraw.Draw(image)
-        
-        # 获取字体
-        try:
-            # 尝试使用系统字体
-            font_size = settings.font.pointSize()
-            font_family = settings.font.family()
-            is_bold = settings.font.bold()
-            is_italic = settings.font.italic()
-            
-            # 这里需要根据系统找到对应的字体文件
-            # 简单起见，这里使用默认字体
-            font = ImageFont.truetype("Arial", font_size)
-        except Exception:
-            # 使用默认字体
-            font_size = settings.font.pointSize()
-            font = ImageFont.load_default()
-        
-        # 获取文本颜色和透明度
-        r, g, b = settings.text_color.red(), settings.text_color.green(), settings.text_color.blue()
-        opacity = settings.text_opacity / 100.0
-        text_color = (r, g, b, int(255 * opacity))
-        
-        # 计算文本大小
-        text = settings.text_content
-        text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
-        
-        # 计算位置
-        position = settings.position
-        img_width, img_height = image.size
-        
-        if position == "左上":
-            x, y = 10, 10
-        elif position == "上中":
-            x = (img_width - text_width) // 2
-            y = 10
-        elif position == "右上":
-            x = img_width - text_width - 10
-            y = 10
-        elif position == "左中":
-            x = 10
-            y = (img_height - text_height) // 2
-        elif position == "中心":
-            x = (img_width - text_width) // 2
-            y = (img_height - text_height) // 2
-        elif position == "右中":
-            x = img_width - text_width - 10
-            y = (img_height - text_height) // 2
-        elif position == "左下":
-            x = 10
-            y = img_height - text_height - 10
-        elif position == "下中":
-            x = (img_width - text_width) // 2
-            y = img_height - text_height - 10
-        else:  # 右下
-            x = img_width - text_width - 10
-            y = img_height - text_height - 10
-        
-        # 应用旋转
-        if settings.rotation != 0:
-            # 创建一个透明图层用于旋转文本
-            txt = Image.new('RGBA', image.size, (255, 255, 255, 0))
-            d = ImageDraw.Draw(txt)
-            
-            # 绘制文本
-            if settings.text_shadow:
-                # 添加阴影
-                shadow_offset = 2
-                d.text((x + shadow_offset, y + shadow_offset), text, font=font, fill=(0, 0, 0, int(128 * opacity)))
-            
-            if settings.text_outline:
-                # 添加描边
-                outline_width = settings.outline_width
-                for dx in range(-outline_width, outline_width + 1):
-                    for dy in range(-outline_width, outline_width + 1):
-                        if dx != 0 or dy != 0:
-                            d.text((x + dx, y + dy), text, font=font, fill=(0, 0, 0, int(200 * opacity)))
-            
-            # 绘制主文本
-            d.text((x, y), text, font=font, fill=text_color)
-            
-            # 旋转文本图层
-            center_x = x + text_width // 2
-            center_y = y + text_height // 2
-            txt = txt.rotate(settings.rotation, center=(center_x, center_y), resample=Image.BICUBIC, expand=False)
-            
-            # 合并图层
-            image = Image.alpha_composite(image, txt)
-        else:
-            # 直接绘制文本
-            if settings.text_shadow:
-                # 添加阴影
-                shadow_offset = 2
-                draw.text((x + shadow_offset, y + shadow_offset), text, font=font, fill=(0, 0, 0, int(128 * opacity)))
-            
-            if settings.text_outline:
-                # 添加描边
-                outline_width = settings.outline_width
-                for dx in range(-outline_width, outline_width + 1):
-                    for dy in range(-outline_width, outline_width + 1):
-                        if dx != 0 or dy != 0:
-                            draw.text((x + dx, y + dy), text, font=font, fill=(0, 0, 0, int(200 * opacity)))
-            
-            # 绘制主文本
-            draw.text((x, y), text, font=font, fill=text_color)
-        
+        rendered = render_text_layer(image.size, settings)
+        if rendered:
+            composite_layer(image, *rendered)
         return image
     
     def apply_image_watermark(self, image, settings):
         """应用图片水印"""
-        if not settings.watermark_image_path or not os.path.exists(settings.watermark_image_path):
-            return image
-        
         try:
-            # 加载水印图片
-            watermark = Image.open(settings.watermark_image_path).convert("RGBA")
-            
-            # 调整大小
-            if settings.keep_aspect_ratio:
-                # 按比例缩放
-                scale = settings.watermark_image_scale
-                new_width = int(watermark.width * scale)
-                new_height = int(watermark.height * scale)
-            else:
-                # 自由调整大小
-                new_width = settings.watermark_image_width
-                new_height = settings.watermark_image_height
-            
-            watermark = watermark.resize((new_width, new_height), Image.LANCZOS)
-            
-            # 调整透明度
-            if settings.watermark_image_opacity < 100:
-                alpha = watermark.split()[3]
-                alpha = ImageEnhance.Brightness(alpha).enhance(settings.watermark_image_opacity / 100.0)
-                watermark.putalpha(alpha)
-            
-            # 计算位置
-            position = settings.position
-            img_width, img_height = image.size
-            wm_width, wm_height = watermark.size
-            
-            if position == "左上":
-                x, y = 10, 10
-            elif position == "上中":
-                x = (img_width - wm_width) // 2
-                y = 10
-            elif position == "右上":
-                x = img_width - wm_width - 10
-                y = 10
-            elif position == "左中":
-                x = 10
-                y = (img_height - wm_height) // 2
-            elif position == "中心":
-                x = (img_width - wm_width) // 2
-                y = (img_height - wm_height) // 2
-            elif position == "右中":
-                x = img_width - wm_width - 10
-                y = (img_height - wm_height) // 2
-            elif position == "左下":
-                x = 10
-                y = img_height - wm_height - 10
-            elif position == "下中":
-                x = (img_width - wm_width) // 2
-                y = img_height - wm_height - 10
-            else:  # 右下
-                x = img_width - wm_width - 10
-                y = img_height - wm_height - 10
-            
-            # 应用旋转
-            if settings.rotation != 0:
-                # 创建一个透明图层用于旋转水印
-                layer = Image.new('RGBA', image.size, (255, 255, 255, 0))
-                
-                # 粘贴水印到图层
-                layer.paste(watermark, (x, y), watermark)
-                
-                # 旋转图层
-                center_x = x + wm_width // 2
-                center_y = y + wm_height // 2
-                layer = layer.rotate(settings.rotation, center=(center_x, center_y), resample=Image.BICUBIC, expand=False)
-                
-                # 合并图层
-                image = Image.alpha_composite(image, layer)
-            else:
-                # 直接粘贴水印
-                image.paste(watermark, (x, y), watermark)
-            
-            return image
+            rendered = render_image_layer(image.size, settings)
         except Exception as e:
             print(f"应用图片水印失败: {e}")
-            return image
\ No newline at end of file
+            return image
+        if rendered:
+            composite_layer(image, *rendered)
+        return image
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import shutil
+
+# 导出任务日志目录
+DEFAULT_JOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs")
+
+
+def write_stream_atomic(write, output_path, temp_path):
+    """先写入临时文件再重命名，保证输出路径上不会留下写了一半的文件
+
+    write 为接收文件对象的写入函数，可以边编码边写入。
+    """
+    try:
+        with open(temp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_file_atomic(data, output_path, temp_path):
+    """原子地写入完整的字节数据"""
+    write_stream_atomic(lambda f: f.write(data), output_path, temp_path)
+
+
+class ExportJournal:
+    """批量导出任务日志，程序被中断后可以从上次停止的位置继续导出"""
+
+    SPEC_FILE = "job.json"
+    DONE_FILE = "done.log"
+
+    # 本进程中正在执行的任务目录，pending_jobs 不返回这些任务
+    _running = set()
+
+    def __init__(self, job_dir, spec, batch_size=32, batch_interval=2.0):
+        self.job_dir = job_dir
+        self.spec = spec
+        self.job_id = spec["job_id"]
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self.done = set()
+        self._pending = []
+        self._last_commit = time.monotonic()
+        self._done_file = None
+
+        self._load_done()
+
+    @classmethod
+    def create(cls, spec, jobs_dir=DEFAULT_JOBS_DIR, **kwargs):
+        """创建新的导出任务并持久化任务描述"""
+        spec = dict(spec)
+        spec["job_id"] = uuid.uuid4().hex
+        spec["created"] = time.time()
+
+        job_dir = os.path.join(jobs_dir, spec["job_id"])
+        os.makedirs(job_dir, exist_ok=True)
+
+        spec_path = os.path.join(job_dir, cls.SPEC_FILE)
+        temp_path = spec_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(spec, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, spec_path)
+
+        return cls(job_dir, spec, **kwargs)
+
+    @classmethod
+    def load(cls, job_dir, **kwargs):
+        """从任务目录加载导出任务"""
+        try:
+            with open(os.path.join(job_dir, cls.SPEC_FILE), "r", encoding="utf-8") as f:
+                spec = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"加载导出任务 {job_dir} 失败: {e}")
+            return None
+        return cls(job_dir, spec, **kwargs)
+
+    @classmethod
+    def pending_jobs(cls, jobs_dir=DEFAULT_JOBS_DIR):
+        """获取所有未完成的导出任务，按创建时间排序"""
+        if not os.path.isdir(jobs_dir):
+            return []
+
+        jobs = []
+        for name in os.listdir(jobs_dir):
+            job_dir = os.path.join(jobs_dir, name)
+            if not os.path.isdir(job_dir) or os.path.abspath(job_dir) in cls._running:
+                continue
+            journal = cls.load(job_dir)
+            if journal is None:
+                # 任务描述没有写完整，说明任务尚未开始
+                shutil.rmtree(job_dir, ignore_errors=True)
+            elif journal.remaining_count() == 0:
+                journal.finish()
+            else:
+                jobs.append(journal)
+
+        jobs.sort(key=lambda job: job.spec.get("created", 0))
+        return jobs
+
+    @property
+    def items(self):
+        return self.spec["items"]
+
+    @property
+    def output_dir(self):
+        return self.spec["output_dir"]
+
+    def output_path(self, index):
+        return os.path.join(self.output_dir, self.items[index]["output"])
+
+    def temp_path(self, index):
+        """临时文件与输出文件在同一目录，保证重命名是原子操作"""
+        return os.path.join(self.output_dir, f".{self.items[index]['output']}.{self.job_id}.tmp")
+
+    def _load_done(self):
+        """读取已完成记录，并识别最后一批尚未落盘记录但已写完的输出"""
+        done_path = os.path.join(self.job_dir, self.DONE_FILE)
+        if os.path.exists(done_path):
+            with open(done_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    # 忽略崩溃时写了一半的最后一行
+                    if line.endswith("\n") and line.strip().isdigit():
+                        self.done.add(int(line))
+
+        # 输出文件只会通过重命名整体出现，任务创建之后出现的输出文件一定是完整的
+        created = self.spec.get("created", 0)
+        for index in range(len(self.items)):
+            if index in self.done:
+                continue
+            output_path = self.output_path(index)
+            try:
+                if os.path.getmtime(output_path) >= created:
+                    self.done.add(index)
+                    self._pending.append(index)
+            except OSError:
+                pass
+
+    def is_done(self, index):
+        return index in self.done
+
+    def remaining_count(self):
+        return len(self.items) - len(self.done)
+
+    def write_output(self, index, data):
+        """原子地写入一张已编码的输出图片"""
+        write_file_atomic(data, self.output_path(index), self.temp_path(index))
+
+    def stream_output(self, index, write):
+        """原子地流式写入一张输出图片，write 接收文件对象"""
+        write_stream_atomic(write, self.output_path(index), self.temp_path(index))
+
+    def mark_done(self, index):
+        """记录一张图片已完成，按批次写入磁盘"""
+        self.done.add(index)
+        self._pending.append(index)
+        if (len(self._pending) >= self.batch_size
+                or time.monotonic() - self._last_commit >= self.batch_interval):
+            self.commit()
+
+    def commit(self):
+        """将缓冲的完成记录持久化到磁盘"""
+        self._last_commit = time.monotonic()
+        if not self._pending:
+            return
+
+        if self._done_file is None:
+            self._done_file = open(os.path.join(self.job_dir, self.DONE_FILE), "a", encoding="utf-8")
+        self._done_file.write("".join(f"{index}\n" for index in self._pending))
+        self._done_file.flush()
+        os.fsync(self._done_file.fileno())
+        self._pending = []
+
+    def start(self):
+        """开始执行任务，执行期间不会被当作未完成的任务"""
+        ExportJournal._running.add(os.path.abspath(self.job_dir))
+
+    def close(self):
+        """暂停任务，保留日志以便下次恢复"""
+        ExportJournal._running.discard(os.path.abspath(self.job_dir))
+        self.commit()
+        if self._done_file is not None:
+            self._done_file.close()
+            self._done_file = None
+
+    def finish(self):
+        """任务完成，删除日志"""
+        self.close()
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    def discard(self):
+        """放弃任务，清理残留的临时文件和日志"""
+        self.close()
+        for index in range(len(self.items)):
+            temp_path = self.temp_path(index)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        shutil.rmtree(self.job_dir, ignore_errors=True)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from PIL import Image
+
+EXIF_HEADER = b"Exif\x00\x00"
+
+ORIENTATION_TAG = 0x0112
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+# EXIF 方向对应的变换
+_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# 可选择移除的标签组：(IFD0 中的标签, Exif IFD 中的标签)
+STRIP_GROUPS = {
+    # GPS 位置信息
+    "gps": ((GPS_IFD,), ()),
+    # 可以识别拍摄者或设备的信息
+    "private": (
+        (0x013B, 0x013C),                          # Artist, HostComputer
+        (0x927C, 0xA420, 0xA430, 0xA431, 0xA435),  # MakerNote, ImageUniqueID, 机主姓名、机身和镜头序列号
+    ),
+}
+
+# XMP 中与标签组对应的内容，出现时整段 XMP 不再写入
+_XMP_MARKERS = {
+    "gps": (b"GPS",),
+    "private": (b"SerialNumber", b"OwnerName", b"ImageUniqueID"),
+}
+
+# TIFF 源图的 getexif() 包含描述图像数据结构的标签，写入其他格式时需要去掉
+_TIFF_STRUCTURE_TAGS = (
+    254, 256, 257, 258, 259, 262, 266, 273, 277, 278, 279, 284, 317,
+    322, 323, 324, 325, 338, 339, 347, 530, 532, 700, 34675,
+)
+
+
+class ImageMetadata:
+    """从文件头读取的元数据，随图片记录一起传递，导出时写回输出文件"""
+
+    def __init__(self, exif=None, icc_profile=None, xmp=None, orientation=1):
+        self.exif = exif  # 带 "Exif\0\0" 头的原始 EXIF 数据
+        self.icc_profile = icc_profile
+        self.xmp = xmp
+        self.orientation = orientation
+        # 解码时是否已经按方向旋转了像素
+        self.orientation_applied = False
+
+    @classmethod
+    def from_image(cls, image):
+        """从已打开（未解码）的PIL图像读取元数据，不需要额外读取文件"""
+        info = image.info
+        exif_data = image.getexif()
+        orientation = exif_data.get(ORIENTATION_TAG, 1)
+
+        exif = info.get("exif")
+        if exif is None and image.format == "TIFF" and len(exif_data):
+            for tag in _TIFF_STRUCTURE_TAGS:
+                exif_data.pop(tag, None)
+            exif = exif_data.tobytes()
+        elif exif is not None and not exif.startswith(EXIF_HEADER):
+            # WebP 中的 EXIF 不带头部
+            exif = EXIF_HEADER + exif
+
+        xmp = info.get("xmp") or info.get("XML:com.adobe.xmp")
+        if isinstance(xmp, str):
+            xmp = xmp.encode("utf-8")
+
+        return cls(exif or None, info.get("icc_profile") or None, xmp or None, orientation)
+
+    def transpose_method(self):
+        """将像素转到正确方向需要的变换，不需要时返回None"""
+        return _TRANSPOSE.get(self.orientation)
+
+    def export_options(self, strip=()):
+        """返回写入输出文件的元数据 {"exif", "icc_profile", "xmp"}，按需移除指定的标签组"""
+        exif = self.exif
+        reset_orientation = self.orientation_applied and self.orientation != 1
+        if exif and (strip or reset_orientation):
+            exif_data = Image.Exif()
+            exif_data.load(exif)
+            if reset_orientation:
+                # 像素已经转正，去掉方向标签避免查看器再次旋转
+                exif_data.pop(ORIENTATION_TAG, None)
+            exif_ifd = exif_data.get_ifd(EXIF_IFD)
+            for group in strip:
+                ifd0_tags, exif_tags = STRIP_GROUPS[group]
+                for tag in ifd0_tags:
+                    exif_data.pop(tag, None)
+                for tag in exif_tags:
+                    exif_ifd.pop(tag, None)
+            exif = exif_data.tobytes()
+
+        xmp = self.xmp
+        if xmp and any(marker in xmp for group in strip for marker in _XMP_MARKERS[group]):
+            xmp = None
+
+        return {"exif": exif, "icc_profile": self.icc_profile, "xmp": xmp}
+
+
+def metadata_options(metadata, policy):
+    """按导出任务的元数据设置生成写入选项，policy 为 {"keep": bool, "strip": [标签组]}"""
+    if metadata is None or not policy or not policy.get("keep"):
+        return None
+    return metadata.export_options(policy.get("strip", ()))
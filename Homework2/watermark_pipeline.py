@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+import time
+
+from PIL import Image
+
+from watermark_image import WatermarkImage
+from watermark_render import text_layers
+from watermark_tiles import TiledSource, open_unbounded, render_tiled
+from watermark_encode import TargetSizeEstimator, encode_for_export
+from watermark_metadata import metadata_options
+from watermark_workers import ProcessExportPool, peak_rss
+from watermark_scheduler import EXPORT, scheduler
+
+# 流水线结束标记
+_STOP = object()
+
+
+class StageQueue(queue.Queue):
+    """带占用统计的有界队列，队列满时上游阻塞形成背压"""
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.max_occupancy = 0
+        self.occupancy_sum = 0
+        self.put_count = 0
+        self.put_wait = 0.0  # 上游因队列满而等待的时间（背压）
+        self.get_wait = 0.0  # 下游因队列空而等待的时间（饥饿）
+
+    def put(self, item, block=True, timeout=None):
+        start = time.perf_counter()
+        super().put(item, block, timeout)
+        waited = time.perf_counter() - start
+        with self.mutex:
+            size = self._qsize()
+            self.put_wait += waited
+            self.put_count += 1
+            self.occupancy_sum += size
+            self.max_occupancy = max(self.max_occupancy, size)
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        item = super().get(block, timeout)
+        waited = time.perf_counter() - start
+        with self.mutex:
+            self.get_wait += waited
+        return item
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "capacity": self.maxsize,
+                "current": self._qsize(),
+                "max": self.max_occupancy,
+                "mean": self.occupancy_sum / self.put_count if self.put_count else 0.0,
+                "put_wait": self.put_wait,
+                "get_wait": self.get_wait,
+            }
+
+
+def default_memory_budget():
+    """默认内存预算：物理内存的一半，无法获取时使用2GB"""
+    try:
+        physical = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 2048 * 1024 * 1024
+    return physical // 2
+
+
+def estimate_working_set(size, mode, output_format):
+    """根据像素数和模式估算一张图片在流水线中同时占用的内存（字节）
+
+    包括源图解码缓冲、RGBA原图、apply_watermark中的副本以及JPEG导出时的RGB转换。
+    水印图层只覆盖水印所在区域，相对整幅图像可以忽略。
+    """
+    width, height = size
+    pixels = width * height
+    try:
+        source_bpp = Image.getmodebands(mode)
+    except (KeyError, ValueError):
+        source_bpp = 4
+    if mode.startswith("I;16") or mode in ("I", "F"):
+        source_bpp = 4
+
+    rgba = pixels * 4
+    total = pixels * source_bpp  # 源图解码缓冲
+    total += rgba                # 转换后的RGBA原图
+    total += rgba                # apply_watermark 中的副本
+    if output_format == "jpeg":
+        total += pixels * 3      # 转换为RGB
+    total += pixels              # 编码后的数据，保守估计
+    return total
+
+
+class MemoryBudget:
+    """内存准入控制：只有在途内存总量不超过预算时才允许开始处理新图片"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.wait_time = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount, cancelled=None):
+        """申请内存额度，额度不足时阻塞；超过预算的单张大图在没有其他任务时单独放行"""
+        start = time.perf_counter()
+        with self._cond:
+            while self.in_flight > 0 and self.in_flight + amount > self.limit:
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                self._cond.wait(0.1)
+            self.in_flight += amount
+            self.peak = max(self.peak, self.in_flight)
+            self.wait_time += time.perf_counter() - start
+        return True
+
+    def release(self, amount):
+        with self._cond:
+            self.in_flight -= amount
+            self._cond.notify_all()
+
+
+class ExportPipeline:
+    """分阶段导出流水线：读取线程 -> 渲染线程池 -> 编码线程池 -> 写入线程
+
+    各阶段之间通过有界队列连接，磁盘读写和CPU计算可以同时进行。
+    流水线使用自己的线程，但作为调度器中优先级最低的导出任务：读取和渲染每张图片之前
+    先让出给排队或运行中的预览和缩略图任务。
+    """
+
+    def __init__(self, journal, settings, renderers=None, encoders=None,
+                 read_depth=4, encode_depth=4, write_depth=8, images=None,
+                 memory_budget=None, tiled_threshold=None, backend="thread", processes=None):
+        cpu_count = os.cpu_count() or 2
+        self.journal = journal
+        self.settings = settings
+        self.output_format = journal.spec["output_format"]
+        # 兼容旧版本任务日志中的字段名
+        self.quality = journal.spec.get("quality", journal.spec.get("jpeg_quality", 95))
+        self.preset = journal.spec.get("preset", journal.spec.get("png_preset", "balanced"))
+        # JPEG 目标文件大小（字节），None 表示按固定质量编码
+        self.target_size = journal.spec.get("target_size") if self.output_format == "jpeg" else None
+        self.size_estimator = TargetSizeEstimator()
+        # 元数据设置，旧版本任务日志没有该字段，按当时的行为不写入元数据
+        self.metadata_policy = journal.spec.get("metadata")
+        self.encode_options = {
+            "output_format": self.output_format,
+            "quality": self.quality,
+            "preset": self.preset,
+            "target_size": self.target_size,
+            "metadata": self.metadata_policy,
+        }
+        self.size_stats = {"images": 0, "trials": 0, "over_budget": 0}
+        self.renderers = renderers or max(1, cpu_count // 2)
+        self.encoders = encoders or max(1, cpu_count - self.renderers)
+        # 已经在界面中加载过的图片，无需重新解码
+        self.images = images or {}
+        self.memory = MemoryBudget(memory_budget or default_memory_budget())
+        # 像素数不小于该值的图片分块处理，None 表示不启用
+        self.tiled_threshold = tiled_threshold
+        self.tiled_count = 0
+        # "thread" 为线程流水线，"process" 为进程池
+        self.backend = backend
+        self.processes = processes or cpu_count
+
+        self.render_queue = StageQueue("render", read_depth)
+        self.encode_queue = StageQueue("encode", encode_depth)
+        self.write_queue = StageQueue("write", write_depth)
+
+        self.completed = 0
+        self.failed = 0
+        self.errors = []
+        self.stage_time = {"read": 0.0, "render": 0.0, "encode": 0.0, "write": 0.0}
+        self.worker_peak = {}  # 每个工作线程处理过的最大单张图片内存估算
+        self.worker_rss = {}   # 进程池模式下每个子进程的峰值RSS
+        self.peak_rss = None
+        self.elapsed = 0.0
+
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._active = {}
+        self._threads = []
+        self._start_time = 0.0
+        self._layer_base = (0, 0)
+
+    def start(self):
+        """启动流水线的所有线程"""
+        self._start_time = time.perf_counter()
+        self._active = {"render": self.renderers, "encode": self.encoders}
+        self._layer_base = (text_layers.misses, text_layers.hits)
+
+        if self.backend == "process":
+            self._spawn("dispatcher", self._dispatch_loop)
+            self._spawn("writer", self._write_loop)
+            return
+
+        self._spawn("reader", self._read_loop)
+        for i in range(self.renderers):
+            self._spawn(f"renderer-{i}", self._render_loop)
+        for i in range(self.encoders):
+            self._spawn(f"encoder-{i}", self._encode_loop)
+        self._spawn("writer", self._write_loop)
+
+    def _spawn(self, name, target):
+        thread = threading.Thread(target=target, name=f"export-{name}", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def wait(self, timeout=None):
+        """等待流水线结束，返回是否已结束"""
+        return self._finished.wait(timeout)
+
+    def cancel(self):
+        """取消导出，已编码或已提交给子进程的图片仍会写完"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_time[stage] += seconds
+
+    def _track_worker(self, cost):
+        name = threading.current_thread().name
+        with self._lock:
+            self.worker_peak[name] = max(self.worker_peak.get(name, 0), cost)
+
+    def _fail(self, index, error, cost=0):
+        if cost:
+            self.memory.release(cost)
+        with self._lock:
+            self.failed += 1
+            self.errors.append((self.journal.items[index]["path"], error))
+        print(f"导出图片 {self.journal.items[index]['path']} 失败: {error}")
+
+    def _record_target_size(self, index, trials, fits):
+        with self._lock:
+            self.size_stats["images"] += 1
+            self.size_stats["trials"] += trials
+            if not fits:
+                self.size_stats["over_budget"] += 1
+        if not fits:
+            print(f"图片 {self.journal.items[index]['path']} 在最低质量下仍超出目标大小")
+
+    def _stage_exit(self, stage, downstream, count):
+        """同一阶段的最后一个线程退出时，向下游每个线程发送结束标记"""
+        with self._lock:
+            self._active[stage] -= 1
+            last = self._active[stage] == 0
+        if last:
+            for _ in range(count):
+                downstream.put(_STOP)
+
+    def settings_for(self, index):
+        """第 index 张图片实际使用的设置：基础设置合并任务日志中记录的单张图片覆盖设置"""
+        return self.settings.with_overrides(self.journal.items[index].get("overrides"))
+
+    def export_order(self):
+        """导出顺序：水印文本相同的图片相邻，共用缓存中的文本图层
+
+        覆盖了图层设置的图片的文本可能是列表，其他图片是字符串，按字符串形式排序。
+        """
+        items = self.journal.items
+        return sorted(range(len(items)), key=lambda index: str(items[index].get("text") or ""))
+
+    def _read_loop(self):
+        try:
+            for index in self.export_order():
+                item = self.journal.items[index]
+                if self.cancelled:
+                    break
+                if self.journal.is_done(index):
+                    continue
+                scheduler.yield_to(EXPORT, self._cancelled)
+
+                start = time.perf_counter()
+                try:
+                    img = self.images.get(item["path"])
+                    if img is not None and img.original_image is not None:
+                        size, mode = img.original_image.size, img.original_image.mode
+                    elif self.tiled_threshold is not None:
+                        # 只读取一次文件头，据此选择分块处理或整幅处理
+                        header = open_unbounded(item["path"])
+                        if header.size[0] * header.size[1] >= self.tiled_threshold:
+                            img = TiledSource(item["path"], header=header)
+                            size, mode = img.size, img.mode
+                        else:
+                            img = WatermarkImage(item["path"], load=False)
+                            size, mode = img.read_header(header)
+                    else:
+                        img = WatermarkImage(item["path"], load=False)
+                        size, mode = img.read_header()
+                except Exception as e:
+                    self._fail(index, e)
+                    continue
+                self._add_time("read", time.perf_counter() - start)
+
+                if isinstance(img, TiledSource):
+                    # 大图分块处理，由渲染线程按行带读取
+                    cost = img.estimate_working_set(self.output_format)
+                    if not self.memory.acquire(cost, self._cancelled):
+                        break
+                    self._track_worker(cost)
+                    self.render_queue.put((index, img, cost))
+                    continue
+
+                # 估算内存占用，预算不足时等待在途图片完成
+                cost = estimate_working_set(size, mode, self.output_format)
+                if not self.memory.acquire(cost, self._cancelled):
+                    if img.source is not None:
+                        img.release_image()
+                    break
+
+                start = time.perf_counter()
+                try:
+                    if img.original_image is None:
+                        img.decode_image()
+                except Exception as e:
+                    img.release_image()
+                    self._fail(index, e, cost)
+                    continue
+                self._track_worker(cost)
+                self._add_time("read", time.perf_counter() - start)
+
+                self.render_queue.put((index, img, cost))
+        finally:
+            for _ in range(self.renderers):
+                self.render_queue.put(_STOP)
+
+    def _dispatch_loop(self):
+        """进程池模式：父进程只读取文件头做内存准入，解码、渲染、编码和写入都在子进程中完成"""
+        pool = ProcessExportPool(self.processes, self.settings, self.encode_options)
+        # 限制已提交但未完成的任务数，保证暂停能及时生效
+        slots = threading.BoundedSemaphore(self.processes * 2)
+        try:
+            order = self.export_order()
+            for position, index in enumerate(order):
+                item = self.journal.items[index]
+                if self.cancelled:
+                    break
+                if self.journal.is_done(index):
+                    continue
+                scheduler.yield_to(EXPORT, self._cancelled)
+
+                start = time.perf_counter()
+                try:
+                    # 只读取一次文件头，据此选择分块处理或整幅处理
+                    if self.tiled_threshold is None:
+                        header = Image.open(item["path"])
+                        tiled = False
+                    else:
+                        header = open_unbounded(item["path"])
+                        tiled = header.size[0] * header.size[1] >= self.tiled_threshold
+                    if tiled:
+                        cost = TiledSource(item["path"], header=header).estimate_working_set(self.output_format)
+                    else:
+                        with header:
+                            cost = estimate_working_set(header.size, header.mode, self.output_format)
+                except Exception as e:
+                    self._fail(index, e)
+                    continue
+                self._add_time("read", time.perf_counter() - start)
+
+                if not self.memory.acquire(cost, self._cancelled):
+                    break
+                slots.acquire()
+                if tiled:
+                    with self._lock:
+                        self.tiled_count += 1
+
+                try:
+                    future = pool.submit(index, item["path"], self.journal.output_path(index),
+                                         self.journal.temp_path(index), tiled, item.get("text"),
+                                         item.get("overrides"))
+                except Exception as e:
+                    # 进程池已不可用（如子进程启动失败），剩余的图片都无法导出，全部记为失败
+                    slots.release()
+                    self._fail(index, e, cost)
+                    for rest in order[position + 1:]:
+                        if not self.journal.is_done(rest):
+                            self._fail(rest, e)
+                    break
+                future.add_done_callback(
+                    lambda f, index=index, cost=cost: self._on_worker_done(f, index, cost, slots)
+                )
+        finally:
+            pool.shutdown(wait=True)
+            self.write_queue.put(_STOP)
+
+    def _on_worker_done(self, future, index, cost, slots):
+        slots.release()
+        try:
+            result = future.result()
+        except Exception as e:
+            self._fail(index, e, cost)
+            return
+
+        with self._lock:
+            pid = result["pid"]
+            if result["peak_rss"] is not None:
+                self.worker_rss[pid] = max(self.worker_rss.get(pid, 0), result["peak_rss"])
+            self.stage_time["render"] += result["elapsed"]
+        if result["trials"]:
+            self._record_target_size(index, result["trials"], result["fits"])
+        # 子进程已经写入输出文件，由写入线程记录完成
+        self.write_queue.put((index, None, cost))
+
+    def _render_loop(self):
+        while True:
+            task = self.render_queue.get()
+            if task is _STOP:
+                break
+            index, img, cost = task
+            if self.cancelled:
+                # 与正常渲染一样只释放流水线自己解码的图片
+                if not isinstance(img, TiledSource) and img.path not in self.images:
+                    img.release_image()
+                self.memory.release(cost)
+                continue
+
+            scheduler.yield_to(EXPORT, self._cancelled)
+            start = time.perf_counter()
+            self._track_worker(cost)
+            if isinstance(img, TiledSource):
+                self._render_tiled(index, img, cost)
+                self._add_time("render", time.perf_counter() - start)
+                continue
+            try:
+                result = img.apply_watermark(self.settings_for(index), self.journal.items[index].get("text"))
+            except Exception as e:
+                self._fail(index, e, cost)
+                continue
+            finally:
+                # 只释放流水线自己解码的图片
+                if img.path not in self.images:
+                    img.release_image()
+            self._add_time("render", time.perf_counter() - start)
+
+            # 元数据随图片记录传递给编码线程，不需要重新读取源文件
+            self.encode_queue.put((index, (result, metadata_options(img.metadata, self.metadata_policy)), cost))
+        self._stage_exit("render", self.encode_queue, self.encoders)
+
+    def _render_tiled(self, index, source, cost):
+        """分块渲染：PNG 边渲染边写入输出文件，其他格式拼成完整的帧后交给编码线程"""
+        with self._lock:
+            self.tiled_count += 1
+        try:
+            metadata = metadata_options(source.metadata, self.metadata_policy)
+            text = self.journal.items[index].get("text")
+            settings = self.settings_for(index)
+            if self.output_format == "png":
+                self.journal.stream_output(
+                    index, lambda f: render_tiled(source, settings, self.output_format, f,
+                                                  self.preset, metadata, text)
+                )
+                frame = None
+            else:
+                frame = render_tiled(source, settings, self.output_format, text=text)
+        except Exception as e:
+            self._fail(index, e, cost)
+            return
+
+        if frame is None:
+            # 已经写入磁盘，只需由写入线程记录完成
+            self.write_queue.put((index, None, cost))
+        else:
+            self.encode_queue.put((index, (frame, metadata), cost))
+
+    def _encode_loop(self):
+        while True:
+            task = self.encode_queue.get()
+            if task is _STOP:
+                break
+            index, (result, metadata), cost = task
+            if self.cancelled:
+                self.memory.release(cost)
+                continue
+
+            start = time.perf_counter()
+            self._track_worker(cost)
+            try:
+                data, trials, fits = encode_for_export(result, self.encode_options, metadata, self.size_estimator)
+                if trials:
+                    self._record_target_size(index, trials, fits)
+            except Exception as e:
+                self._fail(index, e, cost)
+                continue
+            self._add_time("encode", time.perf_counter() - start)
+
+            self.write_queue.put((index, data, cost))
+        self._stage_exit("encode", self.write_queue, 1)
+
+    def _write_loop(self):
+        try:
+            while True:
+                task = self.write_queue.get()
+                if task is _STOP:
+                    break
+                index, data, cost = task
+
+                start = time.perf_counter()
+                try:
+                    if data is not None:
+                        self.journal.write_output(index, data)
+                    self.journal.mark_done(index)
+                except Exception as e:
+                    self._fail(index, e, cost)
+                    continue
+                self.memory.release(cost)
+                self._add_time("write", time.perf_counter() - start)
+
+                with self._lock:
+                    self.completed += 1
+        finally:
+            self.elapsed = time.perf_counter() - self._start_time
+            self.peak_rss = peak_rss()
+            self._finished.set()
+
+    def stats(self):
+        """返回各阶段耗时和队列占用统计"""
+        with self._lock:
+            stage_time = dict(self.stage_time)
+            worker_peak = dict(self.worker_peak)
+            worker_rss = dict(self.worker_rss)
+        elapsed = self.elapsed if self._finished.is_set() else time.perf_counter() - self._start_time
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "tiled": self.tiled_count,
+            "target_size": dict(self.size_stats, target=self.target_size),
+            "text_layers": {"rendered": text_layers.misses - self._layer_base[0],
+                            "reused": text_layers.hits - self._layer_base[1]},
+            "elapsed": elapsed,
+            "throughput": self.completed / elapsed if elapsed > 0 else 0.0,
+            "stage_time": stage_time,
+            "queues": {q.name: q.stats() for q in (self.render_queue, self.encode_queue, self.write_queue)},
+            "memory": {
+                "budget": self.memory.limit,
+                "peak_in_flight": self.memory.peak,
+                "admission_wait": self.memory.wait_time,
+                "worker_peak": worker_peak,
+                "worker_rss": worker_rss,
+                "peak_rss": self.peak_rss if self._finished.is_set() else peak_rss(),
+            },
+        }
+
+    def format_stats(self):
+        """将统计信息格式化为便于阅读的文本"""
+        stats = self.stats()
+        lines = [
+            f"完成 {stats['completed']} 张（分块处理 {stats['tiled']} 张），失败 {stats['failed']} 张，"
+            f"耗时 {stats['elapsed']:.1f} 秒，{stats['throughput']:.2f} 张/秒",
+            "阶段累计耗时: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in stats["stage_time"].items()),
+        ]
+        for name, q in stats["queues"].items():
+            lines.append(
+                f"队列 {name}: 容量 {q['capacity']}，平均占用 {q['mean']:.1f}，最大 {q['max']}，"
+                f"背压等待 {q['put_wait']:.1f}s，空闲等待 {q['get_wait']:.1f}s"
+            )
+
+        layers = stats["text_layers"]
+        if layers["rendered"]:
+            # 进程池模式下文本图层在子进程中渲染，这里没有统计
+            lines.append(f"文本图层: 渲染 {layers['rendered']} 个，复用 {layers['reused']} 次")
+
+        target = stats["target_size"]
+        if target["target"] and target["images"]:
+            lines.append(
+                f"目标大小 {target['target'] / 1024:.0f}KB: 平均每张试编码 {target['trials'] / target['images']:.2f} 次，"
+                f"{target['over_budget']} 张在最低质量下仍超出"
+            )
+
+        mb = 1024 * 1024
+        memory = stats["memory"]
+        lines.append(
+            f"内存: 预算 {memory['budget'] / mb:.0f}MB，在途峰值 {memory['peak_in_flight'] / mb:.0f}MB，"
+            f"准入等待 {memory['admission_wait']:.1f}s"
+            + (f"，进程峰值RSS {memory['peak_rss'] / mb:.0f}MB" if memory["peak_rss"] else "")
+        )
+        for name, peak in sorted(memory["worker_peak"].items()):
+            lines.append(f"  {name}: 单张峰值 {peak / mb:.0f}MB")
+        for pid, rss in sorted(memory["worker_rss"].items()):
+            lines.append(f"  子进程 {pid}: 峰值RSS {rss / mb:.0f}MB")
+        return "\n".join(lines)
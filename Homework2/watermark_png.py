@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageChops
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG 颜色类型
+_COLOR_TYPES = {"RGB": 2, "RGBA": 6}
+
+# PNG 扫描线滤波类型
+FILTER_TYPES = {"none": 0, "sub": 1, "up": 2}
+
+# 压缩预设：压缩级别和扫描线滤波
+PNG_PRESETS = {
+    "fast": {"compress_level": 1, "filter": "none"},
+    "balanced": {"compress_level": 6, "filter": "up"},
+    "small": {"compress_level": 9, "filter": "up"},
+}
+
+# deflate 窗口大小，每个压缩块用前一块末尾的数据作为字典
+_WINDOW_SIZE = 32768
+
+# 每个并行压缩块的目标大小
+CHUNK_SIZE = 1 << 20
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """所有PNG编码共用一个压缩线程池，zlib 压缩时会释放GIL"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="png-deflate")
+        return _executor
+
+
+def write_chunk(f, chunk_type, data):
+    """写入一个PNG数据块"""
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+
+def _write_header(f, size, mode, metadata=None):
+    f.write(PNG_SIGNATURE)
+    # 8位深度，无隔行扫描
+    write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, _COLOR_TYPES[mode], 0, 0, 0))
+
+    # 元数据块必须位于图像数据之前
+    metadata = metadata or {}
+    if metadata.get("icc_profile"):
+        write_chunk(f, b"iCCP", b"ICC Profile\x00\x00" + zlib.compress(metadata["icc_profile"]))
+    exif = metadata.get("exif")
+    if exif:
+        # eXIf 块只包含 TIFF 结构，不带 "Exif\0\0" 头
+        write_chunk(f, b"eXIf", exif[6:] if exif.startswith(b"Exif\x00\x00") else exif)
+    if metadata.get("xmp"):
+        # 未压缩的 iTXt 块：关键字、压缩标志、压缩方法、语言、翻译后的关键字
+        write_chunk(f, b"iTXt", b"XML:com.adobe.xmp\x00\x00\x00\x00\x00" + metadata["xmp"])
+
+
+def zlib_header(level):
+    """生成与压缩级别对应的zlib流头"""
+    if level <= 1:
+        flevel = 0
+    elif level <= 5:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78  # deflate，32K窗口
+    flg = flevel << 6
+    flg += 31 - (cmf * 256 + flg) % 31
+    return bytes((cmf, flg))
+
+
+def adler32_combine(adler1, adler2, len2):
+    """合并两段数据的adler32校验值（与zlib的adler32_combine相同）"""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + base - rem
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def filter_band(band, filter_name, prev_row=None):
+    """对行带做扫描线滤波，返回每行前带滤波类型字节的数据
+
+    prev_row 为行带上方的一行，Up 滤波需要用到；为None时视为全0。
+    滤波用 ImageChops 按像素做模256减法，8位 RGB/RGBA 中一个像素正好是 Sub 滤波的字节偏移。
+    """
+    width, height = band.size
+    if filter_name == "sub":
+        # 左侧像素，第一列视为0
+        reference = Image.new(band.mode, band.size)
+        reference.paste(band.crop((0, 0, width - 1, height)), (1, 0))
+        band = ImageChops.subtract_modulo(band, reference)
+    elif filter_name == "up":
+        # 上一行，第一行使用 prev_row
+        reference = Image.new(band.mode, band.size)
+        if prev_row is not None:
+            reference.paste(prev_row, (0, 0))
+        reference.paste(band.crop((0, 0, width, height - 1)), (0, 1))
+        band = ImageChops.subtract_modulo(band, reference)
+
+    # 用单通道图像在每行前插入滤波类型字节，避免Python逐行拼接
+    stride = width * len(band.mode)
+    rows = Image.new("L", (stride + 1, height), FILTER_TYPES[filter_name])
+    rows.paste(Image.frombytes("L", (stride, height), band.tobytes()), (1, 0))
+    return rows.tobytes()
+
+
+def _deflate_chunk(data, level, zdict=None, final=False):
+    """压缩一个独立的块，输出可以直接拼接成一个deflate流"""
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    out = compressor.compress(data)
+    # 非最后一块用同步刷新结束，保证字节对齐且不设置结束标志
+    out += compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return out, zlib.adler32(data), len(data)
+
+
+def _encode_rows(image, y0, y1, filter_name, level, final):
+    """滤波并压缩 [y0, y1) 行，同时重新滤波前面若干行作为压缩字典"""
+    width = image.width
+    row_bytes = width * len(image.mode) + 1
+    dict_rows = 0 if y0 == 0 else min(y0, -(-_WINDOW_SIZE // row_bytes))
+    start = y0 - dict_rows
+
+    prev_row = image.crop((0, start - 1, width, start)) if start > 0 else None
+    data = filter_band(image.crop((0, start, width, y1)), filter_name, prev_row)
+
+    split = dict_rows * row_bytes
+    zdict = data[max(0, split - _WINDOW_SIZE):split]
+    return _deflate_chunk(data[split:], level, zdict, final)
+
+
+def encode_png(image, compress_level=6, filter_name="up", chunk_size=CHUNK_SIZE, metadata=None):
+    """多线程编码PNG，按行分块并行滤波和压缩，再拼接成一个合法的IDAT流
+
+    metadata 为 {"exif", "icc_profile", "xmp"}，写入对应的 eXIf、iCCP、iTXt 块。
+    """
+    if image.mode not in _COLOR_TYPES:
+        image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+    width, height = image.size
+    row_bytes = width * len(image.mode) + 1
+    rows_per_chunk = max(1, chunk_size // row_bytes)
+
+    ranges = [(y0, min(y0 + rows_per_chunk, height)) for y0 in range(0, height, rows_per_chunk)]
+    executor = _get_executor()
+    futures = [
+        executor.submit(_encode_rows, image, y0, y1, filter_name, compress_level, y1 == height)
+        for y0, y1 in ranges
+    ]
+
+    writer = _ByteSink()
+    _write_header(writer, image.size, image.mode, metadata)
+    idat = _IdatWriter(writer, compress_level)
+    for future in futures:
+        idat.add(*future.result())
+    idat.close()
+    write_chunk(writer, b"IEND", b"")
+    return writer.getvalue()
+
+
+class _ByteSink:
+    """收集写入的字节"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(data)
+
+    def getvalue(self):
+        return b"".join(self._parts)
+
+
+class _IdatWriter:
+    """按顺序拼接压缩块，计算整体adler32并切分为IDAT数据块"""
+
+    def __init__(self, f, level, idat_size=1 << 16):
+        self.f = f
+        self.idat_size = idat_size
+        self.adler = 1
+        self._buffer = bytearray(zlib_header(level))
+
+    def add(self, compressed, adler, length):
+        self.adler = adler32_combine(self.adler, adler, length)
+        self._write(compressed)
+
+    def _write(self, data, final=False):
+        self._buffer += data
+        while len(self._buffer) >= self.idat_size or (final and self._buffer):
+            chunk = bytes(self._buffer[:self.idat_size])
+            del self._buffer[:self.idat_size]
+            write_chunk(self.f, b"IDAT", chunk)
+
+    def close(self, final_block=b""):
+        self._write(final_block + struct.pack(">I", self.adler), final=True)
+
+
+class PngStreamWriter:
+    """按行带流式写出PNG，整幅图像不需要同时存在于内存中
+
+    每个行带在共用线程池中并行压缩，按顺序写出，最多同时压缩 max_pending 个行带。
+    """
+
+    def __init__(self, f, size, mode, compress_level=6, filter_name="up", max_pending=None, metadata=None):
+        if mode not in _COLOR_TYPES:
+            raise ValueError(f"不支持的PNG模式: {mode}")
+        self.f = f
+        self.width, self.height = size
+        self.mode = mode
+        self.compress_level = compress_level
+        self.filter_name = filter_name
+        self.max_pending = max_pending or (os.cpu_count() or 2)
+        self.rows_written = 0
+
+        self._prev_row = None
+        self._dict_tail = b""
+        self._pending = deque()
+
+        _write_header(f, size, mode, metadata)
+        self._idat = _IdatWriter(f, compress_level)
+
+    def write_band(self, band):
+        """写入一个行带，行带宽度必须与图像一致"""
+        if band.mode != self.mode:
+            band = band.convert(self.mode)
+        if band.width != self.width:
+            raise ValueError("行带宽度与图像宽度不一致")
+
+        data = filter_band(band, self.filter_name, self._prev_row)
+        self._prev_row = band.crop((0, band.height - 1, self.width, band.height))
+        zdict = self._dict_tail
+        self._dict_tail = (zdict + data)[-_WINDOW_SIZE:]
+
+        self._pending.append(_get_executor().submit(_deflate_chunk, data, self.compress_level, zdict))
+        self.rows_written += band.height
+        while len(self._pending) > self.max_pending:
+            self._idat.add(*self._pending.popleft().result())
+
+    def close(self):
+        """结束压缩流并写入IEND"""
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG行数不完整: {self.rows_written}/{self.height}")
+        while self._pending:
+            self._idat.add(*self._pending.popleft().result())
+        # 空的最后一个deflate块，结束压缩流
+        final_block = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush()
+        self._idat.close(final_block)
+        write_chunk(self.f, b"IEND", b"")
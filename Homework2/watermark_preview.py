@@ -2,23 +2,56 @@
 # -*- coding: utf-8 -*-
 
 from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QSizePolicy
-from PyQt5.QtGui import QPainter, QPixmap, QColor, QPen, QCursor, QMouseEvent
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize, pyqtSignal
+from PyQt5.QtGui import QPainter, QPixmap, QColor, QFont, QPen, QCursor, QMouseEvent
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF, QSize, pyqtSignal
+
+import copy
+import json
+import math
+
+from watermark_render import scaled_overlay, render_text_layer, render_image_layer, layer_box
+from watermark_auto import auto_settings
+from watermark_pyramid import TILE_SIZE, TilePyramid, tile_level
 
 class WatermarkPreview(QWidget):
-    # 自定义信号，用于通知位置变化
-    position_changed = pyqtSignal(QPoint)
+    # 拖拽结束时发出各水印中心在图片中的归一化坐标，键与设置中的字段相同
+    position_changed = pyqtSignal(dict)
+    
+    # 水印叠加层的最大渲染像素数，显示区域更大时渲染后再放大绘制
+    MAX_RENDER_PIXELS = 2 * 1000 * 1000
+    
+    # 滚轮每格的缩放倍数和最大放大倍数（显示像素/原图像素）
+    ZOOM_STEP = 1.25
+    MAX_ZOOM = 8
     
     def __init__(self, settings):
         super().__init__()
         self.settings = settings
+        # 当前图片实际使用的设置，开启自动模式时按图片内容调整
+        self.effective = settings
+        # 当前图片解析变量后的水印文本，None 表示直接使用设置中的文本
+        self.text = None
         self.image = None
         self.pixmap = None
-        self.scaled_pixmap = None
+        self.scaled_pixmap = None  # (缓存键, 缩放到显示大小的图片)
+        self.drag_background = None  # 拖拽时不变的部分
         self.dragging = False
         self.drag_start_pos = QPoint()
-        self.watermark_pos = QPoint()
+        self.drag_offset = QPoint()  # 拖拽中水印相对原位置的偏移（控件像素），只用于绘制
         self.watermark_rect = QRect()
+        self.image_rect = QRect()
+        # 缩放比例（显示像素/原图像素），None 表示适应窗口
+        self.zoom = None
+        # 放大时图片左上角在控件中的位置
+        self.view_origin = QPointF()
+        # 放大超过缩小图分辨率时按需生成的原图图块
+        self.pyramid = None
+        self.panning = False
+        self.pan_start_pos = QPoint()
+        # 水印叠加层缓存：{"below": 其他图层, "top": 当前编辑的水印}，值为 (缓存键, QPixmap, 渲染尺寸上的区域)
+        self.overlays = {}
+        # 最近一次绘制时各叠加层在控件中的区域
+        self.overlay_targets = {}
         
         # 设置鼠标跟踪
         self.setMouseTracking(True)
@@ -35,44 +68,150 @@ class WatermarkPreview(QWidget):
     def set_image(self, image):
         """设置要预览的图像"""
         self.image = image
+        self.zoom = None
+        if self.pyramid is not None:
+            self.pyramid.close()
+            self.pyramid = None
         if image and image.pixmap:
             self.pixmap = image.pixmap
             self.update()
     
-    def update(self):
-        """更新预览"""
-        super().update()
-    
     def paintEvent(self, event):
         """绘制预览"""
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
         painter.setRenderHint(QPainter.SmoothPixmapTransform)
         
+        if self.dragging and self.drag_background is not None:
+            # 拖拽时背景不变，只在需要更新的区域内绘制缓存的背景和水印
+            painter.drawPixmap(0, 0, self.drag_background)
+            painter.setClipRect(self.image_rect)
+            self.draw_cached_overlay(painter, "top", self.drag_offset)
+            return
+        
+        if not self.draw_background(painter):
+            return
+        
+        # 应用水印预览
+        self.draw_watermark_preview(painter)
+    
+    def draw_background(self, painter):
+        """绘制背景和缩放后的图片，没有图片时返回False"""
         # 填充背景
         painter.fillRect(self.rect(), QColor(240, 240, 240))
         
         if not self.pixmap or self.pixmap.isNull():
             # 没有图片，显示提示
             painter.drawText(self.rect(), Qt.AlignCenter, "请导入图片")
+            return False
+        
+        self.layout_image()
+        if self.zoom is not None:
+            self.draw_zoomed_image(painter)
+            return True
+        
+        # 缩放后的图片按图片和显示大小缓存，只在切换图片或改变窗口大小时重新缩放
+        scaled_size = self.image_rect.size()
+        key = (self.pixmap.cacheKey(), scaled_size.width(), scaled_size.height())
+        if self.scaled_pixmap is None or self.scaled_pixmap[0] != key:
+            self.scaled_pixmap = (key, self.pixmap.scaled(scaled_size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        painter.drawPixmap(self.image_rect.topLeft(), self.scaled_pixmap[1])
+        return True
+    
+    def layout_image(self):
+        """计算图片在控件中的区域：适应窗口时居中显示，放大时按缩放比例和视图位置"""
+        if self.zoom is None:
+            # 计算缩放后的图片大小，保持宽高比，并居中
+            scaled_size = self.calculate_scaled_size()
+            x = (self.width() - scaled_size.width()) // 2
+            y = (self.height() - scaled_size.height()) // 2
+            self.image_rect = QRect(x, y, scaled_size.width(), scaled_size.height())
+        else:
+            self.clamp_view()
+            self.image_rect = QRect(round(self.view_origin.x()), round(self.view_origin.y()),
+                                    round(self.image.size[0] * self.zoom), round(self.image.size[1] * self.zoom))
+    
+    def clamp_view(self):
+        """限制视图位置：图片比控件小的方向居中，否则不露出图片以外的区域"""
+        x, y = self.view_origin.x(), self.view_origin.y()
+        width, height = self.image.size[0] * self.zoom, self.image.size[1] * self.zoom
+        if width <= self.width():
+            x = (self.width() - width) / 2
+        else:
+            x = min(0, max(self.width() - width, x))
+        if height <= self.height():
+            y = (self.height() - height) / 2
+        else:
+            y = min(0, max(self.height() - height, y))
+        self.view_origin = QPointF(x, y)
+    
+    def set_zoom(self, zoom, anchor=None):
+        """设置缩放比例，anchor 处的图片内容保持不动；zoom 不大于适应窗口的比例时恢复适应窗口"""
+        if not self.image or not self.image.size or not self.pixmap or self.pixmap.isNull():
             return
-        
-        # 计算缩放后的图片大小，保持宽高比
-        scaled_size = self.calculate_scaled_size()
-        
-        # 计算居中位置
-        x = (self.width() - scaled_size.width()) // 2
-        y = (self.height() - scaled_size.height()) // 2
-        
-        # 绘制缩放后的图片
-        self.scaled_pixmap = self.pixmap.scaled(scaled_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        painter.drawPixmap(x, y, self.scaled_pixmap)
-        
-        # 保存图片区域
-        self.image_rect = QRect(x, y, scaled_size.width(), scaled_size.height())
-        
-        # 应用水印预览
-        self.draw_watermark_preview(painter)
+        self.layout_image()
+        fit = self.calculate_scaled_size().width() / self.image.size[0]
+        if zoom is None or zoom <= fit:
+            self.zoom = None
+        else:
+            if anchor is None:
+                anchor = self.rect().center()
+            scale = self.display_scale()
+            point = QPointF(anchor) - QPointF(self.image_rect.topLeft())
+            self.zoom = min(zoom, self.MAX_ZOOM)
+            self.view_origin = QPointF(anchor) - point * (self.zoom / scale)
+        self.update()
+    
+    def display_scale(self):
+        """当前显示比例（显示像素/原图像素）"""
+        return self.image_rect.width() / self.image.size[0]
+    
+    def visible_image_box(self):
+        """控件中可见部分对应的原图区域 (left, top, right, bottom)"""
+        visible = self.image_rect.intersected(self.rect())
+        scale = self.display_scale()
+        return ((visible.left() - self.view_origin.x()) / scale, (visible.top() - self.view_origin.y()) / scale,
+                (visible.left() + visible.width() - self.view_origin.x()) / scale,
+                (visible.top() + visible.height() - self.view_origin.y()) / scale)
+    
+    def draw_zoomed_image(self, painter):
+        """放大时只绘制可见部分；超过缩小图的分辨率时叠加原图图块，尚未生成的图块先显示缩小图"""
+        if not self.image_rect.intersects(self.rect()):
+            return
+        # 放大到1:1以上时不做平滑，能看清原图的像素
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, self.zoom < 1)
+        box = self.visible_image_box()
+        target = QRectF(self.view_origin.x() + box[0] * self.zoom, self.view_origin.y() + box[1] * self.zoom,
+                        (box[2] - box[0]) * self.zoom, (box[3] - box[1]) * self.zoom)
+        pixmap_scale = self.pixmap.width() / self.image.size[0]
+        painter.drawPixmap(target, self.pixmap, QRectF(box[0] * pixmap_scale, box[1] * pixmap_scale,
+                                                       (box[2] - box[0]) * pixmap_scale,
+                                                       (box[3] - box[1]) * pixmap_scale))
+        
+        level = tile_level(self.zoom)
+        if 1 / 2 ** level <= pixmap_scale:
+            # 缩小图的分辨率已经足够
+            return
+        if self.pyramid is None:
+            self.pyramid = TilePyramid(self.image.path)
+            self.pyramid.tile_ready.connect(self.update)
+        factor = 2 ** level * self.zoom
+        for (col, row), tile in self.pyramid.tiles(level, box).items():
+            left, top, right, bottom = self.pyramid.tile_box(level, col, row)
+            painter.drawImage(QRectF(self.view_origin.x() + left * factor, self.view_origin.y() + top * factor,
+                                     (right - left) * factor, (bottom - top) * factor), tile)
+    
+    def build_drag_background(self):
+        """拖拽开始时将背景、图片和下面的水印图层绘制到一个 QPixmap，拖拽过程中直接使用"""
+        ratio = self.devicePixelRatioF()
+        background = QPixmap(round(self.width() * ratio), round(self.height() * ratio))
+        background.setDevicePixelRatio(ratio)
+        painter = QPainter(background)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.draw_background(painter)
+        painter.setClipRect(self.image_rect)
+        self.draw_cached_overlay(painter, "below")
+        painter.end()
+        return background
     
     def calculate_scaled_size(self):
         """计算缩放后的图片大小"""
@@ -96,9 +235,91 @@ class WatermarkPreview(QWidget):
         
         return QSize(scaled_width, scaled_height)
     
+    def watermark_text(self):
+        """当前编辑的水印解析变量后的文本"""
+        if self.text is None:
+            return self.settings.text_content
+        return self.text[-1] if isinstance(self.text, list) else self.text
+    
+    def split_layers(self):
+        """将实际使用的设置分为其他图层和当前编辑的水印，返回 (下面的图层, 当前水印)
+
+        每一项为 (设置, 文本)，没有其他图层时下面的图层为None。
+        """
+        extra = self.effective.extra_layers
+        texts = self.text if isinstance(self.text, list) else None
+        below = None
+        if extra:
+            below_settings = copy.copy(extra[-1])
+            below_settings.extra_layers = extra[:-1]
+            below = (below_settings, texts[:-1] if texts else None)
+        top_settings = copy.copy(self.effective)
+        top_settings.extra_layers = []
+        return below, (top_settings, self.watermark_text())
+    
+    def render_geometry(self):
+        """叠加层的渲染尺寸和区域，返回 (尺寸, 区域)
+        
+        适应窗口时为预览中图片的显示大小，超过 MAX_RENDER_PIXELS 时按比例缩小，区域为None（整幅图片）。
+        放大时最多按原图大小渲染；渲染尺寸超过 MAX_RENDER_PIXELS 时只渲染可见部分，
+        区域向外对齐到 TILE_SIZE，平移不超出该区域时不重新渲染。
+        """
+        if self.zoom is None:
+            width, height = self.image_rect.width(), self.image_rect.height()
+            scale = min(1.0, math.sqrt(self.MAX_RENDER_PIXELS / (width * height)))
+            return (max(1, round(width * scale)), max(1, round(height * scale))), None
+        
+        scale = min(self.zoom, 1.0)
+        size = (max(1, round(self.image.size[0] * scale)), max(1, round(self.image.size[1] * scale)))
+        if size[0] * size[1] <= self.MAX_RENDER_PIXELS:
+            return size, None
+        visible = self.visible_image_box()
+        box = (int(visible[0] * scale) // TILE_SIZE * TILE_SIZE, int(visible[1] * scale) // TILE_SIZE * TILE_SIZE,
+               min(size[0], -(-math.ceil(visible[2] * scale) // TILE_SIZE) * TILE_SIZE),
+               min(size[1], -(-math.ceil(visible[3] * scale) // TILE_SIZE) * TILE_SIZE))
+        return size, box
+    
+    def draw_overlay(self, painter, name, settings, text, offset=QPoint()):
+        """用导出时的渲染代码生成预览大小的水印叠加层并绘制，返回其在控件中的区域
+
+        叠加层按设置、文本和尺寸缓存，设置不变时重绘只需绘制缓存的 QPixmap。
+        """
+        size, box = self.render_geometry()
+        key = (json.dumps(settings.to_dict(), sort_keys=True), json.dumps(text), size, box, self.image.size)
+        cached = self.overlays.get(name)
+        if cached is None or cached[0] != key:
+            overlay = scaled_overlay(self.image.size, size, settings, text, box)
+            if overlay is None:
+                cached = (key, None, QRect())
+            else:
+                layer, x, y = overlay
+                cached = (key, QPixmap.fromImage(self.image.pil_to_qimage(layer)),
+                          QRect(x, y, layer.width, layer.height))
+            self.overlays[name] = cached
+        
+        _, pixmap, box = cached
+        if pixmap is None:
+            self.overlay_targets.pop(name, None)
+            return QRect()
+        # 渲染尺寸换算到控件坐标
+        scale_x = self.image_rect.width() / size[0]
+        scale_y = self.image_rect.height() / size[1]
+        self.overlay_targets[name] = QRect(self.image_rect.left() + round(box.x() * scale_x),
+                                           self.image_rect.top() + round(box.y() * scale_y),
+                                           round(box.width() * scale_x), round(box.height() * scale_y))
+        return self.draw_cached_overlay(painter, name, offset)
+    
+    def draw_cached_overlay(self, painter, name, offset=QPoint()):
+        """按上次绘制时的区域绘制缓存的叠加层，不检查设置是否改变"""
+        target = self.overlay_targets.get(name)
+        if target is None:
+            return QRect()
+        painter.drawPixmap(target.translated(offset), self.overlays[name][1])
+        return target
+    
     def draw_watermark_preview(self, painter):
-        """绘制水印预览"""
-        if not self.image or not self.image_rect.isValid():
+        """绘制水印预览，与导出使用同一套渲染代码，在预览大小上合成"""
+        if not self.image or not self.image.size or not self.image_rect.isValid():
             return
         
         # 保存当前状态
@@ -107,198 +328,88 @@ class WatermarkPreview(QWidget):
         # 限制绘制区域在图片范围内
         painter.setClipRect(self.image_rect)
         
-        # 计算水印位置
-        position = self.settings.position
-        img_rect = self.image_rect
+        # 自动位置和自动对比度按当前图片的缩略图调整，与导出时的结果一致
+        self.effective = auto_settings(self.settings, self.image.size, lambda: self.image.analysis, self.text)
+        below, top = self.split_layers()
         
-        # 文本水印
-        if self.settings.text_content.strip():
-            self.draw_text_watermark_preview(painter, img_rect, position)
+        # 其他水印图层在当前编辑的水印下面
+        if below is not None:
+            self.draw_overlay(painter, "below", *below)
+        else:
+            self.overlay_targets.pop("below", None)
         
-        # 图片水印
-        if self.settings.watermark_image_path:
-            self.draw_image_watermark_preview(painter, img_rect, position)
+        # 拖拽时当前水印整体平移，不重新渲染
+        offset = self.drag_offset if self.dragging else QPoint()
+        rect = self.draw_overlay(painter, "top", *top, offset=offset)
+        if not self.dragging:
+            # 平铺的水印覆盖整幅图片，不能拖拽
+            self.watermark_rect = QRect() if top[0].tiled else rect
         
         # 恢复状态
         painter.restore()
     
-    def draw_text_watermark_preview(self, painter, img_rect, position):
-        """绘制文本水印预览"""
-        text = self.settings.text_content
-        if not text.strip():
-            return
-        
-        # 设置字体
-        font = self.settings.font
-        painter.setFont(font)
-        
-        # 设置颜色和透明度
-        color = self.settings.text_color
-        opacity = self.settings.text_opacity / 100.0
-        color.setAlpha(int(255 * opacity))
-        painter.setPen(color)
-        
-        # 计算文本大小
-        fm = painter.fontMetrics()
-        text_width = fm.horizontalAdvance(text)
-        text_height = fm.height()
-        
-        # 计算位置
-        x, y = self.calculate_position(img_rect, text_width, text_height, position)
-        
-        # 保存当前位置用于拖拽
-        self.watermark_rect = QRect(x, y, text_width, text_height)
-        
-        # 应用旋转
-        if self.settings.rotation != 0:
-            painter.save()
-            
-            # 设置旋转中心
-            center_x = x + text_width / 2
-            center_y = y + text_height / 2
-            painter.translate(center_x, center_y)
-            painter.rotate(self.settings.rotation)
-            painter.translate(-center_x, -center_y)
-            
-            # 绘制文本阴影
-            if self.settings.text_shadow:
-                shadow_color = QColor(0, 0, 0, int(128 * opacity))
-                painter.setPen(shadow_color)
-                painter.drawText(x + 2, y + 2 + fm.ascent(), text)
-            
-            # 绘制文本描边
-            if self.settings.text_outline:
-                outline_color = QColor(0, 0, 0, int(200 * opacity))
-                painter.setPen(outline_color)
-                outline_width = self.settings.outline_width
-                for dx in range(-outline_width, outline_width + 1):
-                    for dy in range(-outline_width, outline_width + 1):
-                        if dx != 0 or dy != 0:
-                            painter.drawText(x + dx, y + dy + fm.ascent(), text)
-            
-            # 绘制文本
-            painter.setPen(color)
-            painter.drawText(x, y + fm.ascent(), text)
-            
-            painter.restore()
-        else:
-            # 绘制文本阴影
-            if self.settings.text_shadow:
-                shadow_color = QColor(0, 0, 0, int(128 * opacity))
-                painter.setPen(shadow_color)
-                painter.drawText(x + 2, y + 2 + fm.ascent(), text)
-            
-            # 绘制文本描边
-            if self.settings.text_outline:
-                outline_color = QColor(0, 0, 0, int(200 * opacity))
-                painter.setPen(outline_color)
-                outline_width = self.settings.outline_width
-                for dx in range(-outline_width, outline_width + 1):
-                    for dy in range(-outline_width, outline_width + 1):
-                        if dx != 0 or dy != 0:
-                            painter.drawText(x + dx, y + dy + fm.ascent(), text)
-            
-            # 绘制文本
-            painter.setPen(color)
-            painter.drawText(x, y + fm.ascent(), text)
+    def dragged_position(self):
+        """拖拽后各水印中心在图片中的归一化坐标 {设置字段: 值}，没有移动时返回None
+        
+        文本和图片水印分别计算，两者的相对位置与拖拽时一致。从水印在原图上旋转后的实际区域
+        （不受预览裁剪和缩放的影响）加上拖拽的偏移计算，与导出时放置图层的方式相同。
+        """
+        if self.drag_offset.isNull():
+            return None
+        _, (settings, text) = self.split_layers()
+        width, height = self.image.size
+        scale = width / self.image_rect.width()
+        centers = {}
+        for prefix, layer in (("", render_text_layer(self.image.size, settings, text)),
+                              ("image_", render_image_layer(self.image.size, settings))):
+            if layer is None:
+                continue
+            box = layer_box(*layer)
+            center_x = box[0] + (box[2] - box[0]) // 2 + self.drag_offset.x() * scale
+            center_y = box[1] + (box[3] - box[1]) // 2 + self.drag_offset.y() * scale
+            centers[prefix + "position_x"] = min(max(center_x / width, 0.0), 1.0)
+            centers[prefix + "position_y"] = min(max(center_y / height, 0.0), 1.0)
+        if not centers:
+            return None
+        # 只有一种水印时另一种使用同一中心，之后添加时出现在拖拽到的位置
+        for prefix, other in (("", "image_"), ("image_", "")):
+            for axis in ("x", "y"):
+                centers.setdefault(f"{prefix}position_{axis}", centers.get(f"{other}position_{axis}"))
+        return centers
     
-    def draw_image_watermark_preview(self, painter, img_rect, position):
-        """绘制图片水印预览"""
-        if not self.settings.watermark_image_path:
-            return
-        
-        # 加载水印图片
-        watermark_pixmap = QPixmap(self.settings.watermark_image_path)
-        if watermark_pixmap.isNull():
+    def wheelEvent(self, event):
+        """滚轮缩放，以鼠标所在位置为中心"""
+        if not self.image or not self.image.size or not self.image_rect.isValid() or self.dragging:
             return
-        
-        # 调整大小
-        if self.settings.keep_aspect_ratio:
-            # 按比例缩放
-            scale = self.settings.watermark_image_scale
-            new_width = int(watermark_pixmap.width() * scale)
-            new_height = int(watermark_pixmap.height() * scale)
-        else:
-            # 自由调整大小
-            new_width = self.settings.watermark_image_width
-            new_height = self.settings.watermark_image_height
-        
-        watermark_pixmap = watermark_pixmap.scaled(new_width, new_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        
-        # 计算位置
-        x, y = self.calculate_position(img_rect, watermark_pixmap.width(), watermark_pixmap.height(), position)
-        
-        # 保存当前位置用于拖拽
-        self.watermark_rect = QRect(x, y, watermark_pixmap.width(), watermark_pixmap.height())
-        
-        # 设置透明度
-        opacity = self.settings.watermark_image_opacity / 100.0
-        painter.setOpacity(opacity)
-        
-        # 应用旋转
-        if self.settings.rotation != 0:
-            painter.save()
-            
-            # 设置旋转中心
-            center_x = x + watermark_pixmap.width() / 2
-            center_y = y + watermark_pixmap.height() / 2
-            painter.translate(center_x, center_y)
-            painter.rotate(self.settings.rotation)
-            painter.translate(-center_x, -center_y)
-            
-            # 绘制水印图片
-            painter.drawPixmap(x, y, watermark_pixmap)
-            
-            painter.restore()
-        else:
-            # 绘制水印图片
-            painter.drawPixmap(x, y, watermark_pixmap)
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.set_zoom(self.display_scale() * self.ZOOM_STEP ** steps, event.pos())
+        event.accept()
     
-    def calculate_position(self, img_rect, width, height, position):
-        """计算水印位置"""
-        if self.dragging:
-            # 如果正在拖拽，使用拖拽位置
-            return self.watermark_pos.x(), self.watermark_pos.y()
-        
-        # 根据预设位置计算
-        padding = 10  # 边距
-        
-        if position == "左上":
-            x = img_rect.left() + padding
-            y = img_rect.top() + padding
-        elif position == "上中":
-            x = img_rect.left() + (img_rect.width() - width) // 2
-            y = img_rect.top() + padding
-        elif position == "右上":
-            x = img_rect.right() - width - padding
-            y = img_rect.top() + padding
-        elif position == "左中":
-            x = img_rect.left() + padding
-            y = img_rect.top() + (img_rect.height() - height) // 2
-        elif position == "中心":
-            x = img_rect.left() + (img_rect.width() - width) // 2
-            y = img_rect.top() + (img_rect.height() - height) // 2
-        elif position == "右中":
-            x = img_rect.right() - width - padding
-            y = img_rect.top() + (img_rect.height() - height) // 2
-        elif position == "左下":
-            x = img_rect.left() + padding
-            y = img_rect.bottom() - height - padding
-        elif position == "下中":
-            x = img_rect.left() + (img_rect.width() - width) // 2
-            y = img_rect.bottom() - height - padding
-        else:  # 右下
-            x = img_rect.right() - width - padding
-            y = img_rect.bottom() - height - padding
-        
-        return x, y
+    def keyPressEvent(self, event):
+        """0 适应窗口，1 按原图大小显示"""
+        if event.key() == Qt.Key_0:
+            self.set_zoom(None)
+        elif event.key() == Qt.Key_1:
+            self.set_zoom(1.0)
+        else:
+            super().keyPressEvent(event)
     
     def mousePressEvent(self, event):
         """鼠标按下事件"""
-        if event.button() == Qt.LeftButton and self.watermark_rect.contains(event.pos()):
+        if event.button() == Qt.MiddleButton or (
+                event.button() == Qt.LeftButton and self.zoom is not None
+                and not self.watermark_rect.contains(event.pos())):
+            # 放大时拖拽水印以外的区域或按住中键平移视图
+            self.panning = True
+            self.pan_start_pos = event.pos()
+            self.setCursor(QCursor(Qt.SizeAllCursor))
+            event.accept()
+        elif event.button() == Qt.LeftButton and self.watermark_rect.contains(event.pos()):
             self.dragging = True
             self.drag_start_pos = event.pos()
-            self.watermark_pos = self.watermark_rect.topLeft()
+            self.drag_offset = QPoint()
+            self.drag_background = self.build_drag_background()
             self.setCursor(QCursor(Qt.ClosedHandCursor))
             event.accept()
         else:
@@ -306,43 +417,23 @@ class WatermarkPreview(QWidget):
     
     def mouseMoveEvent(self, event):
         """鼠标移动事件"""
-        if self.dragging:
-            # 计算偏移量
-            delta = event.pos() - self.drag_start_pos
-            
-            # 降低拖拽灵敏度，使水印移动速度与鼠标移动速度匹配
-            # 使用0.5的系数来减缓水印移动速度
-            scaled_delta = QPoint(int(delta.x() * 0.5), int(delta.y() * 0.5))
-            new_pos = self.watermark_pos + scaled_delta
-            
-            # 获取水印宽度和高度
-            watermark_width = self.watermark_rect.width()
-            watermark_height = self.watermark_rect.height()
-            
-            # 确保水印不会完全移出图片范围
-            x = new_pos.x()
-            y = new_pos.y()
-            
-            # 限制水印左边界不超出图片左边界
-            if x < self.image_rect.left():
-                x = self.image_rect.left()
-            # 限制水印右边界不超出图片右边界
-            elif x + watermark_width > self.image_rect.right():
-                x = self.image_rect.right() - watermark_width
-            
-            # 限制水印上边界不超出图片上边界
-            if y < self.image_rect.top():
-                y = self.image_rect.top()
-            # 限制水印下边界不超出图片下边界
-            elif y + watermark_height > self.image_rect.bottom():
-                y = self.image_rect.bottom() - watermark_height
-            
-            # 更新水印位置
-            self.watermark_pos = QPoint(x, y)
+        if self.panning:
+            self.view_origin += QPointF(event.pos() - self.pan_start_pos)
+            self.pan_start_pos = event.pos()
             self.update()
+            event.accept()
+        elif self.dragging:
+            # 水印跟随鼠标移动，偏移量从按下鼠标时算起
+            rect = self.watermark_rect.translated(event.pos() - self.drag_start_pos)
             
-            # 更新拖拽起始位置，使拖拽更加平滑
-            self.drag_start_pos = event.pos()
+            # 限制水印不超出图片范围
+            x = max(self.image_rect.left(), min(rect.left(), self.image_rect.right() + 1 - rect.width()))
+            y = max(self.image_rect.top(), min(rect.top(), self.image_rect.bottom() + 1 - rect.height()))
+            
+            # 只重绘水印移动前后覆盖的区域
+            old_rect = self.watermark_rect.translated(self.drag_offset)
+            self.drag_offset = QPoint(x, y) - self.watermark_rect.topLeft()
+            self.update(old_rect.united(self.watermark_rect.translated(self.drag_offset)))
             
             event.accept()
         elif self.watermark_rect.contains(event.pos()):
@@ -355,12 +446,21 @@ class WatermarkPreview(QWidget):
     
     def mouseReleaseEvent(self, event):
         """鼠标释放事件"""
-        if event.button() == Qt.LeftButton and self.dragging:
+        if self.panning and event.button() in (Qt.LeftButton, Qt.MiddleButton):
+            self.panning = False
+            self.setCursor(QCursor(Qt.ArrowCursor))
+            event.accept()
+        elif event.button() == Qt.LeftButton and self.dragging:
             self.dragging = False
+            self.drag_background = None
             self.setCursor(QCursor(Qt.ArrowCursor))
             
-            # 发送位置变化信号
-            self.position_changed.emit(self.watermark_pos)
+            # 发送归一化的新位置，由设置保存，导出时按图片尺寸换算
+            position = self.dragged_position()
+            self.drag_offset = QPoint()
+            if position is not None:
+                self.position_changed.emit(position)
+            self.update()
             
             event.accept()
         else:
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from watermark_tiles import TiledSource, open_unbounded
+from watermark_scheduler import PREVIEW, CancelToken, scheduler
+
+# 图块边长（所在层级的像素）
+TILE_SIZE = 256
+
+# 最多缓存的图块数，每块约256KB
+MAX_TILES = 256
+
+# JPEG 解码时最多缩小的倍数
+_JPEG_MAX_REDUCE = 8
+
+
+def tile_level(scale):
+    """显示比例（显示像素/原图像素）对应的层级
+
+    层级 k 的分辨率为原图的 1/2^k，选择不低于显示分辨率的最小层级。
+    """
+    if scale >= 1:
+        return 0
+    return int(math.floor(math.log2(1 / scale)))
+
+
+class TilePyramid(QObject):
+    """放大预览超大图片时按需生成的图块金字塔
+
+    只生成和缓存可见的图块，作为预览任务交给调度器按行生成，每生成一行发出一次 tile_ready。
+    可局部解码的格式只读取图块所在的行；JPEG 按层级缩小解码（最多 1/8），
+    其他格式需要完整解码，解码结果只保留最近使用的一份。
+    """
+
+    tile_ready = pyqtSignal()
+
+    def __init__(self, path, max_tiles=MAX_TILES):
+        super().__init__()
+        self.source = TiledSource(path)
+        self.size = self.source.size
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()  # (层级, 列, 行) -> QImage
+        self._wanted = set()  # 当前可见、尚未生成的图块
+        self._pending = set()  # 已提交生成的 (层级, 行)
+        self._decoded = None  # 无法局部解码时的 (请求的缩小倍数, 实际的缩小倍数, 解码后的图像)
+        self._lock = threading.Lock()
+        # 多个预览线程同时需要整幅解码时只解码一次，其他线程等待并复用结果
+        self._decode_lock = threading.Lock()
+        self._token = CancelToken()
+
+    def level_size(self, level):
+        factor = 2 ** level
+        return -(-self.size[0] // factor), -(-self.size[1] // factor)
+
+    def tile_box(self, level, col, row):
+        """图块在所在层级中的区域"""
+        width, height = self.level_size(level)
+        return (col * TILE_SIZE, row * TILE_SIZE,
+                min((col + 1) * TILE_SIZE, width), min((row + 1) * TILE_SIZE, height))
+
+    def visible_tiles(self, level, box):
+        """覆盖原图区域 box 的图块 [(列, 行)]"""
+        factor = 2 ** level
+        width, height = self.level_size(level)
+        col0 = max(0, int(box[0] / factor) // TILE_SIZE)
+        row0 = max(0, int(box[1] / factor) // TILE_SIZE)
+        col1 = min((width - 1) // TILE_SIZE, max(0, math.ceil(box[2] / factor) - 1) // TILE_SIZE)
+        row1 = min((height - 1) // TILE_SIZE, max(0, math.ceil(box[3] / factor) - 1) // TILE_SIZE)
+        return [(col, row) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+    def tiles(self, level, box):
+        """返回覆盖原图区域 box 的已生成图块 {(列, 行): QImage}，缺少的图块提交到后台生成
+
+        之前请求但已不可见的图块不再生成。
+        """
+        visible = self.visible_tiles(level, box)
+        ready = {}
+        missing = {}
+        with self._lock:
+            self._wanted = set()
+            for col, row in visible:
+                key = (level, col, row)
+                tile = self._tiles.get(key)
+                if tile is not None:
+                    self._tiles.move_to_end(key)
+                    ready[(col, row)] = tile
+                else:
+                    self._wanted.add(key)
+                    missing.setdefault(row, []).append(col)
+            rows = [row for row in missing if (level, row) not in self._pending]
+            self._pending.update((level, row) for row in rows)
+        for row in rows:
+            scheduler.submit(PREVIEW, self._render_row, level, row, token=self._token)
+        return ready
+
+    def _render_row(self, level, row):
+        """生成一行中仍然需要的图块"""
+        try:
+            with self._lock:
+                cols = sorted(col for lv, col, r in self._wanted if lv == level and r == row)
+            if not cols:
+                return
+            boxes = [self.tile_box(level, col, row) for col in cols]
+            left, right = boxes[0][0], boxes[-1][2]
+            region = self._read_region(level, (left, boxes[0][1], right, boxes[0][3]))
+
+            for col, box in zip(cols, boxes):
+                tile = region.crop((box[0] - left, 0, box[2] - left, region.height))
+                if tile.mode != "RGBA":
+                    tile = tile.convert("RGBA")
+                qimage = QImage(tile.tobytes("raw", "RGBA"), tile.width, tile.height,
+                                QImage.Format_RGBA8888).copy()
+                with self._lock:
+                    self._tiles[(level, col, row)] = qimage
+                    self._wanted.discard((level, col, row))
+                    if len(self._tiles) > self.max_tiles:
+                        self._tiles.popitem(last=False)
+            self.tile_ready.emit()
+        except Exception as e:
+            print(f"生成预览图块失败: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard((level, row))
+
+    def _read_region(self, level, box):
+        """读取层级 level 中 box 区域的图像"""
+        factor = 2 ** level
+        width, height = self.size
+        full_box = (box[0] * factor, box[1] * factor, min(box[2] * factor, width), min(box[3] * factor, height))
+        size = (box[2] - box[0], box[3] - box[1])
+
+        if self.source.streamable:
+            # 只读取图块所在的行
+            band = self.source.read_band(full_box[1], full_box[3])
+            region = band.crop((full_box[0], 0, full_box[2], band.height))
+        else:
+            reduce, image = self._decode(level)
+            region = image.crop(tuple(value // reduce for value in full_box))
+        if region.size != size:
+            region = region.resize(size, Image.BOX)
+        return region
+
+    def _decode(self, level):
+        """无法局部解码时解码整幅图片，JPEG 按层级缩小解码，返回 (缩小倍数, 图像)"""
+        reduce = 1
+        if self.source.format == "JPEG":
+            reduce = min(2 ** level, _JPEG_MAX_REDUCE)
+        with self._decode_lock:
+            if self._decoded is not None and self._decoded[0] == reduce:
+                return self._decoded[1:]
+            # 先释放上一份解码结果，峰值内存只有一份
+            self._decoded = None
+            im = open_unbounded(self.source.path)
+            try:
+                if reduce > 1:
+                    im.draft("RGB", (-(-self.size[0] // reduce), -(-self.size[1] // reduce)))
+                im.load()
+                # draft 选择的缩小倍数可能小于请求的倍数
+                self._decoded = (reduce, round(self.size[0] / im.size[0]), im.copy())
+            finally:
+                im.close()
+            return self._decoded[1:]
+
+    def close(self):
+        scheduler.cancel(self._token)
+        with self._lock:
+            self._tiles.clear()
+            self._wanted.clear()
+        self._decoded = None
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter
+
+# 距离图片边缘的边距
+PADDING = 10
+
+# 拖拽后的自定义位置，文本按 position_x、position_y，图片按 image_position_x、image_position_y 中的归一化中心坐标放置
+CUSTOM_POSITION = "自定义"
+
+# 相对大小的分档比例
+SIZE_BUCKET_RATIO = 1.04
+
+# FreeType 字体对象不能在线程间共享，每个线程单独缓存
+_thread_local = threading.local()
+
+
+def load_font(font_size):
+    """加载指定字号的字体，每个线程只加载一次"""
+    fonts = getattr(_thread_local, "fonts", None)
+    if fonts is None:
+        fonts = _thread_local.fonts = {}
+    font = fonts.get(font_size)
+    if font is None:
+        try:
+            # 这里需要根据系统找到对应的字体文件
+            # 简单起见，这里使用默认字体
+            font = ImageFont.truetype("Arial", font_size)
+        except Exception:
+            # 使用默认字体
+            font = ImageFont.load_default()
+        fonts[font_size] = font
+    return font
+
+
+def anchor_position(image_size, width, height, position, center=(0.5, 0.5)):
+    """根据九宫格位置计算水印左上角坐标
+
+    position 为 CUSTOM_POSITION 时按 center 放置：center 为水印中心在图片中的归一化坐标，
+    每张图片只需乘以图片尺寸，水印不超出图片范围。
+    """
+    img_width, img_height = image_size
+
+    if position == CUSTOM_POSITION:
+        x = round(center[0] * img_width) - width // 2
+        y = round(center[1] * img_height) - height // 2
+        x = max(0, min(x, img_width - width))
+        y = max(0, min(y, img_height - height))
+    elif position == "左上":
+        x, y = PADDING, PADDING
+    elif position == "上中":
+        x = (img_width - width) // 2
+        y = PADDING
+    elif position == "右上":
+        x = img_width - width - PADDING
+        y = PADDING
+    elif position == "左中":
+        x = PADDING
+        y = (img_height - height) // 2
+    elif position == "中心":
+        x = (img_width - width) // 2
+        y = (img_height - height) // 2
+    elif position == "右中":
+        x = img_width - width - PADDING
+        y = (img_height - height) // 2
+    elif position == "左下":
+        x = PADDING
+        y = img_height - height - PADDING
+    elif position == "下中":
+        x = (img_width - width) // 2
+        y = img_height - height - PADDING
+    else:  # 右下
+        x = img_width - width - PADDING
+        y = img_height - height - PADDING
+
+    return x, y
+
+
+def place_layer(image_size, layer, width, height, position, center):
+    """旋转后的图层左上角坐标
+
+    九宫格位置按旋转前的大小 width×height 对齐，旋转后中心不变；
+    自定义位置按旋转后图层的实际大小放置，整个图层不超出图片范围。
+    """
+    if position == CUSTOM_POSITION:
+        return anchor_position(image_size, layer.width, layer.height, position, center)
+    x, y = anchor_position(image_size, width, height, position)
+    return x + width // 2 - layer.width // 2, y + height // 2 - layer.height // 2
+
+
+def rotate_layer(layer, center_x, center_y, rotation):
+    """绕指定中心旋转图层，返回旋转后的图层及其左上角坐标"""
+    if rotation == 0:
+        return layer, center_x - layer.width // 2, center_y - layer.height // 2
+    rotated = layer.rotate(rotation, resample=Image.BICUBIC, expand=True)
+    return rotated, center_x - rotated.width // 2, center_y - rotated.height // 2
+
+
+class LayerCache:
+    """线程安全的LRU图层缓存，缓存的图层只读，可以在多个渲染线程间共享"""
+
+    def __init__(self, max_layers=64):
+        self.max_layers = max_layers
+        self.hits = 0
+        self.misses = 0
+        self._layers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """返回 key 对应的图层，不存在时调用 build() 渲染"""
+        with self._lock:
+            value = self._layers.get(key)
+            if value is not None:
+                self._layers.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        # 在锁外渲染，其他线程可以同时读取缓存
+        value = build()
+        with self._lock:
+            self._layers[key] = value
+            if len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+        return value
+
+
+# 文本水印图层缓存，文本相同的图片共用同一个图层
+text_layers = LayerCache()
+
+# 图片水印原图及缩放后的图层缓存
+watermark_sources = LayerCache(8)
+image_layers = LayerCache(32)
+
+# 平铺模式的单元图块，以及与输出图片同样大小的图案（占用内存较多，只保留少量）
+tile_layers = LayerCache(16)
+pattern_layers = LayerCache(2)
+
+# 多个水印图层重叠时预先合并的图层
+stack_layers = LayerCache(4)
+
+# 按预览大小缩小后的图层
+scaled_layer_cache = LayerCache(32)
+
+
+def quantize_size(size):
+    """将相对大小换算出的像素尺寸量化到按对数刻度划分的分档
+
+    相邻两档相差约4%，分辨率各不相同的一批图片只需渲染少数几种尺寸的图层。
+    """
+    if size <= 1:
+        return 1
+    return round(SIZE_BUCKET_RATIO ** round(math.log(size, SIZE_BUCKET_RATIO)))
+
+
+def text_font_size(image_size, settings):
+    """文本水印在指定尺寸图片上的字号"""
+    if settings.text_relative_size:
+        return quantize_size(min(image_size) * settings.text_size_ratio / 100)
+    return settings.font.pointSize()
+
+
+def soft_shadow_extent(settings):
+    """柔和阴影超出文本的范围：偏移加上约3倍模糊半径"""
+    return (max(abs(settings.shadow_offset_x), abs(settings.shadow_offset_y))
+            + math.ceil(settings.shadow_blur * 3))
+
+
+def _shadow_key(settings):
+    if not (settings.text_shadow and settings.shadow_soft):
+        return None
+    return (settings.shadow_blur, settings.shadow_offset_x, settings.shadow_offset_y,
+            settings.shadow_color.getRgb())
+
+
+def _text_layer_key(text, font_size, settings):
+    color = settings.text_color
+    return (text, font_size, (color.red(), color.green(), color.blue()),
+            settings.text_opacity, settings.text_shadow, settings.text_outline,
+            settings.outline_width, settings.rotation, _shadow_key(settings))
+
+
+def _add_soft_shadow(layer, settings):
+    """在未旋转的文本图层下面加上模糊的阴影
+
+    阴影由文本（含描边）的透明通道偏移后模糊得到，文本的不透明度已包含在透明通道中。
+    只模糊留有足够边距的文本图块，开销与图片尺寸无关。
+    """
+    color = settings.shadow_color
+    mask = Image.new("L", layer.size, 0)
+    mask.paste(layer.getchannel("A"), (settings.shadow_offset_x, settings.shadow_offset_y))
+    if settings.shadow_blur > 0:
+        mask = mask.filter(ImageFilter.GaussianBlur(settings.shadow_blur))
+    if color.alpha() < 255:
+        mask = mask.point([value * color.alpha() // 255 for value in range(256)])
+    shadow = Image.new("RGBA", layer.size, (color.red(), color.green(), color.blue(), 0))
+    shadow.putalpha(mask)
+    shadow.alpha_composite(layer)
+    return shadow
+
+
+def _build_text_layer(text, font_size, settings):
+    """渲染旋转后的文本图层，返回 (图层, 文本宽度, 文本高度)
+
+    图层以文本中心为中心，内容只与字号有关，与图片尺寸和水印位置无关。
+    """
+    font = load_font(font_size)
+
+    # 获取文本颜色和透明度
+    r, g, b = settings.text_color.red(), settings.text_color.green(), settings.text_color.blue()
+    opacity = settings.text_opacity / 100.0
+    text_color = (r, g, b, int(255 * opacity))
+
+    # 计算文本大小
+    left, top, right, bottom = font.getbbox(text)
+    text_width = right - left
+    text_height = bottom - top
+
+    # 阴影和描边向外扩展的范围
+    soft_shadow = settings.text_shadow and settings.shadow_soft
+    pad = 0
+    if settings.text_outline:
+        pad = settings.outline_width
+    if soft_shadow:
+        pad += soft_shadow_extent(settings)
+    elif settings.text_shadow:
+        pad = max(pad, 2)
+
+    # 图层以旋转中心为中心，旋转后位置不变
+    half_width = max(text_width // 2 - left + pad, right + pad - text_width // 2)
+    half_height = max(text_height // 2 - top + pad, bottom + pad - text_height // 2)
+    layer = Image.new("RGBA", (half_width * 2, half_height * 2), (255, 255, 255, 0))
+    d = ImageDraw.Draw(layer)
+
+    # 文本在图层中的坐标
+    tx = half_width - text_width // 2
+    ty = half_height - text_height // 2
+
+    if settings.text_shadow and not soft_shadow:
+        # 添加阴影
+        shadow_offset = 2
+        d.text((tx + shadow_offset, ty + shadow_offset), text, font=font, fill=(0, 0, 0, int(128 * opacity)))
+
+    if settings.text_outline:
+        # 添加描边
+        outline_width = settings.outline_width
+        for dx in range(-outline_width, outline_width + 1):
+            for dy in range(-outline_width, outline_width + 1):
+                if dx != 0 or dy != 0:
+                    d.text((tx + dx, ty + dy), text, font=font, fill=(0, 0, 0, int(200 * opacity)))
+
+    # 绘制主文本
+    d.text((tx, ty), text, font=font, fill=text_color)
+
+    if soft_shadow:
+        # 柔和阴影与文本一起缓存，同样的文本只模糊一次
+        layer = _add_soft_shadow(layer, settings)
+
+    layer, _, _ = rotate_layer(layer, 0, 0, settings.rotation)
+    return layer, text_width, text_height
+
+
+def render_text_layer(image_size, settings, text=None):
+    """渲染文本水印图层，返回 (图层, x, y)，图层只覆盖水印所在区域
+
+    text 为按图片解析好的水印文本，None 表示使用设置中的文本。
+    """
+    if text is None:
+        text = settings.text_content
+    if not text.strip():
+        return None
+
+    font_size = text_font_size(image_size, settings)
+    layer, text_width, text_height = text_layers.get(
+        _text_layer_key(text, font_size, settings), lambda: _build_text_layer(text, font_size, settings)
+    )
+
+    # 计算位置
+    x, y = place_layer(image_size, layer, text_width, text_height, settings.position,
+                       (settings.position_x, settings.position_y))
+    return layer, x, y
+
+
+def _open_watermark(path):
+    with Image.open(path) as watermark:
+        return watermark.convert("RGBA")
+
+
+def watermark_image_size(image_size, source_size, settings):
+    """图片水印缩放后的大小"""
+    source_width, source_height = source_size
+    if settings.image_relative_size:
+        # 长边按图片短边的百分比计算，量化到分档
+        long_edge = quantize_size(min(image_size) * settings.image_size_ratio / 100)
+        scale = long_edge / max(source_width, source_height)
+        new_width = round(source_width * scale)
+        new_height = round(source_height * scale)
+    elif settings.keep_aspect_ratio:
+        # 按比例缩放
+        scale = settings.watermark_image_scale
+        new_width = int(source_width * scale)
+        new_height = int(source_height * scale)
+    else:
+        # 自由调整大小
+        new_width = settings.watermark_image_width
+        new_height = settings.watermark_image_height
+    return max(1, new_width), max(1, new_height)
+
+
+def _build_image_layer(watermark, size, settings):
+    """缩放、调整透明度并旋转图片水印"""
+    watermark = watermark.resize(size, Image.LANCZOS)
+
+    # 调整透明度
+    if settings.watermark_image_opacity < 100:
+        alpha = watermark.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(settings.watermark_image_opacity / 100.0)
+        watermark.putalpha(alpha)
+
+    layer, _, _ = rotate_layer(watermark, 0, 0, settings.rotation)
+    return layer
+
+
+def render_image_layer(image_size, settings):
+    """渲染图片水印图层，返回 (图层, x, y)"""
+    path = settings.watermark_image_path
+    if not path:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    # 加载水印图片，文件修改后重新加载
+    watermark = watermark_sources.get((path, mtime), lambda: _open_watermark(path))
+
+    # 调整大小
+    width, height = watermark_image_size(image_size, watermark.size, settings)
+    layer = image_layers.get(
+        (path, mtime, width, height, settings.watermark_image_opacity, settings.rotation),
+        lambda: _build_image_layer(watermark, (width, height), settings)
+    )
+
+    # 计算位置
+    x, y = place_layer(image_size, layer, width, height, settings.position,
+                       (settings.image_position_x, settings.image_position_y))
+    return layer, x, y
+
+
+def render_anchored_layers(image_size, settings, text=None):
+    """渲染一个水印图层中放在九宫格位置上的图片和文本，返回 [(图层, x, y)]"""
+    layers = []
+
+    # 先图片水印，再文本水印
+    try:
+        image_layer = render_image_layer(image_size, settings)
+    except Exception as e:
+        print(f"应用图片水印失败: {e}")
+        image_layer = None
+    if image_layer:
+        layers.append(image_layer)
+
+    text_layer = render_text_layer(image_size, settings, text)
+    if text_layer:
+        layers.append(text_layer)
+
+    return layers
+
+
+def _build_tile(layers, spacing):
+    """将各水印图层叠放在单元中心，四周按间距留白"""
+    width = max(layer.width for layer in layers)
+    height = max(layer.height for layer in layers)
+    tile = Image.new("RGBA", (max(1, round(width * (1 + spacing / 100))),
+                              max(1, round(height * (1 + spacing / 100)))), (0, 0, 0, 0))
+    for layer in layers:
+        tile.alpha_composite(layer, ((tile.width - layer.width) // 2, (tile.height - layer.height) // 2))
+    return tile
+
+
+def render_tile(image_size, settings, text=None):
+    """平铺模式的单元图块，没有水印时返回None"""
+    layers = [layer for layer, _, _ in render_anchored_layers(image_size, settings, text)]
+    if not layers:
+        return None
+    # 缓存值中保留组成图层的引用，这些对象的 id 在缓存期间不会被复用
+    key = (tuple(id(layer) for layer in layers), settings.tile_spacing)
+    return tile_layers.get(key, lambda: (layers, _build_tile(layers, settings.tile_spacing)))[1]
+
+
+def pattern_region(tile, size, box):
+    """平铺图案中 box 区域的部分
+
+    相邻两行单元错开半个单元，形成斜向排列；图案以图片中心对齐，
+    每行先拼接成一条再整条粘贴，粘贴次数与行数成正比。
+    """
+    width, height = size
+    left, top, right, bottom = box
+    center_x = (width - tile.width) // 2
+    center_y = (height - tile.height) // 2
+    origin_y = center_y % tile.height
+    center_row = center_y // tile.height
+
+    row = Image.new("RGBA", (right - left + tile.width * 2, tile.height), (0, 0, 0, 0))
+    for x in range(0, row.width, tile.width):
+        row.paste(tile, (x, 0))
+
+    region = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    for r in range((top - origin_y) // tile.height, (bottom - 1 - origin_y) // tile.height + 1):
+        offset = tile.width // 2 if (r - center_row) % 2 else 0
+        # 该行第一个单元在区域左边界之前的位置
+        x = (center_x + offset - left) % tile.width - tile.width
+        region.paste(row, (x, origin_y + r * tile.height - top))
+    return region
+
+
+def pattern_band(tile, size, y0, y1):
+    """平铺图案中第 y0 到 y1 行的部分"""
+    return pattern_region(tile, size, (0, y0, size[0], y1))
+
+
+def tile_pattern(tile, size):
+    """整幅图片大小的平铺图案，同一尺寸的图片共用"""
+    return pattern_layers.get((id(tile), size), lambda: (tile, pattern_band(tile, size, 0, size[1])))[1]
+
+
+def render_stack(image_size, settings, text=None, patterns=True):
+    """按叠加顺序渲染图层栈中的所有水印，返回 [(图层, x, y)]
+
+    text 为按图片解析好的水印文本；有多个水印图层时为与 settings.layer_stack() 对应的列表，
+    为字符串时只用于最上面的图层。patterns 为 False 时平铺图层返回 (单元图块, None, None)，
+    由调用方自行生成图案。
+    """
+    stack = settings.layer_stack()
+    texts = text if isinstance(text, list) else [None] * (len(stack) - 1) + [text]
+    layers = []
+    for layer_settings, layer_text in zip(stack, texts):
+        if not layer_settings.tiled:
+            layers += render_anchored_layers(image_size, layer_settings, layer_text)
+            continue
+        tile = render_tile(image_size, layer_settings, layer_text)
+        if tile is None:
+            continue
+        if patterns:
+            # 平铺图案覆盖整幅图片，只需合成一次
+            layers.append((tile_pattern(tile, image_size), 0, 0))
+        else:
+            layers.append((tile, None, None))
+    return layers
+
+
+def _boxes_intersect(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _flatten(parts, box):
+    canvas = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+    for layer, x, y in parts:
+        composite_layer(canvas, layer, x, y, origin=(box[0], box[1]))
+    return canvas
+
+
+def flatten_layers(layers, image_size):
+    """将区域重叠的图层预先合成为一个图层，图片上每块区域只需合成一次
+
+    区域互不重叠的图层仍分别合成，合成的像素数不超过各图层区域之和。
+    合并结果按组成图层及其位置缓存，同样尺寸的一批图片共用。
+    """
+    if len(layers) < 2:
+        return layers
+
+    groups = []  # [(合并后的区域, [图层序号])]
+    for i, (layer, x, y) in enumerate(layers):
+        box = layer_box(layer, x, y, image_size)
+        if box[0] >= box[2] or box[1] >= box[3]:
+            continue
+        members = [i]
+        merged = True
+        while merged:
+            merged = False
+            for group in groups:
+                if _boxes_intersect(group[0], box):
+                    groups.remove(group)
+                    box = (min(box[0], group[0][0]), min(box[1], group[0][1]),
+                           max(box[2], group[0][2]), max(box[3], group[0][3]))
+                    members = group[1] + members
+                    merged = True
+                    break
+        groups.append((box, sorted(members)))
+
+    result = []
+    for box, members in sorted(groups, key=lambda group: group[1][0]):
+        if len(members) == 1:
+            result.append(layers[members[0]])
+            continue
+        parts = [layers[i] for i in members]
+        # 缓存值中保留组成图层的引用，这些对象的 id 在缓存期间不会被复用
+        key = tuple((id(layer), x, y) for layer, x, y in parts) + (box,)
+        canvas = stack_layers.get(key, lambda: (parts, _flatten(parts, box)))[1]
+        result.append((canvas, box[0], box[1]))
+    return result
+
+
+def render_layers(image_size, settings, text=None):
+    """渲染图层栈中的所有水印，重叠的图层合并为一个，返回 [(图层, x, y)]"""
+    return flatten_layers(render_stack(image_size, settings, text), image_size)
+
+
+def _scaled_tile(tile, full_size, size):
+    if tuple(size) == tuple(full_size):
+        return tile
+    scale = size[0] / full_size[0]
+    tile_size = (max(1, round(tile.width * scale)), max(1, round(tile.height * scale)))
+    return tile_layers.get((id(tile), tile_size), lambda: (tile, tile.resize(tile_size, Image.LANCZOS)))[1]
+
+
+def scaled_layers(full_size, size, settings, text=None, box=None):
+    """将原图大小的水印图层按 size 缩小，返回 [(图层, x, y)]
+
+    预览和导出使用同一套图层渲染：导出直接合成原图大小的图层，预览合成缩小后的图层，
+    效果与在原图上合成后再缩小一致。平铺图层的图块先缩小再拼接成图案；
+    box 为 size 坐标系中需要的区域（如放大预览时的可见部分），平铺图案只生成该区域。
+    """
+    if tuple(size) == tuple(full_size) and box is None:
+        return render_stack(full_size, settings, text)
+
+    scale_x = size[0] / full_size[0]
+    scale_y = size[1] / full_size[1]
+    layers = []
+    for layer, x, y in render_stack(full_size, settings, text, patterns=False):
+        if x is None:
+            tile = _scaled_tile(layer, full_size, size)
+            if box is None:
+                layers.append((tile_pattern(tile, size), 0, 0))
+            else:
+                layers.append((pattern_region(tile, size, box), box[0], box[1]))
+            continue
+        if tuple(size) == tuple(full_size):
+            layers.append((layer, x, y))
+            continue
+        layer_size = (max(1, round(layer.width * scale_x)), max(1, round(layer.height * scale_y)))
+        # 缓存值中保留原图层的引用，其 id 在缓存期间不会被复用
+        scaled = scaled_layer_cache.get((id(layer), layer_size),
+                                        lambda: (layer, layer.resize(layer_size, Image.LANCZOS)))[1]
+        layers.append((scaled, round(x * scale_x), round(y * scale_y)))
+    return layers
+
+
+def scaled_overlay(full_size, size, settings, text=None, box=None):
+    """水印在缩小到 size 的图片上的叠加层，返回 (叠加层, x, y)，没有水印时返回None
+
+    叠加层只覆盖各水印图层所在区域的并集，不是整幅图片大小；box 不为None时只渲染该区域。
+    """
+    layers = scaled_layers(full_size, size, settings, text, box)
+    bounds = box or (0, 0) + tuple(size)
+    boxes = [layer_box(layer, x, y, size) for layer, x, y in layers]
+    boxes = [(max(b[0], bounds[0]), max(b[1], bounds[1]), min(b[2], bounds[2]), min(b[3], bounds[3]))
+             for b in boxes]
+    boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+    if not boxes:
+        return None
+    box = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+    return _flatten(layers, box), box[0], box[1]
+
+
+def composite_scaled(image, full_size, settings, text=None):
+    """在缩小图上合成水印，效果与在原图上合成后再缩小一致"""
+    for layer, x, y in scaled_layers(full_size, image.size, settings, text):
+        composite_layer(image, layer, x, y)
+    return image
+
+
+def layer_box(layer, x, y, image_size=None):
+    """图层在图片坐标系中的区域，可选地裁剪到图片范围内"""
+    box = (x, y, x + layer.width, y + layer.height)
+    if image_size is not None:
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], image_size[0]), min(box[3], image_size[1]))
+    return box
+
+
+def composite_layer(image, layer, x, y, origin=(0, 0)):
+    """将图层合成到图片上，只处理重叠区域
+
+    origin 为 image 左上角在完整图片中的坐标，用于分块处理时合成到图块上。
+    """
+    # 图层相对于 image 的位置
+    x -= origin[0]
+    y -= origin[1]
+
+    left = max(x, 0)
+    top = max(y, 0)
+    right = min(x + layer.width, image.width)
+    bottom = min(y + layer.height, image.height)
+    if left >= right or top >= bottom:
+        return image
+
+    image.alpha_composite(layer, dest=(left, top), source=(left - x, top - y, right - x, bottom - y))
+    return image
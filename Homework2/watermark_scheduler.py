@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+# 优先级，数值越小越先执行
+PREVIEW = 0    # 交互预览（放大预览的图块等）
+THUMBNAIL = 1  # 可见的缩略图
+PREFETCH = 2   # 预取（即将滚动到可见的缩略图等）
+EXPORT = 3     # 批量导出
+
+PRIORITY_NAMES = {PREVIEW: "预览", THUMBNAIL: "可见缩略图", PREFETCH: "预取", EXPORT: "导出"}
+
+# 后台线程数，另有一个只执行预览任务的线程
+BACKGROUND_THREADS = max(1, (os.cpu_count() or 2) // 2)
+
+# 后台线程的 nice 值，只在 Linux 上按线程生效
+BACKGROUND_NICE = 10
+
+
+def _lower_thread_priority():
+    """降低当前线程的调度优先级，使后台任务不影响界面响应"""
+    if sys.platform.startswith("linux"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKGROUND_NICE)
+        except OSError as e:
+            print(f"降低后台线程优先级失败: {e}")
+
+
+class CancelToken:
+    """一批任务共用的取消标记
+
+    取消后尚未开始的任务从队列中移除，正在运行的任务可以检查 cancelled 自行提前结束。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class TaskScheduler:
+    """界面各功能共用的按优先级调度的线程池
+
+    队列按优先级排序，优先级相同时先提交的先执行；新提交的预览任务排在所有后台任务之前。
+    除后台线程外还有一个只执行预览任务的线程，预览不会等待正在运行的后台任务。
+    不经过队列的批量任务（导出流水线）在处理每一项之前调用 yield_to，有更高优先级的任务时暂停。
+    """
+
+    def __init__(self, background_threads=BACKGROUND_THREADS):
+        self.background_threads = background_threads
+        self._condition = threading.Condition()
+        self._queue = []  # (优先级, 序号, Future, 函数, 参数, 取消标记, 提交时间)
+        self._sequence = itertools.count()
+        self._running = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._metrics = {priority: {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0,
+                                    "max_queued": 0, "queue_wait": 0.0, "run_time": 0.0, "yield_wait": 0.0}
+                         for priority in PRIORITY_NAMES}
+        self._threads = []
+        self._shutdown = False
+
+    def _start(self):
+        """第一次提交任务时启动线程"""
+        if self._threads:
+            return
+        self._spawn("scheduler-preview", PREVIEW, False)
+        for i in range(self.background_threads):
+            self._spawn(f"scheduler-background-{i}", EXPORT, True)
+
+    def _spawn(self, name, lowest, background):
+        thread = threading.Thread(target=self._worker_loop, args=(lowest, background), name=name, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def submit(self, priority, fn, *args, token=None):
+        """提交任务，返回 Future；token 被取消时尚未开始的任务不再执行"""
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("调度器已关闭")
+            self._start()
+            heapq.heappush(self._queue, (priority, next(self._sequence), future, fn, args, token,
+                                         time.perf_counter()))
+            metrics = self._metrics[priority]
+            metrics["submitted"] += 1
+            metrics["max_queued"] = max(metrics["max_queued"], self._queued(priority))
+            self._condition.notify_all()
+        return future
+
+    def cancel(self, token):
+        """取消 token 对应的所有任务，尚未开始的立即从队列中移除"""
+        with self._condition:
+            # 在持有锁时设置，工作线程不会取出已取消但尚未移除的任务
+            token.cancel()
+            kept = []
+            removed = []
+            for entry in self._queue:
+                if entry[5] is token:
+                    removed.append(entry[2])
+                    self._metrics[entry[0]]["cancelled"] += 1
+                else:
+                    kept.append(entry)
+            heapq.heapify(kept)
+            self._queue = kept
+            self._condition.notify_all()
+        # Future 的回调在释放锁之后执行，回调中可以再提交任务
+        for future in removed:
+            future.cancel()
+
+    def _queued(self, priority):
+        return sum(1 for entry in self._queue if entry[0] == priority)
+
+    def _busy_above(self, priority):
+        """是否有优先级高于 priority 的任务在排队或运行"""
+        return ((self._queue and self._queue[0][0] < priority)
+                or any(count for p, count in self._running.items() if p < priority))
+
+    def yield_to(self, priority, cancelled=None):
+        """不经过队列的批量任务在处理每一项之前调用，有更高优先级的任务排队或运行时等待
+
+        cancelled 为可选的 threading.Event，设置后停止等待。
+        """
+        start = time.perf_counter()
+        with self._condition:
+            while (self._busy_above(priority) and not self._shutdown
+                   and not (cancelled is not None and cancelled.is_set())):
+                self._condition.wait(0.1)
+            self._metrics[priority]["yield_wait"] += time.perf_counter() - start
+
+    def _worker_loop(self, lowest, background):
+        """lowest 为该线程执行的最低优先级"""
+        if background:
+            _lower_thread_priority()
+        while True:
+            with self._condition:
+                while not self._shutdown and not (self._queue and self._queue[0][0] <= lowest):
+                    self._condition.wait()
+                if self._shutdown:
+                    return
+                priority, _, future, fn, args, token, submitted = heapq.heappop(self._queue)
+                metrics = self._metrics[priority]
+                skipped = token is not None and token.cancelled
+                run = not skipped and future.set_running_or_notify_cancel()
+                if run:
+                    metrics["queue_wait"] += time.perf_counter() - submitted
+                    self._running[priority] += 1
+                else:
+                    metrics["cancelled"] += 1
+            if not run:
+                if skipped:
+                    # 标记已取消的任务也要结束其 Future，否则等待结果或回调的调用方会一直等待
+                    future.cancel()
+                continue
+
+            start = time.perf_counter()
+            try:
+                future.set_result(fn(*args))
+                failed = False
+            except Exception as e:
+                future.set_exception(e)
+                failed = True
+            with self._condition:
+                self._running[priority] -= 1
+                metrics["run_time"] += time.perf_counter() - start
+                metrics["failed" if failed else "completed"] += 1
+                # 唤醒等待 yield_to 的批量任务
+                self._condition.notify_all()
+
+    def stats(self):
+        """返回各优先级的队列统计"""
+        with self._condition:
+            return {PRIORITY_NAMES[priority]: dict(metrics, queued=self._queued(priority),
+                                                   running=self._running[priority])
+                    for priority, metrics in self._metrics.items()}
+
+    def format_stats(self):
+        """将统计信息格式化为便于阅读的文本"""
+        lines = []
+        for name, s in self.stats().items():
+            if not s["submitted"] and not s["yield_wait"]:
+                continue
+            started = s["completed"] + s["failed"] + s["running"]
+            lines.append(
+                f"{name}: 提交 {s['submitted']}，完成 {s['completed']}，失败 {s['failed']}，取消 {s['cancelled']}，"
+                f"排队 {s['queued']}（最多 {s['max_queued']}），"
+                f"平均排队 {s['queue_wait'] / started * 1000 if started else 0:.1f}ms，"
+                f"运行 {s['run_time']:.1f}s，让出等待 {s['yield_wait']:.1f}s"
+            )
+        return "\n".join(lines)
+
+    def shutdown(self):
+        """取消所有排队的任务并停止线程，正在运行的任务会继续完成"""
+        with self._condition:
+            self._shutdown = True
+            for entry in self._queue:
+                entry[2].cancel()
+            self._queue = []
+            self._condition.notify_all()
+
+
+# 应用共用的调度器
+scheduler = TaskScheduler()
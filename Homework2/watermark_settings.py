@@ -17,6 +17,13 @@ class WatermarkSettings:
         self.text_outline = False
         self.outline_width = 2
         
+        # 柔和阴影：阴影按模糊半径做高斯模糊，替代固定偏移2像素的硬阴影
+        self.shadow_soft = False
+        self.shadow_blur = 4  # 模糊半径（像素）
+        self.shadow_offset_x = 3
+        self.shadow_offset_y = 3
+        self.shadow_color = QColor(0, 0, 0, 160)
+        
         # 图片水印设置
         self.watermark_image_path = ""
         self.watermark_image_scale = 1.0
@@ -25,9 +32,64 @@ class WatermarkSettings:
         self.watermark_image_height = 100
         self.watermark_image_opacity = 100  # 百分比
         
+        # 相对大小：按图片短边的百分比确定水印大小，不同分辨率的图片上比例一致
+        self.text_relative_size = False
+        self.text_size_ratio = 5.0  # 字号占短边的百分比
+        self.image_relative_size = False
+        self.image_size_ratio = 20.0  # 水印图片长边占短边的百分比
+        
         # 位置和旋转
         self.position = "右下"  # 默认右下角
+        # 在预览中拖拽后位置为"自定义"，水印中心在图片中的归一化坐标（0~1），不同尺寸的图片上位置一致；
+        # 文本和图片水印分别保存，拖拽后两者保持拖拽时的相对位置
+        self.position_x = 0.5
+        self.position_y = 0.5
+        self.image_position_x = 0.5
+        self.image_position_y = 0.5
         self.rotation = 0  # 旋转角度
+        
+        # 自动模式：按每张图片的内容选择背景最平坦的位置，以及与背景对比明显的文本颜色和不透明度
+        self.auto_position = False
+        self.auto_contrast = False
+        
+        # 平铺：水印按斜向错开的网格重复铺满整幅图片，忽略位置设置
+        self.tiled = False
+        self.tile_spacing = 50  # 单元之间的间距，占水印大小的百分比
+        
+        # 其他水印图层，按叠加顺序从下到上；每个图层有自己的文本、图片、位置和旋转，
+        # 当前编辑的水印叠加在最上面
+        self.extra_layers = []
+    
+    def layer_stack(self):
+        """按叠加顺序（从下到上）返回所有水印图层"""
+        return self.extra_layers + [self]
+    
+    def describe(self):
+        """图层列表中显示的简短说明"""
+        parts = []
+        if self.watermark_image_path:
+            parts.append(os.path.basename(self.watermark_image_path))
+        if self.text_content.strip():
+            parts.append(self.text_content)
+        placement = "平铺" if self.tiled else ("自动" if self.auto_position else self.position)
+        return f"{' + '.join(parts) or '(空)'} [{placement}]"
+    
+    def diff(self, base):
+        """与 base 不同的字段，格式与 to_dict 相同，用作单张图片的覆盖设置"""
+        base_data = base.to_dict()
+        return {key: value for key, value in self.to_dict().items() if base_data.get(key) != value}
+    
+    def with_overrides(self, overrides):
+        """合并单张图片的覆盖设置，返回这张图片实际使用的设置
+        
+        只在有覆盖时创建新的设置对象，原设置不变；没有覆盖时直接返回本设置，
+        这些图片共用同一个设置对象，渲染缓存也按同样的设置命中。
+        """
+        if not overrides:
+            return self
+        data = self.to_dict()
+        data.update(overrides)
+        return WatermarkSettings.from_dict(data)
     
     def to_dict(self):
         """将设置转换为字典，用于保存"""
@@ -47,14 +109,37 @@ class WatermarkSettings:
             "text_shadow": self.text_shadow,
             "text_outline": self.text_outline,
             "outline_width": self.outline_width,
+            "shadow_soft": self.shadow_soft,
+            "shadow_blur": self.shadow_blur,
+            "shadow_offset_x": self.shadow_offset_x,
+            "shadow_offset_y": self.shadow_offset_y,
+            "shadow_color": {
+                "r": self.shadow_color.red(),
+                "g": self.shadow_color.green(),
+                "b": self.shadow_color.blue(),
+                "a": self.shadow_color.alpha()
+            },
             "watermark_image_path": self.watermark_image_path,
             "watermark_image_scale": self.watermark_image_scale,
             "keep_aspect_ratio": self.keep_aspect_ratio,
             "watermark_image_width": self.watermark_image_width,
             "watermark_image_height": self.watermark_image_height,
             "watermark_image_opacity": self.watermark_image_opacity,
+            "text_relative_size": self.text_relative_size,
+            "text_size_ratio": self.text_size_ratio,
+            "image_relative_size": self.image_relative_size,
+            "image_size_ratio": self.image_size_ratio,
             "position": self.position,
-            "rotation": self.rotation
+            "position_x": self.position_x,
+            "position_y": self.position_y,
+            "image_position_x": self.image_position_x,
+            "image_position_y": self.image_position_y,
+            "rotation": self.rotation,
+            "auto_position": self.auto_position,
+            "auto_contrast": self.auto_contrast,
+            "tiled": self.tiled,
+            "tile_spacing": self.tile_spacing,
+            "layers": [layer.to_dict() for layer in self.extra_layers]
         }
     
     @classmethod
@@ -84,6 +169,17 @@ class WatermarkSettings:
         settings.text_shadow = data.get("text_shadow", False)
         settings.text_outline = data.get("text_outline", False)
         settings.outline_width = data.get("outline_width", 2)
+        settings.shadow_soft = data.get("shadow_soft", False)
+        settings.shadow_blur = data.get("shadow_blur", 4)
+        settings.shadow_offset_x = data.get("shadow_offset_x", 3)
+        settings.shadow_offset_y = data.get("shadow_offset_y", 3)
+        shadow_data = data.get("shadow_color", {"r": 0, "g": 0, "b": 0, "a": 160})
+        settings.shadow_color = QColor(
+            shadow_data.get("r", 0),
+            shadow_data.get("g", 0),
+            shadow_data.get("b", 0),
+            shadow_data.get("a", 160)
+        )
         
         # 图片水印设置
         settings.watermark_image_path = data.get("watermark_image_path", "")
@@ -93,8 +189,25 @@ class WatermarkSettings:
         settings.watermark_image_height = data.get("watermark_image_height", 100)
         settings.watermark_image_opacity = data.get("watermark_image_opacity", 100)
         
+        # 相对大小
+        settings.text_relative_size = data.get("text_relative_size", False)
+        settings.text_size_ratio = data.get("text_size_ratio", 5.0)
+        settings.image_relative_size = data.get("image_relative_size", False)
+        settings.image_size_ratio = data.get("image_size_ratio", 20.0)
+        
         # 位置和旋转
         settings.position = data.get("position", "右下")
+        settings.position_x = data.get("position_x", 0.5)
+        settings.position_y = data.get("position_y", 0.5)
+        settings.image_position_x = data.get("image_position_x", settings.position_x)
+        settings.image_position_y = data.get("image_position_y", settings.position_y)
         settings.rotation = data.get("rotation", 0)
+        settings.auto_position = data.get("auto_position", False)
+        settings.auto_contrast = data.get("auto_contrast", False)
+        settings.tiled = data.get("tiled", False)
+        settings.tile_spacing = data.get("tile_spacing", 50)
+        
+        # 其他水印图层
+        settings.extra_layers = [cls.from_dict(layer) for layer in data.get("layers", [])]
         
         return settings
\ No newline at end of file
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import struct
+from PIL import Image, ImageFile, UnidentifiedImageError
+
+from watermark_render import render_stack, flatten_layers, pattern_band, composite_layer, layer_box
+from watermark_png import PngStreamWriter
+from watermark_encode import ENCODER_PRESETS, frame_mode
+from watermark_metadata import ImageMetadata
+from watermark_auto import ANALYSIS_SIZE, analysis_proxy, auto_settings
+
+# 超过该像素数的图片默认使用分块处理
+TILED_PIXEL_THRESHOLD = 64 * 1000 * 1000
+
+# 行带的默认高度
+BAND_HEIGHT = 256
+
+# 可以按行拆分的原始数据格式及每像素位数
+_RAW_BITS = {
+    "1": 1, "L": 8, "P": 8, "RGB": 24, "BGR": 24, "RGBA": 32, "RGBX": 32,
+    "BGRX": 32, "BGRA": 32, "CMYK": 32, "I;16": 16, "I;16B": 16, "LA": 16,
+}
+
+
+def open_unbounded(path):
+    """打开图片（只读文件头），不做 Image.open 的解压炸弹检查
+
+    分块模式下内存占用与图片大小无关，因此可以安全地打开超大图片。
+    与 Image.open 一样按文件开头识别格式，但不修改全局的 Image.MAX_IMAGE_PIXELS，
+    其他线程同时打开的图片仍然受限制。
+    """
+    Image.init()
+    with open(path, "rb") as f:
+        prefix = f.read(16)
+    for name in Image.ID:
+        factory, accept = Image.OPEN[name]
+        try:
+            result = not accept or accept(prefix)
+            if not result or isinstance(result, str):
+                continue
+            # 传入路径时由图像对象自己打开和关闭文件
+            return factory(path, path)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+    raise UnidentifiedImageError(f"无法识别图片格式: {path}")
+
+
+def _make_tile(decoder, extents, offset, args):
+    tile_class = getattr(ImageFile, "_Tile", None)
+    if tile_class is not None:
+        return tile_class(decoder, extents, offset, args)
+    return decoder, extents, offset, args
+
+
+class TiledSource:
+    """按行带读取源图片
+
+    TIFF 的条带/图块以及 BMP、PPM 等未压缩格式可以只解码需要的行；
+    其他格式（如 JPEG、压缩 PNG）无法局部解码，退化为整幅解码后按行带切分。
+    """
+
+    def __init__(self, path, band_height=BAND_HEIGHT, header=None):
+        """header 为已经用 open_unbounded 打开的文件头，读取后关闭，不传入时重新打开"""
+        self.path = path
+        self.band_height = band_height
+
+        im = header or open_unbounded(path)
+        try:
+            self.size = im.size
+            self.mode = im.mode
+            self.format = im.format
+            self._tiles = list(im.tile)
+            # 分块处理不旋转像素，方向标签原样保留
+            self.metadata = ImageMetadata.from_image(im)
+        finally:
+            im.close()
+
+        self._stride = None
+        self._boundaries = self._row_boundaries()
+        self._full = None
+
+    @property
+    def streamable(self):
+        """是否可以只解码部分行"""
+        return self._boundaries is not None
+
+    def _row_boundaries(self):
+        """返回可以独立解码的行边界，无法局部解码时返回None"""
+        width, height = self.size
+        if not self._tiles or any(tile[0] == "libtiff" for tile in self._tiles):
+            return None
+
+        if len(self._tiles) == 1:
+            decoder, extents, offset, args = self._tiles[0]
+            if decoder != "raw" or tuple(extents) != (0, 0, width, height):
+                return None
+            if isinstance(args, str):
+                args = (args,)
+            rawmode = args[0]
+            stride = args[1] if len(args) > 1 else 0
+            if not stride:
+                if rawmode not in _RAW_BITS:
+                    return None
+                stride = (width * _RAW_BITS[rawmode] + 7) // 8
+            self._stride = stride
+            # 单个原始数据块，任意行都可以作为边界
+            return None if height <= self.band_height else list(range(0, height + 1))
+
+        boundaries = {0, height}
+        for _, extents, _, _ in self._tiles:
+            boundaries.add(extents[1])
+            boundaries.add(extents[3])
+        return sorted(boundaries)
+
+    def bands(self):
+        """生成 (y0, y1) 行带，尽量贴近 band_height 并与条带边界对齐"""
+        height = self.size[1]
+        if self._boundaries is None:
+            boundaries = list(range(0, height, self.band_height)) + [height]
+        else:
+            boundaries = self._boundaries
+
+        y0 = 0
+        index = 0
+        while y0 < height:
+            while index < len(boundaries) and boundaries[index] < y0 + self.band_height:
+                index += 1
+            y1 = boundaries[index] if index < len(boundaries) else height
+            yield y0, y1
+            y0 = y1
+
+    def read_band(self, y0, y1):
+        """读取 [y0, y1) 行，返回源图模式的图像"""
+        width, height = self.size
+        if not self.streamable:
+            if self._full is None:
+                self._full = open_unbounded(self.path)
+                self._full.load()
+            return self._full.crop((0, y0, width, y1))
+
+        im = open_unbounded(self.path)
+        try:
+            if self._stride is not None:
+                decoder, _, offset, args = self._tiles[0]
+                if isinstance(args, str):
+                    args = (args,)
+                direction = args[2] if len(args) > 2 else 1
+                # 自下而上存储的图片（如BMP）从文件末尾开始
+                first_row = height - y1 if direction < 0 else y0
+                tiles = [_make_tile(decoder, (0, 0, width, y1 - y0), offset + first_row * self._stride,
+                                    (args[0], self._stride, direction) + tuple(args[3:]))]
+            else:
+                tiles = [
+                    _make_tile(decoder, (extents[0], extents[1] - y0, extents[2], extents[3] - y0), offset, args)
+                    for decoder, extents, offset, args in self._tiles
+                    if extents[1] < y1 and extents[3] > y0
+                ]
+            im.tile = tiles
+            im._size = (width, y1 - y0)
+            if hasattr(im, "_tile_size"):
+                # TIFF 按 _tile_size 分配解码缓冲
+                im._tile_size = im._size
+            im.load()
+            # 关闭文件后内存映射失效，需要复制一份
+            return im.copy()
+        finally:
+            im.close()
+
+    def close(self):
+        if self._full is not None:
+            self._full.close()
+            self._full = None
+
+    def estimate_working_set(self, output_format):
+        """估算分块处理时的内存占用（字节）"""
+        width, height = self.size
+        # 源行带、转换后的行带和 PNG 编码缓冲
+        total = width * (self.band_height * 2) * 4 * 3
+        if not self.streamable:
+            total += width * height * 4
+        if output_format != "png":
+            # 只有 PNG 可以流式写出，其他编码器需要完整的帧
+            total += width * height * len(frame_mode(output_format)) * 2
+        return total
+
+    def make_proxy(self, max_size):
+        """生成长边不超过 max_size 的缩略图，内存占用与原图大小无关"""
+        width, height = self.size
+        scale = min(1.0, max_size / max(width, height))
+        proxy_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        if self.format == "JPEG" or not self.streamable:
+            im = open_unbounded(self.path)
+            try:
+                # JPEG 解码时直接按 1/2、1/4、1/8 缩小
+                im.draft("RGB", proxy_size)
+                return im.convert("RGBA").resize(proxy_size, Image.BILINEAR)
+            finally:
+                im.close()
+
+        proxy = Image.new("RGBA", proxy_size)
+        for y0, y1 in self.bands():
+            ty0 = round(y0 * scale)
+            ty1 = max(ty0 + 1, round(y1 * scale))
+            if ty0 >= proxy_size[1]:
+                break
+            band = self.read_band(y0, y1).convert("RGBA")
+            proxy.paste(band.resize((proxy_size[0], ty1 - ty0), Image.BILINEAR), (0, ty0))
+        return proxy
+
+
+    def analysis_proxy(self, max_size=ANALYSIS_SIZE):
+        """自动模式统计用的灰度缩略图
+
+        JPEG 只按 1/8 解码亮度；可局部解码的格式只读取均匀分布的 max_size 行；
+        其他格式需要完整解码，解码结果留给随后的 read_band 使用。
+        """
+        width, height = self.size
+        scale = min(1.0, max_size / max(width, height))
+        proxy_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        if self.format == "JPEG":
+            im = open_unbounded(self.path)
+            try:
+                im.draft("L", proxy_size)
+                return im.convert("L").resize(proxy_size, Image.NEAREST)
+            finally:
+                im.close()
+
+        if not self.streamable:
+            self.read_band(0, 1)
+            return analysis_proxy(self._full, max_size)
+
+        proxy = Image.new("L", proxy_size)
+        for row in range(proxy_size[1]):
+            y = min(int((row + 0.5) * height / proxy_size[1]), height - 1)
+            line = self.read_band(y, y + 1).convert("L")
+            proxy.paste(line.resize((proxy_size[0], 1), Image.NEAREST), (0, row))
+        return proxy
+
+
+def render_tiled(source, settings, output_format, png_file=None, preset="balanced", metadata=None, text=None):
+    """分块渲染水印
+
+    只有与水印区域重叠的部分会被转换为RGBA并合成，其余行带直接送入编码器。
+    PNG 输出直接流式写入 png_file 并返回None，metadata 写入PNG文件头；其他格式返回完整的图像交给编码器。
+    """
+    width, height = source.size
+    # 自动位置和自动对比度按缩略图的统计结果调整设置
+    settings = auto_settings(settings, source.size, source.analysis_proxy, text)
+    # 按叠加顺序分成若干步：平铺图层的图案按行带生成，不生成整幅图片大小的图案；
+    # 相邻的定位图层合并重叠部分后按区域合成
+    steps = []
+    for layer, x, y in render_stack(source.size, settings, text, patterns=False):
+        if x is None:
+            steps.append((layer, None))
+        elif steps and steps[-1][0] is None:
+            steps[-1][1].append((layer, x, y))
+        else:
+            steps.append((None, [(layer, x, y)]))
+    steps = [(tile, None) if tile is not None else
+             (None, [(layer, x, y, layer_box(layer, x, y, source.size))
+                     for layer, x, y in flatten_layers(layers, source.size)])
+             for tile, layers in steps]
+
+    out_mode = frame_mode(output_format)
+    if output_format == "png":
+        options = ENCODER_PRESETS["png"][preset]
+        writer = PngStreamWriter(png_file, source.size, out_mode, options["compress_level"], options["filter"],
+                                 metadata=metadata)
+        frame = None
+    else:
+        writer = None
+        frame = Image.new(out_mode, source.size)
+
+    try:
+        for y0, y1 in source.bands():
+            band = source.read_band(y0, y1).convert(out_mode)
+
+            for tile, layers in steps:
+                if tile is not None:
+                    # 图案覆盖整个行带
+                    band = band.convert("RGBA")
+                    band.alpha_composite(pattern_band(tile, source.size, y0, y1))
+                    band = band.convert(out_mode)
+                    continue
+
+                for layer, x, y, box in layers:
+                    top = max(box[1], y0)
+                    bottom = min(box[3], y1)
+                    if box[0] >= box[2] or top >= bottom:
+                        continue
+                    # 只处理水印覆盖的区域
+                    roi = band.crop((box[0], top - y0, box[2], bottom - y0)).convert("RGBA")
+                    composite_layer(roi, layer, x, y, origin=(box[0], top))
+                    band.paste(roi.convert(out_mode), (box[0], top - y0))
+
+            if writer is not None:
+                writer.write_band(band)
+            else:
+                frame.paste(band, (0, y0))
+
+        if writer is not None:
+            writer.close()
+    finally:
+        source.close()
+
+    return frame
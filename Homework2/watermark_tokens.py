@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+# 水印文本中可用的变量及界面说明
+TOKEN_NAMES = {
+    "date": "拍摄日期",
+    "filename": "文件名",
+    "camera": "相机型号",
+    "index": "序号",
+}
+
+# {名称} 或 {名称:格式}，例如 {index:03d}
+_TOKEN_PATTERN = re.compile(r"\{(\w+)(?::([^{}]*))?\}")
+
+# 需要读取文件元数据的变量
+_METADATA_TOKENS = {"date", "camera"}
+
+EXIF_IFD = 0x8769
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+
+# 批量读取文件头的线程数，读取以磁盘IO为主
+METADATA_THREADS = 8
+
+
+def used_tokens(template):
+    """模板中用到的已知变量名集合"""
+    return {name for name, _ in _TOKEN_PATTERN.findall(template) if name in TOKEN_NAMES}
+
+
+def has_tokens(template):
+    return bool(used_tokens(template))
+
+
+def resolve_text(template, values):
+    """用变量值替换模板中的变量，未知的变量原样保留"""
+    def replace(match):
+        name, spec = match.group(1), match.group(2)
+        if name not in values:
+            return match.group(0)
+        try:
+            return format(values[name], spec or "")
+        except (TypeError, ValueError):
+            return str(values[name])
+    return _TOKEN_PATTERN.sub(replace, template)
+
+
+def _format_exif_date(value, path):
+    """将 YYYY:MM:DD HH:MM:SS 转换为 YYYY-MM-DD，没有或格式不正确时用文件修改时间，文件无法访问时为空"""
+    try:
+        return datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S").strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d")
+    except OSError as e:
+        print(f"读取 {path} 的修改时间失败: {e}")
+        return ""
+
+
+def read_token_values(path, tokens=None):
+    """读取一张图片的变量值（不含序号），只读取文件头，不解码图像
+
+    tokens 为需要的变量名集合，None 表示全部；不需要日期和相机时不打开文件。
+    """
+    values = {"filename": os.path.splitext(os.path.basename(path))[0]}
+    if tokens is not None and not tokens & _METADATA_TOKENS:
+        return values
+
+    date = camera = None
+    try:
+        with Image.open(path) as im:
+            exif = im.getexif()
+            exif_ifd = exif.get_ifd(EXIF_IFD)
+            # 优先 DateTimeOriginal，其次 DateTimeDigitized，再其次 DateTime
+            date = (exif_ifd.get(TAG_DATETIME_ORIGINAL) or exif_ifd.get(TAG_DATETIME_DIGITIZED)
+                    or exif.get(TAG_DATETIME))
+            make = str(exif.get(TAG_MAKE, "")).strip("\x00 ")
+            model = str(exif.get(TAG_MODEL, "")).strip("\x00 ")
+            # 多数相机的型号已经包含厂商名
+            camera = model if model.lower().startswith(make.lower()) else f"{make} {model}".strip()
+    except Exception as e:
+        print(f"读取 {path} 的元数据失败: {e}")
+
+    values["date"] = _format_exif_date(date or "", path)
+    values["camera"] = camera or ""
+    return values
+
+
+def resolve_texts(template, paths, on_read=None, cancelled=None):
+    """批量解析每张图片的水印文本，返回与 paths 对应的文本列表
+
+    所有图片的元数据在渲染之前一次读取完成；序号按 paths 中的顺序从1开始。
+    template 为多个水印图层的模板列表时，每张图片的结果是与之对应的文本列表；
+    各图片的模板不同时（如单张图片覆盖了设置），template 为 template(i) 返回第 i 张图片模板的函数。
+    on_read 在每读取完一张图片后调用（在读取线程中），用于显示进度；
+    cancelled 为可选的 threading.Event，设置后不再读取，返回None。
+    """
+    templates = [template(i) if callable(template) else template for i in range(len(paths))]
+    layers = [t if isinstance(t, list) else [t] for t in templates]
+    tokens = [set().union(*(used_tokens(t) for t in image_layers)) for image_layers in layers]
+    if not any(tokens):
+        return templates
+
+    def read(index):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        values = read_token_values(paths[index], tokens[index])
+        if on_read is not None:
+            on_read()
+        return values
+
+    if any(image_tokens & _METADATA_TOKENS for image_tokens in tokens) and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(METADATA_THREADS, len(paths))) as executor:
+            all_values = list(executor.map(read, range(len(paths))))
+    else:
+        all_values = [read(index) for index in range(len(paths))]
+    if cancelled is not None and cancelled.is_set():
+        return None
+
+    results = []
+    for index, values in enumerate(all_values):
+        values["index"] = index + 1
+        texts = [resolve_text(t, values) for t in layers[index]]
+        results.append(texts if isinstance(templates[index], list) else texts[0])
+    return results
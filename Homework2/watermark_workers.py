@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+# 子进程只接收文件路径和设置字典，解码后的图像不经过 pickle
+# 使用 spawn 方式启动，避免在已有线程和 Qt 对象的进程中 fork
+_context = multiprocessing.get_context("spawn")
+
+# 子进程中的导出设置，由进程池初始化函数设置
+_worker_settings = None
+_worker_options = None
+_worker_size_estimator = None
+
+
+def peak_rss():
+    """返回当前进程的峰值常驻内存（字节），不支持的平台返回None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位是字节，Linux 单位是KB
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _init_export_worker(settings_dict, encode_options):
+    global _worker_settings, _worker_options, _worker_size_estimator
+    from watermark_settings import WatermarkSettings
+    from watermark_encode import TargetSizeEstimator
+    _worker_settings = WatermarkSettings.from_dict(settings_dict)
+    _worker_options = encode_options
+    # 每个子进程各自学习目标大小与质量的关系
+    _worker_size_estimator = TargetSizeEstimator()
+
+
+def _export_in_worker(task):
+    """子进程中导出一张图片：解码、渲染、编码并原子写入"""
+    from watermark_image import WatermarkImage
+    from watermark_tiles import TiledSource, render_tiled
+    from watermark_encode import encode_for_export
+    from watermark_metadata import metadata_options
+    from watermark_journal import write_file_atomic, write_stream_atomic
+
+    index, path, output_path, temp_path, tiled, text, overrides = task
+    # 只有覆盖了部分设置的图片才创建新的设置对象
+    settings = _worker_settings.with_overrides(overrides)
+    output_format = _worker_options["output_format"]
+    policy = _worker_options["metadata"]
+    start = time.perf_counter()
+    trials = 0
+    fits = True
+
+    if tiled:
+        source = TiledSource(path)
+        metadata = metadata_options(source.metadata, policy)
+        if output_format == "png":
+            write_stream_atomic(lambda f: render_tiled(source, settings, output_format, f,
+                                                       _worker_options["preset"], metadata, text),
+                                output_path, temp_path)
+        else:
+            frame = render_tiled(source, settings, output_format, text=text)
+            data, trials, fits = encode_for_export(frame, _worker_options, metadata, _worker_size_estimator)
+            write_file_atomic(data, output_path, temp_path)
+    else:
+        img = WatermarkImage(path, load=False)
+        img.decode_image()
+        result = img.apply_watermark(settings, text)
+        img.release_image()
+        metadata = metadata_options(img.metadata, policy)
+        data, trials, fits = encode_for_export(result, _worker_options, metadata, _worker_size_estimator)
+        write_file_atomic(data, output_path, temp_path)
+
+    return {"index": index, "pid": os.getpid(), "peak_rss": peak_rss(),
+            "elapsed": time.perf_counter() - start, "trials": trials, "fits": fits}
+
+
+class ProcessExportPool:
+    """导出用的进程池，每个任务只传递路径，水印设置和编码选项在进程启动时传递一次"""
+
+    def __init__(self, processes, settings, encode_options):
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=_context,
+            initializer=_init_export_worker, initargs=(settings.to_dict(), encode_options)
+        )
+
+    def submit(self, index, path, output_path, temp_path, tiled, text=None, overrides=None):
+        """overrides 为这张图片的覆盖设置（字典），与水印文本一样随任务传递"""
+        task = (index, path, output_path, temp_path, tiled, text, overrides)
+        return self.executor.submit(_export_in_worker, task)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)